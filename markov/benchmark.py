@@ -0,0 +1,202 @@
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import tempfile
+import time
+import pymongo
+from instrumentation import Instrumentation
+from markov import MarkovGenerator
+from storage import MongoStorage, SQLiteStorage
+
+
+def generate_corpus(path, tokens, vocabulary, zipf=1.1, seed=0):
+    """
+    Генерация синтетического корпуса с распределением слов по закону Ципфа
+
+    :param path: путь к файлу корпуса
+    :type path: str
+    :param tokens: количество слов
+    :type tokens: int
+    :param vocabulary: размер словаря
+    :type vocabulary: int
+    :param zipf: показатель закона Ципфа
+    :type zipf: float
+    :param seed: начальное значение генератора случайных чисел
+    :type seed: int
+    """
+    rnd = random.Random(seed)
+    words = ['w{}'.format(i) for i in range(vocabulary)]
+    cum_weights = list()
+    total = 0.0
+    for rank in range(1, vocabulary + 1):
+        total += 1.0 / rank ** zipf
+        cum_weights.append(total)
+    written = 0
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write('END')
+        while written < tokens:
+            length = min(rnd.randint(3, 25), tokens - written)
+            file.write(' ' + ' '.join(rnd.choices(words, cum_weights=cum_weights, k=length)) + ' . END')
+            written += length + 2
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """
+    Перцентили значений
+
+    :param values: значения
+    :type values: list
+    :param points: перцентили
+    :type points: tuple
+    :return: словарь {'p50': значение, ...}
+    :rtype: dict
+    """
+    values = sorted(values)
+    if not values:
+        return dict()
+    return {'p{}'.format(p): values[min(len(values) - 1, int(len(values) * p / 100))] for p in points}
+
+
+def git_commit():
+    """
+    Текущий коммит репозитория
+
+    :return: хэш коммита или None
+    :rtype: str
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def peak_rss():
+    """
+    Пиковый размер резидентной памяти процесса
+
+    :return: размер в байтах
+    :rtype: int
+    """
+    # На Linux 'ru_maxrss' в килобайтах, на macOS - в байтах
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if platform.system() == 'Darwin' else rss * 1024
+
+
+def connect(backend, database):
+    """
+    Подключение к хранилищу для замера
+
+    :param backend: 'mongo' - локальный mongod, 'memory' - mongomock в памяти, 'sqlite' - файл SQLite
+    :type backend: str
+    :param database: имя базы данных или путь к файлу SQLite
+    :type database: str
+    :return: хранилище
+    :rtype: class storage.Storage
+    """
+    if backend == 'sqlite':
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(database + suffix):
+                os.remove(database + suffix)
+        return SQLiteStorage(database)
+    if backend == 'memory':
+        import mongomock
+        client = mongomock.MongoClient()
+    else:
+        client = pymongo.MongoClient("mongodb://localhost:27017/")
+    client.drop_database(database)
+    return MongoStorage(client[database])
+
+
+def run(args):
+    """
+    Запуск замеров обучения, дообучения, сохранения и генерации
+
+    :param args: параметры командной строки
+    :type args: argparse.Namespace
+    :return: результаты замеров
+    :rtype: dict
+    """
+    db = connect(args.backend, args.database)
+    results = {'commit': git_commit(), 'time': time.time(), 'python': platform.python_version(),
+               'parameters': vars(args)}
+    with tempfile.TemporaryDirectory() as directory:
+        train_path = os.path.join(directory, 'train.txt')
+        retrain_path = os.path.join(directory, 'retrain.txt')
+        generate_corpus(train_path, args.tokens, args.vocabulary, args.zipf, args.seed)
+        generate_corpus(retrain_path, args.retrain_tokens, args.vocabulary * 2, args.zipf, args.seed + 1)
+
+        options = {'engine': args.engine, 'chunk_size': args.chunk_size, 'workers': args.workers,
+                   'writers': args.writers, 'memory_budget': args.memory_budget}
+        instrumentation = Instrumentation()
+        started = time.perf_counter()
+        MarkovGenerator(MarkovGenerator.TrainStrategy(database=db, text_path=train_path, window_size=args.window_size,
+                                                      instrumentation=instrumentation, **options))
+        elapsed = time.perf_counter() - started
+        save = instrumentation.stages['save']
+        states = db.count_states()
+        results['train'] = {'seconds': elapsed, 'tokens_per_sec': args.tokens / elapsed, 'states': states,
+                            'save_seconds': save['wall'], 'keys_per_sec_saved': states / max(save['wall'], 1e-9),
+                            'stages': instrumentation.summary()['stages']}
+
+        instrumentation = Instrumentation()
+        started = time.perf_counter()
+        MarkovGenerator(MarkovGenerator.RetrainStrategy(database=db, text_path=retrain_path,
+                                                        window_size=args.window_size,
+                                                        instrumentation=instrumentation, **options))
+        elapsed = time.perf_counter() - started
+        save = instrumentation.stages['save']
+        results['retrain'] = {'seconds': elapsed, 'tokens_per_sec': args.retrain_tokens / elapsed,
+                              'save_seconds': save['wall'],
+                              'stages': instrumentation.summary()['stages']}
+
+    generator = MarkovGenerator(MarkovGenerator.GenerateStrategy(db, args.window_size))
+    latencies = list()
+    for _ in range(args.sentences):
+        started = time.perf_counter()
+        generator.generate_sentence(args.sentence_size)
+        latencies.append(time.perf_counter() - started)
+    started = time.perf_counter()
+    generator.generate_sentences(args.sentences, args.sentence_size, batched=True)
+    batched = time.perf_counter() - started
+    results['generate'] = {'sentence_latency': percentiles(latencies),
+                           'sentences_per_sec': len(latencies) / max(sum(latencies), 1e-9),
+                           'batched_sentences_per_sec': args.sentences / max(batched, 1e-9),
+                           'cache': generator.strategy.model.cache.stats()}
+    results['peak_rss'] = peak_rss()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Замеры производительности цепи Маркова')
+    parser.add_argument('--backend', choices=['mongo', 'memory', 'sqlite'], default='memory')
+    parser.add_argument('--database', default='markov_benchmark', help='имя базы данных или путь к файлу SQLite')
+    parser.add_argument('--tokens', type=int, default=100000)
+    parser.add_argument('--retrain-tokens', type=int, default=10000)
+    parser.add_argument('--vocabulary', type=int, default=5000)
+    parser.add_argument('--zipf', type=float, default=1.1)
+    parser.add_argument('--window-size', type=int, default=2)
+    parser.add_argument('--engine', choices=['python', 'numpy', 'packed'], default='python')
+    parser.add_argument('--chunk-size', type=int, default=None)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--writers', type=int, default=1, help='потоки записи модели')
+    parser.add_argument('--memory-budget', type=int, default=None, help='бюджет памяти модели в байтах')
+    parser.add_argument('--sentences', type=int, default=100)
+    parser.add_argument('--sentence-size', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='путь к JSON-файлу с результатами')
+    args = parser.parse_args()
+
+    results = run(args)
+    text = json.dumps(results, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import sys
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Ограниченный кэш с вытеснением давно не использованных элементов (LRU)
+    """
+    def __init__(self, max_entries=None, max_bytes=None, sizeof=sys.getsizeof):
+        """
+
+        :param max_entries: максимальное количество элементов, None - без ограничения
+        :type max_entries: int
+        :param max_bytes: максимальный суммарный размер элементов в байтах, None - без ограничения
+        :type max_bytes: int
+        :param sizeof: функция оценки размера элемента в байтах
+        :type sizeof: callable
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.data = OrderedDict()
+        self.sizes = dict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        """
+        Получение элемента с обновлением его позиции
+
+        :param key: ключ
+        :param default: значение при отсутствии ключа
+        :return: элемент или 'default'
+        """
+        if key in self.data:
+            self.data.move_to_end(key)
+            self.hits += 1
+            return self.data[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        """
+        Добавление элемента и вытеснение старых при превышении лимитов
+
+        :param key: ключ
+        :param value: значение
+        """
+        if self.max_entries == 0:
+            return
+        if key in self.data:
+            self.nbytes -= self.sizes[key]
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        self.data[key] = value
+        self.data.move_to_end(key)
+        self.sizes[key] = size
+        self.nbytes += size
+        self.evict()
+
+    def evict(self):
+        """
+        Вытеснение элементов до соблюдения лимитов
+        """
+        while self.data and ((self.max_entries is not None and len(self.data) > self.max_entries) or
+                             (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+            key, _ = self.data.popitem(last=False)
+            self.nbytes -= self.sizes.pop(key)
+
+    def clear(self):
+        """
+        Явная инвалидация всего кэша
+        """
+        self.data.clear()
+        self.sizes.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        """
+        Статистика использования кэша
+
+        :return: количество элементов, размер, попадания и промахи
+        :rtype: dict
+        """
+        return {'entries': len(self.data), 'bytes': self.nbytes, 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,158 @@
+import argparse
+import json
+import random
+import time
+from benchmark import percentiles
+from markov_chain import MarkovChain
+
+
+def prune_value(value, min_count=1, top_k=None):
+    """
+    Отбор переходов состояния
+
+    :param value: распределение {индекс: частота}
+    :type value: dict
+    :param min_count: минимальная частота перехода
+    :type min_count: int
+    :param top_k: количество самых частых переходов, None - без ограничения
+    :type top_k: int, optional
+    :return: оставшееся распределение
+    :rtype: dict
+    """
+    res = {successor: count for successor, count in value.items() if count >= min_count}
+    if top_k is not None and len(res) > top_k:
+        res = dict(sorted(res.items(), key=lambda item: item[1], reverse=True)[:top_k])
+    return res
+
+
+def measure_latency(model, sentences, length, seed=0):
+    """
+    Задержка генерации предложений запросами к хранилищу без кэша.
+    Тупиковое состояние заканчивает предложение
+
+    :param model: цепь Маркова
+    :type model: class markov_chain.MarkovChain
+    :param sentences: количество предложений
+    :type sentences: int
+    :param length: количество слов в предложении
+    :type length: int
+    :param seed: начальное значение генератора случайных чисел
+    :type seed: int
+    :return: перцентили задержки в секундах
+    :rtype: dict
+    """
+    random.seed(seed)
+    # Только локальный кэш: замер не меняет модель, и версия в хранилище не увеличивается
+    model.cache.clear()
+    model.starts = None
+    latencies = list()
+    for _ in range(sentences):
+        started = time.perf_counter()
+        window = model.generate_random_start_sequences(1)[0]
+        for _ in range(length):
+            distribution = model.storage.find_distributions([window]).get(window)
+            if distribution is None:
+                break
+            window = window[1:] + (distribution.return_weighted_random_word(),)
+        latencies.append(time.perf_counter() - started)
+    return percentiles(latencies)
+
+
+def compact(model, min_count=1, min_state_count=1, top_k=None, prune_tokens=True, dry_run=True,
+            sentences=100, length=20, batch_size=10000):
+    """
+    Сжатие модели: удаление редких переходов и состояний, лишних переходов сверх 'top_k',
+    слов, на которые больше не ссылается модель, и перестроение индексов
+
+    :param model: цепь Маркова
+    :type model: class markov_chain.MarkovChain
+    :param min_count: минимальная частота перехода
+    :type min_count: int
+    :param min_state_count: минимальная суммарная частота состояния
+    :type min_state_count: int
+    :param top_k: количество самых частых переходов состояния, None - без ограничения
+    :type top_k: int, optional
+    :param prune_tokens: удалять ли слова, не встречающиеся в модели
+    :type prune_tokens: bool
+    :param dry_run: только отчет, без изменения хранилища
+    :type dry_run: bool
+    :param sentences: количество предложений для замера задержки, 0 - без замера
+    :type sentences: int
+    :param length: количество слов в предложении для замера задержки
+    :type length: int
+    :param batch_size: количество состояний в одной записи
+    :type batch_size: int
+    :return: отчет об удаленных состояниях, переходах, словах, байтах и задержке генерации
+    :rtype: dict
+    """
+    storage = model.storage
+    end_symbol = storage.find_idxs(['end'])['end']
+    report = {'dry_run': dry_run, 'states': 0, 'states_removed': 0, 'transitions': 0, 'transitions_removed': 0,
+              'bytes': 0, 'bytes_removed': 0, 'tokens': 0, 'tokens_removed': 0}
+    referenced = {end_symbol}
+    deleted, replaced = list(), list()
+    # Изменения собираются до записи: хранилище не меняется во время перебора
+    for window, value in storage.iter_states():
+        start = model.is_start(window)
+        nbytes = storage.state_nbytes(window, value, start)
+        report['states'] += 1
+        report['transitions'] += len(value)
+        report['bytes'] += nbytes
+        pruned = prune_value(value, min_count, top_k)
+        if not pruned or sum(pruned.values()) < min_state_count:
+            deleted.append(window)
+            report['states_removed'] += 1
+            report['transitions_removed'] += len(value)
+            report['bytes_removed'] += nbytes
+            continue
+        referenced.update(window)
+        referenced.update(pruned)
+        if len(pruned) < len(value):
+            replaced.append((window, pruned, start))
+            report['transitions_removed'] += len(value) - len(pruned)
+            report['bytes_removed'] += nbytes - storage.state_nbytes(window, pruned, start)
+    unreferenced = list()
+    for idx, _ in storage.iter_tokens():
+        report['tokens'] += 1
+        if prune_tokens and idx not in referenced:
+            unreferenced.append(idx)
+    report['tokens_removed'] = len(unreferenced)
+
+    if sentences:
+        report['latency_before'] = measure_latency(model, sentences, length)
+    if dry_run:
+        return report
+
+    for i in range(0, len(deleted), batch_size):
+        storage.delete_states(deleted[i: i + batch_size])
+    for i in range(0, len(replaced), batch_size):
+        storage.replace_states(replaced[i: i + batch_size])
+    storage.delete_tokens(unreferenced)
+    storage.rebuild_indexes()
+    model.invalidate_cache()
+    if sentences:
+        report['latency_after'] = measure_latency(model, sentences, length)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сжатие модели: удаление редких переходов, состояний и слов')
+    parser.add_argument('--database', default='mydatabase', help='имя базы данных или sqlite:///путь')
+    parser.add_argument('--window-size', type=int, default=2)
+    parser.add_argument('--min-count', type=int, default=2, help='минимальная частота перехода')
+    parser.add_argument('--min-state-count', type=int, default=1, help='минимальная суммарная частота состояния')
+    parser.add_argument('--top-k', type=int, default=None, help='самые частые переходы состояния')
+    parser.add_argument('--keep-tokens', action='store_true', help='не удалять слова, отсутствующие в модели')
+    parser.add_argument('--apply', action='store_true', help='изменить хранилище, по умолчанию только отчет')
+    parser.add_argument('--sentences', type=int, default=100, help='предложения для замера задержки')
+    args = parser.parse_args()
+
+    model = MarkovChain(args.database, args.window_size, cache_size=0)
+    print('COMPACTING A MODEL' if args.apply else 'DRY RUN')
+    report = compact(model, args.min_count, args.min_state_count, args.top_k, not args.keep_tokens,
+                     not args.apply, args.sentences)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+import os
+import struct
+import sys
+from array import array
+from functools import partial
+from multiprocessing import Pool
+from read_files import read_token_chunks, file_digest
+
+MAGIC = b'MARKOVTK'
+VERSION = 1
+# magic, версия, количество слов текста, количество слов словаря, SHA-256 исходного текста
+HEADER = struct.Struct('<8sIQQ32s')
+
+
+class EncodedCorpus:
+    """
+    Подготовленный корпус: словарь, отсортированный как у 'Tokenizer.GenerateNewStrategy',
+    и текст в виде массива индексов. Не зависит от размера окна
+    """
+    def __init__(self, words, tokens, digest):
+        """
+
+        :param words: словарь 'idx -> word'
+        :type words: list
+        :param tokens: индексы слов текста
+        :type tokens: array.array
+        :param digest: шестнадцатеричный SHA-256 исходного текста
+        :type digest: str
+        """
+        self.words = words
+        self.tokens = tokens
+        self.digest = digest
+
+    @classmethod
+    def encode(cls, text_path, digest=None, chunk_size=1 << 20):
+        """
+        Построение словаря и кодирование текста за один проход.
+        Индексы выдаются в порядке появления слов и после прохода переводятся в порядок словаря
+
+        :param text_path: путь к тексту
+        :type text_path: str
+        :param digest: хэш текста, если уже посчитан
+        :type digest: str, optional
+        :param chunk_size: количество слов в порции чтения
+        :type chunk_size: int
+        :return: подготовленный корпус
+        :rtype: class corpus.EncodedCorpus
+        """
+        ids = dict()
+        tokens = array('I')
+        for chunk in read_token_chunks(text_path, chunk_size):
+            tokens.extend(ids.setdefault(word, len(ids)) for word in map(str.lower, chunk))
+        words = sorted(ids)
+        rank = array('I', bytes(4 * len(words)))
+        for idx, word in enumerate(words):
+            rank[ids[word]] = idx
+        del ids
+        tokens = array('I', map(rank.__getitem__, tokens))
+        return cls(words, tokens, digest or file_digest(text_path))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Загрузка артефактов корпуса
+
+        :param path: путь к артефактам без расширения
+        :type path: str
+        :return: подготовленный корпус или None, если артефакты отсутствуют или повреждены
+        :rtype: class corpus.EncodedCorpus
+        """
+        try:
+            with open(path + '.tokens', 'rb') as file:
+                magic, version, length, vocabulary_size, digest = HEADER.unpack(file.read(HEADER.size))
+                if magic != MAGIC or version != VERSION:
+                    return None
+                tokens = array('I')
+                tokens.fromfile(file, length)
+            with open(path + '.vocab', 'r', encoding='utf-8', newline='\n') as file:
+                text = file.read()
+            words = text.split('\n') if text else list()
+        except (OSError, EOFError, struct.error):
+            return None
+        if len(words) != vocabulary_size:
+            return None
+        if sys.byteorder != 'little':
+            tokens.byteswap()
+        return cls(words, tokens, digest.hex())
+
+    def save(self, path):
+        """
+        Запись артефактов корпуса: словарь по слову в строке и массив индексов с заголовком.
+        Массив записывается последним и переименовывается, поэтому прерванная запись не дает артефакта
+
+        :param path: путь к артефактам без расширения
+        :type path: str
+        """
+        with open(path + '.vocab.tmp', 'w', encoding='utf-8', newline='\n') as file:
+            file.write('\n'.join(self.words))
+        os.replace(path + '.vocab.tmp', path + '.vocab')
+        tokens = self.tokens
+        if sys.byteorder != 'little':
+            tokens = array('I', tokens)
+            tokens.byteswap()
+        with open(path + '.tokens.tmp', 'wb') as file:
+            file.write(HEADER.pack(MAGIC, VERSION, len(tokens), len(self.words), bytes.fromhex(self.digest)))
+            tokens.tofile(file)
+        os.replace(path + '.tokens.tmp', path + '.tokens')
+
+    def words_in_order(self):
+        """
+        Слова в порядке первого появления в тексте: в этом порядке
+        токенизатор из базы данных выдает индексы новым словам
+
+        :return: слова
+        :rtype: list
+        """
+        return [self.words[token] for token in dict.fromkeys(self.tokens)]
+
+    def translate(self, word2idx):
+        """
+        Перевод текста в индексы другого словаря, например токенизатора из базы данных
+
+        :param word2idx: индексы слов в другом словаре
+        :type word2idx: dict
+        :return: текст в индексах другого словаря
+        :rtype: array.array, list
+        """
+        idxs = [word2idx[word] for word in self.words]
+        if all(idx == i for i, idx in enumerate(idxs)):
+            return self.tokens
+        return [idxs[token] for token in self.tokens]
+
+
+def artifact_path(text_path, digest, cache_dir=None):
+    """
+    Путь к артефактам корпуса: имя текста и начало его хэша
+
+    :param text_path: путь к тексту
+    :type text_path: str
+    :param digest: хэш текста
+    :type digest: str
+    :param cache_dir: каталог артефактов, None - рядом с текстом
+    :type cache_dir: str, optional
+    :return: путь без расширения
+    :rtype: str
+    """
+    directory = cache_dir if cache_dir is not None else os.path.dirname(os.path.abspath(text_path))
+    return os.path.join(directory, '{}.{}'.format(os.path.basename(text_path), digest[:16]))
+
+
+def prepare_corpus(text_path, cache_dir=None):
+    """
+    Подготовленный корпус из кэша или кодирование текста с записью в кэш.
+    Измененный текст получает другой хэш и кодируется заново
+
+    :param text_path: путь к тексту
+    :type text_path: str
+    :param cache_dir: каталог артефактов, None - рядом с текстом
+    :type cache_dir: str, optional
+    :return: подготовленный корпус
+    :rtype: class corpus.EncodedCorpus
+    """
+    digest = file_digest(text_path)
+    path = artifact_path(text_path, digest, cache_dir)
+    corpus = EncodedCorpus.load(path)
+    if corpus is not None and corpus.digest == digest:
+        print('-USING AN ENCODED CORPUS')
+        return corpus
+    print('-ENCODING A CORPUS')
+    corpus = EncodedCorpus.encode(text_path, digest)
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+    corpus.save(path)
+    return corpus
+
+
+def prepare_corpora(paths, cache_dir=None, workers=1):
+    """
+    Подготовленные корпуса нескольких файлов, файлы без артефактов кодируются в пуле процессов.
+    Каждый файл - отдельный корпус со своим словарем, поэтому добавление файла не требует
+    повторного кодирования остальных
+
+    :param paths: пути к файлам
+    :type paths: list
+    :param cache_dir: каталог артефактов, None - рядом с текстами
+    :type cache_dir: str, optional
+    :param workers: количество процессов
+    :type workers: int
+    :return: подготовленные корпуса в порядке файлов
+    :rtype: list
+    """
+    if len(paths) == 1 or workers == 1:
+        return [prepare_corpus(path, cache_dir) for path in paths]
+    with Pool(workers) as pool:
+        return pool.map(partial(prepare_corpus, cache_dir=cache_dir), paths)
@@ -1,3 +1,6 @@
+import pymongo
+
+
 class Counter:
     """
     Счетчик индексов в базе данных
@@ -21,13 +24,14 @@ class Counter:
 
     def update(self, collection_name):
         """
-        Обновление поля 'last_id' для 'collection_name' в коллекции 'counter'
+        Обновление поля 'last_id' для 'collection_name' в коллекции 'counter'.
+        Счетчик не уменьшается: индексы, арендованные другими процессами, но еще не записанные, не выдаются повторно
 
         :param collection_name: имя коллекции
         :type collection_name: str
         """
         last_id = {'last_id': self.db[collection_name].find_one(sort=[('idx', -1)])['idx']}
-        self.db['counter'].update_one({'name': collection_name}, {'$set': last_id})
+        self.db['counter'].update_one({'name': collection_name}, {'$max': last_id})
 
     def increment(self, collection_name, increment_amount: int = 1):
         """
@@ -40,6 +44,38 @@ class Counter:
         """
         self.db['counter'].find_one_and_update({'name': collection_name}, {'$inc': {'last_id': increment_amount}})
 
+    def reserve(self, collection_name, amount):
+        """
+        Атомарное резервирование непрерывного диапазона из 'amount' индексов
+
+        :param collection_name: имя коллекции
+        :type collection_name: str
+        :param amount: количество индексов
+        :type amount: int
+        :return: первый индекс зарезервированного диапазона
+        :rtype: int
+        """
+        counter = self.db['counter'].find_one_and_update({'name': collection_name}, {'$inc': {'last_id': amount}},
+                                                         return_document=pymongo.ReturnDocument.AFTER)
+        return counter['last_id'] - amount + 1
+
+    def release(self, collection_name, first_id, last_id):
+        """
+        Возврат неиспользованного конца диапазона, если после него никто не резервировал индексы
+
+        :param collection_name: имя коллекции
+        :type collection_name: str
+        :param first_id: первый неиспользованный индекс
+        :type first_id: int
+        :param last_id: последний индекс диапазона
+        :type last_id: int
+        :return: возвращен ли диапазон
+        :rtype: bool
+        """
+        res = self.db['counter'].update_one({'name': collection_name, 'last_id': last_id},
+                                            {'$set': {'last_id': first_id - 1}})
+        return res.modified_count == 1
+
     def get(self, collection_name):
         """
         Получение 'last_id'
@@ -49,4 +85,53 @@ class Counter:
         :return: last_id
         :rtype: int
         """
-        return self.db['counter'].find_one({'name': collection_name})['last_id']
\ No newline at end of file
+        return self.db['counter'].find_one({'name': collection_name})['last_id']
+
+
+class IdLease:
+    """
+    Аренда индексов блоками: блок резервируется одним атомарным увеличением счетчика,
+    индексы выдаются из него локально. Процессы с разными арендами не получают одинаковых индексов.
+    Повторяет метод 'reserve' счетчика, поэтому передается вместо него
+    """
+    def __init__(self, counter, block_size=10000):
+        """
+
+        :param counter: счетчик
+        :type counter: class counter.Counter
+        :param block_size: количество индексов в одном блоке
+        :type block_size: int
+        """
+        self.counter = counter
+        self.block_size = block_size
+        # Свободная часть арендованного блока по коллекциям: [первый, последний]
+        self.blocks = dict()
+
+    def reserve(self, collection_name, amount):
+        """
+        Непрерывный диапазон из 'amount' индексов из арендованного блока.
+        Если в блоке не хватает индексов, арендуется новый, остаток старого не используется
+
+        :param collection_name: имя коллекции
+        :type collection_name: str
+        :param amount: количество индексов
+        :type amount: int
+        :return: первый индекс диапазона
+        :rtype: int
+        """
+        first_id, last_id = self.blocks.get(collection_name, (1, 0))
+        if last_id - first_id + 1 < amount:
+            size = max(self.block_size, amount)
+            first_id = self.counter.reserve(collection_name, size)
+            last_id = first_id + size - 1
+        self.blocks[collection_name] = (first_id + amount, last_id)
+        return first_id
+
+    def release(self):
+        """
+        Возврат неиспользованных остатков блоков, если после них счетчик не увеличивался
+        """
+        for collection_name, (first_id, last_id) in self.blocks.items():
+            if first_id <= last_id:
+                self.counter.release(collection_name, first_id, last_id)
+        self.blocks = dict()
@@ -1,4 +1,6 @@
 import random
+import sys
+from bisect import bisect_right
 
 
 class Dictogram(dict):
@@ -26,6 +28,41 @@ class Dictogram(dict):
                 self.types += 1
                 self.tokens += 1
 
+    def add_counts(self, counts):
+        """
+        Добавляем к распределению готовые частоты
+
+        :param counts: пары (слово, частота) или словарь частот
+        :type counts: iterable, dict
+        """
+        if isinstance(counts, dict):
+            counts = counts.items()
+        for item, amount in counts:
+            if item in self:
+                self[item] += amount
+            else:
+                self[item] = amount
+                self.types += 1
+            self.tokens += amount
+
+    @classmethod
+    def from_counts(cls, items, counts):
+        """
+        Построение распределения по уникальным словам и их частотам
+
+        :param items: уникальные слова
+        :type items: list
+        :param counts: частоты слов
+        :type counts: list
+        :return: распределение
+        :rtype: class dictogram.Dictogram
+        """
+        dictogram = cls.__new__(cls)
+        dict.__init__(dictogram, zip(items, counts))
+        dictogram.types = len(dictogram)
+        dictogram.tokens = sum(counts)
+        return dictogram
+
     def count(self, item):
         """
         Возвращаем значение счетчика элемента, или 0
@@ -66,4 +103,119 @@ class Dictogram(dict):
             # вывести индекс
             if index > random_int:
                 # вывести list_of_keys[i]
-                return list_of_keys[i]
\ No newline at end of file
+                return list_of_keys[i]
+
+    def freeze(self):
+        """
+        Построение неизменяемого распределения, оптимизированного для выборки
+
+        :return: замороженное распределение
+        :rtype: class dictogram.FrozenDictogram
+        """
+        return FrozenDictogram(self)
+
+
+class FrozenDictogram:
+    """
+    Неизменяемое распределение с накопленными частотами.
+    Строится один раз на состояние, выборка - бинарный поиск за O(log n)
+    """
+    __slots__ = ('words', 'cum_weights', 'types', 'tokens')
+
+    def __init__(self, counts):
+        """
+
+        :param counts: распределение {слово: частота}
+        :type counts: dict
+        """
+        self.words = tuple(counts.keys())
+        cum_weights = list()
+        total = 0
+        for weight in counts.values():
+            total += weight
+            cum_weights.append(total)
+        self.cum_weights = tuple(cum_weights)
+        self.types = len(self.words)  # число уникальных ключей в распределении
+        self.tokens = total  # общее количество всех слов в распределении
+
+    @classmethod
+    def from_cumulative(cls, words, cum_weights):
+        """
+        Построение по готовым накопленным частотам, без пересчета
+
+        :param words: слова
+        :type words: tuple
+        :param cum_weights: накопленные частоты слов
+        :type cum_weights: tuple
+        :return: распределение
+        :rtype: class dictogram.FrozenDictogram
+        """
+        frozen = cls.__new__(cls)
+        frozen.words = tuple(words)
+        frozen.cum_weights = tuple(cum_weights)
+        frozen.types = len(frozen.words)
+        frozen.tokens = frozen.cum_weights[-1] if frozen.cum_weights else 0
+        return frozen
+
+    def __len__(self):
+        return self.types
+
+    def __contains__(self, item):
+        return item in self.words
+
+    def count(self, item):
+        """
+        Возвращаем значение счетчика элемента, или 0
+
+        :param item: значение
+        :return: значение счетчика
+        :rtype: int
+        """
+        if item not in self.words:
+            return 0
+        i = self.words.index(item)
+        return self.cum_weights[i] - (self.cum_weights[i - 1] if i else 0)
+
+    def items(self):
+        """
+        Пары (слово, частота) в порядке построения
+
+        :return: пары (слово, частота)
+        :rtype: list
+        """
+        res = list()
+        previous = 0
+        for word, cum_weight in zip(self.words, self.cum_weights):
+            res.append((word, cum_weight - previous))
+            previous = cum_weight
+        return res
+
+    def nbytes(self):
+        """
+        Оценка занимаемой памяти
+
+        :return: размер в байтах
+        :rtype: int
+        """
+        size = sys.getsizeof(self) + sys.getsizeof(self.words) + sys.getsizeof(self.cum_weights)
+        return size + sum(sys.getsizeof(word) for word in self.words) + sum(map(sys.getsizeof, self.cum_weights))
+
+    def return_weighted_random_word(self):
+        """
+        Вернуть случайное слово с учетом частот
+
+        :return: случайное слово
+        :rtype: int
+        """
+        return self.words[bisect_right(self.cum_weights, random.randrange(self.tokens))]
+
+    def return_weighted_random_words(self, k):
+        """
+        Вернуть 'k' случайных слов с учетом частот за один вызов
+
+        :param k: количество слов
+        :type k: int
+        :return: случайные слова
+        :rtype: list
+        """
+        return random.choices(self.words, cum_weights=self.cum_weights, k=k)
@@ -0,0 +1,338 @@
+import random
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+
+
+def pack_key(window, base):
+    """
+    Упаковка окна индексов в одно число
+
+    :param window: окно
+    :type window: tuple
+    :param base: основание, больше любого индекса
+    :type base: int
+    :return: упакованный ключ
+    :rtype: int
+    """
+    key = 0
+    for idx in window:
+        key = key * base + idx
+    return key
+
+
+def unpack_key(key, base, window_size):
+    """
+    Распаковка числа в окно индексов
+
+    :param key: упакованный ключ
+    :type key: int
+    :param base: основание упаковки
+    :type base: int
+    :param window_size: размер окна
+    :type window_size: int
+    :return: окно
+    :rtype: tuple
+    """
+    window = list()
+    for _ in range(window_size):
+        key, idx = divmod(key, base)
+        window.append(idx)
+    return tuple(reversed(window))
+
+
+def typed_array(values):
+    """
+    Массив 64-битных чисел, если значения в него помещаются, иначе список
+
+    :param values: значения
+    :type values: list
+    :return: массив значений
+    :rtype: array.array, list
+    """
+    if not values or max(values) < 2 ** 63:
+        return array('q', values)
+    return list(values)
+
+
+def read_vocabulary(pairs):
+    """
+    Построение словаря токенизатора в виде списка 'idx -> word'
+
+    :param pairs: пары (индекс, слово)
+    :type pairs: iterable
+    :return: словарь
+    :rtype: list
+    """
+    pairs = list(pairs)
+    vocabulary = [None] * (max(idx for idx, _ in pairs) + 1 if pairs else 0)
+    for idx, word in pairs:
+        vocabulary[idx] = word
+    return vocabulary
+
+
+class FrozenModel:
+    """
+    Неизменяемая модель цепи Маркова в памяти, без базы данных.
+    Окна хранятся упакованными в отсортированном массиве, следующие слова - в общем массиве
+    со смещениями по состояниям (CSR), выборка - бинарный поиск по накопленным частотам
+    """
+    def __init__(self, keys, offsets, successors, cum_counts, window_size, base, end_symbol, vocabulary=None,
+                 start_states=None, start_cum_weights=None):
+        """
+
+        :param keys: отсортированные упакованные окна
+        :param offsets: смещения состояний в 'successors', длина на единицу больше 'keys'
+        :param successors: следующие слова всех состояний
+        :param cum_counts: накопленные частоты следующих слов внутри каждого состояния
+        :param window_size: размер окна
+        :type window_size: int
+        :param base: основание упаковки окон
+        :type base: int
+        :param end_symbol: индекс символа конца предложения
+        :type end_symbol: int
+        :param vocabulary: словарь 'idx -> word'
+        :type vocabulary: list, optional
+        :param start_states: номера состояний из индекса начал предложений
+        :param start_cum_weights: накопленные частоты начал, None - начала выбираются равновероятно
+        """
+        self.keys = keys
+        self.offsets = offsets
+        self.successors = successors
+        self.cum_counts = cum_counts
+        self.window_size = window_size
+        self.base = base
+        self.end_symbol = end_symbol
+        self.vocabulary = vocabulary
+        # Начала предложений - состояния, окно которых начинается с символа конца
+        first = bisect_left(keys, end_symbol * base ** (window_size - 1))
+        last = bisect_left(keys, (end_symbol + 1) * base ** (window_size - 1))
+        self.starts = range(first, last)
+        self.start_states = start_states
+        self.start_cum_weights = start_cum_weights
+
+    @classmethod
+    def from_model(cls, markov_model, window_size, end_symbol, vocabulary=None):
+        """
+        Построение из модели, полученной 'MarkovChain.create_model_from_text'
+
+        :param markov_model: модель цепи Маркова
+        :type markov_model: dict
+        :param window_size: размер окна
+        :type window_size: int
+        :param end_symbol: индекс символа конца предложения
+        :type end_symbol: int
+        :param vocabulary: словарь 'idx -> word'
+        :type vocabulary: list, optional
+        :return: замороженная модель
+        :rtype: class frozen_model.FrozenModel
+        """
+        return cls.from_items(markov_model.items(), window_size, end_symbol, vocabulary)
+
+    @classmethod
+    def from_storage(cls, storage, window_size):
+        """
+        Построение из модели и словаря в хранилище. Загружаются только окна размера 'window_size':
+        замороженная модель не откатывается к более коротким окнам, окна других порядков
+        модели, обученной с 'min_window_size', пропускаются
+
+        :param storage: хранилище
+        :type storage: class storage.Storage
+        :param window_size: размер окна
+        :type window_size: int
+        :return: замороженная модель
+        :rtype: class frozen_model.FrozenModel
+        """
+        vocabulary = read_vocabulary(storage.iter_tokens())
+        items, skipped = list(), 0
+        for window, value in storage.iter_states():
+            if len(window) == window_size:
+                items.append((window, value))
+            else:
+                skipped += 1
+        if skipped:
+            print('-SKIPPING {} STATES OF OTHER WINDOW SIZES, NO BACK-OFF'.format(skipped))
+        model = cls.from_items(items, window_size, vocabulary.index('end'), vocabulary)
+        start_states, start_cum_weights = array('q'), array('q')
+        total = 0
+        for window, count in storage.iter_starts():
+            state = model.find(window)
+            if state >= 0:
+                total += count
+                start_states.append(state)
+                start_cum_weights.append(total)
+        if start_states:
+            model.start_states, model.start_cum_weights = start_states, start_cum_weights
+        return model
+
+    @classmethod
+    def from_items(cls, items, window_size, end_symbol, vocabulary=None):
+        """
+        Построение из пар (окно, распределение)
+
+        :param items: пары (окно, {слово: частота})
+        :type items: iterable
+        :param window_size: размер окна
+        :type window_size: int
+        :param end_symbol: индекс символа конца предложения
+        :type end_symbol: int
+        :param vocabulary: словарь 'idx -> word'
+        :type vocabulary: list, optional
+        :return: замороженная модель
+        :rtype: class frozen_model.FrozenModel
+        """
+        items = list(items)
+        base = 1 + max([end_symbol] + [max(max(window), max(value)) for window, value in items])
+        rows = sorted((pack_key(window, base), value) for window, value in items)
+        del items
+        keys, offsets, successors, cum_counts = list(), [0], array('q'), array('q')
+        for key, value in rows:
+            keys.append(key)
+            total = 0
+            for successor, count in value.items():
+                total += count
+                successors.append(successor)
+                cum_counts.append(total)
+            offsets.append(len(successors))
+        return cls(typed_array(keys), array('q', offsets), successors, cum_counts,
+                   window_size, base, end_symbol, vocabulary)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def find(self, window):
+        """
+        Поиск номера состояния по окну
+
+        :param window: окно
+        :type window: tuple
+        :return: номер состояния или -1
+        :rtype: int
+        """
+        if max(window) >= self.base:
+            return -1
+        key = pack_key(window, self.base)
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return i
+        return -1
+
+    def sample_state(self, state):
+        """
+        Выбор следующего слова для состояния с учетом частот
+
+        :param state: номер состояния
+        :type state: int
+        :return: следующее слово
+        :rtype: int
+        """
+        start, end = self.offsets[state], self.offsets[state + 1]
+        r = random.randrange(self.cum_counts[end - 1])
+        return self.successors[bisect_right(self.cum_counts, r, start, end)]
+
+    def sample(self, window):
+        """
+        Выбор следующего слова для окна с учетом частот
+
+        :param window: окно
+        :type window: tuple
+        :return: следующее слово
+        :rtype: int
+        """
+        state = self.find(window)
+        if state < 0:
+            raise KeyError(window)
+        return self.sample_state(state)
+
+    def generate_random_start_sequence(self):
+        """
+        Генерация начала предложения
+
+        :return: окно начала предложения
+        :rtype: tuple
+        """
+        if self.start_cum_weights:
+            r = random.randrange(self.start_cum_weights[-1])
+            state = self.start_states[bisect_right(self.start_cum_weights, r)]
+        elif self.starts:
+            state = random.choice(self.starts)
+        else:
+            raise ValueError('model has no sentence starts: no window begins with the end symbol')
+        window = unpack_key(self.keys[state], self.base, self.window_size)
+        return window[1:] + (self.sample_state(state),)
+
+    def generate_random_sentence(self, length, start_sequence):
+        """
+        Генерация предложения
+
+        :param length: количестов слов в предложение
+        :type length: int
+        :param start_sequence: окно начала предложения
+        :type start_sequence: tuple
+        :return: предложение
+        :rtype: list
+        """
+        window = tuple(start_sequence)
+        sentence = list(window)
+        for _ in range(length):
+            state = self.find(window)
+            if state < 0:
+                # Тупик - продолжаем с нового начала предложения, как 'MarkovChain.generate_random_sentence'
+                window = self.generate_random_start_sequence()
+                sentence.extend(window)
+            else:
+                window = window[1:] + (self.sample_state(state),)
+                sentence.append(window[-1])
+        return sentence
+
+    def generate(self, length):
+        """
+        Генерация предложения
+
+        :param length: количество слов в тексте
+        :type length: int
+        :return: сгенерированное предложение, или индексы слов без словаря
+        :rtype: str, list
+        """
+        sentence = self.generate_random_sentence(length, self.generate_random_start_sequence())
+        sentence = [word for word in sentence if word != self.end_symbol]
+        if self.vocabulary is None:
+            return sentence
+        return ' '.join(self.vocabulary[word] for word in sentence)
+
+    def generate_batch(self, count, length):
+        """
+        Генерация нескольких предложений
+
+        :param count: количество предложений
+        :type count: int
+        :param length: количество слов в предложении
+        :type length: int
+        :return: сгенерированные предложения
+        :rtype: list
+        """
+        return [self.generate(length) for _ in range(count)]
+
+    def nbytes(self):
+        """
+        Размер массивов модели в памяти
+
+        :return: размер в байтах
+        :rtype: int
+        """
+        size = 0
+        for values in (self.keys, self.offsets, self.successors, self.cum_counts):
+            if isinstance(values, (array, memoryview)):
+                size += values.itemsize * len(values)
+            else:
+                size += sys.getsizeof(values) + sum(map(sys.getsizeof, values))
+        return size
+
+    def bytes_per_million_states(self):
+        """
+        Размер модели в пересчете на миллион состояний
+
+        :return: размер в байтах
+        :rtype: float
+        """
+        return self.nbytes() * 1e6 / max(len(self.keys), 1)
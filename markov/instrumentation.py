@@ -0,0 +1,246 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from pymongo import monitoring
+
+
+class Progress:
+    """
+    Вывод прогресса не чаще одного раза в 'interval' секунд
+    """
+    def __init__(self, name, total=None, interval=1.0, verbose=False):
+        """
+
+        :param name: название операции
+        :type name: str
+        :param total: общее количество элементов
+        :type total: int, optional
+        :param interval: минимальный интервал между выводами в секундах
+        :type interval: float
+        :param verbose: выводить ли прогресс
+        :type verbose: bool
+        """
+        self.name = name
+        self.total = total
+        self.interval = interval
+        self.verbose = verbose
+        self.started = time.monotonic()
+        self.last = self.started
+
+    def update(self, done):
+        """
+        Сообщение о количестве обработанных элементов
+
+        :param done: количество обработанных элементов
+        :type done: int
+        """
+        if not self.verbose:
+            return
+        now = time.monotonic()
+        if now - self.last < self.interval and done != self.total:
+            return
+        self.last = now
+        rate = done / max(now - self.started, 1e-9)
+        if self.total is None:
+            print('{}: {} ({:.0f}/s)'.format(self.name, done, rate))
+        else:
+            print('{}: {}/{} ({:.0f}/s)'.format(self.name, done, self.total, rate))
+
+
+class CommandCounter(monitoring.CommandListener):
+    """
+    Подсчет запросов к MongoDB, документов и задержек по этапам
+    """
+    def __init__(self, instrumentation):
+        """
+
+        :param instrumentation: инструментирование, этапы которого учитываются
+        :type instrumentation: class instrumentation.Instrumentation
+        """
+        self.instrumentation = instrumentation
+
+    @staticmethod
+    def count_documents(reply):
+        """
+        Количество документов в ответе на команду
+
+        :param reply: ответ сервера
+        :type reply: dict
+        :return: количество документов
+        :rtype: int
+        """
+        if 'cursor' in reply:
+            cursor = reply['cursor']
+            return len(cursor.get('firstBatch', cursor.get('nextBatch', [])))
+        if 'n' in reply:
+            return reply['n'] + len(reply.get('upserted', []))
+        return 1 if reply.get('value') is not None else 0
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.instrumentation.record_command(event.command_name, event.duration_micros,
+                                            self.count_documents(event.reply))
+
+    def failed(self, event):
+        self.instrumentation.record_command(event.command_name, event.duration_micros, 0, failed=True)
+
+
+class Instrumentation:
+    """
+    Таймеры этапов, счетчики запросов к базе данных и прогресс.
+    По умолчанию ничего не выводит, итог доступен через 'summary'.
+    Текущий этап свой у каждого потока: запросы из потоков записи и пула сервиса
+    относятся к этапу потока, который их выполняет, см. 'bind'
+    """
+    def __init__(self, verbose=False, progress_interval=1.0, report_path=None):
+        """
+
+        :param verbose: выводить ли прогресс и итог
+        :type verbose: bool
+        :param progress_interval: минимальный интервал между выводами прогресса в секундах
+        :type progress_interval: float
+        :param report_path: путь к JSON-файлу для итога
+        :type report_path: str, optional
+        """
+        self.verbose = verbose
+        self.progress_interval = progress_interval
+        self.report_path = report_path
+        self.stages = dict()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.listener = CommandCounter(self)
+
+    def current_stage(self):
+        """
+        Этап, выполняемый текущим потоком
+
+        :rtype: str
+        """
+        return getattr(self.local, 'stage', 'other')
+
+    def register(self):
+        """
+        Глобальная регистрация счетчика запросов для всех новых клиентов MongoDB
+        """
+        monitoring.register(self.listener)
+
+    def stage_stats(self, name):
+        """
+        Статистика этапа, создается при первом обращении
+
+        :param name: название этапа
+        :type name: str
+        :return: статистика этапа
+        :rtype: dict
+        """
+        with self.lock:
+            if name not in self.stages:
+                self.stages[name] = {'calls': 0, 'wall': 0.0, 'cpu': 0.0,
+                                     'queries': 0, 'documents': 0, 'db_latency': 0.0, 'failed': 0, 'commands': dict()}
+            return self.stages[name]
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Замер времени этапа, запросы к базе данных внутри относятся к этому этапу
+
+        :param name: название этапа
+        :type name: str
+        """
+        stats = self.stage_stats(name)
+        previous = self.current_stage()
+        self.local.stage = name
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield stats
+        finally:
+            with self.lock:
+                stats['calls'] += 1
+                stats['wall'] += time.perf_counter() - wall
+                stats['cpu'] += time.process_time() - cpu
+            self.local.stage = previous
+
+    def bind(self, function):
+        """
+        Привязка функции к этапу вызывающего потока: запросы, выполненные функцией
+        в другом потоке (пул потоков записи), учитываются в этом этапе
+
+        :param function: функция
+        :type function: callable
+        :return: функция, выполняемая в этапе вызывающего потока
+        :rtype: callable
+        """
+        name = self.current_stage()
+
+        def bound(*args, **kwargs):
+            previous = self.current_stage()
+            self.local.stage = name
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.local.stage = previous
+
+        return bound
+
+    def record_command(self, command_name, duration_micros, documents, failed=False):
+        """
+        Учет выполненной команды MongoDB в текущем этапе потока, выполнившего команду
+
+        :param command_name: имя команды
+        :type command_name: str
+        :param duration_micros: длительность в микросекундах
+        :type duration_micros: int
+        :param documents: количество документов
+        :type documents: int
+        :param failed: завершилась ли команда ошибкой
+        :type failed: bool
+        """
+        stats = self.stage_stats(self.current_stage())
+        with self.lock:
+            stats['queries'] += 1
+            stats['documents'] += documents
+            stats['db_latency'] += duration_micros / 1e6
+            stats['failed'] += failed
+            stats['commands'][command_name] = stats['commands'].get(command_name, 0) + 1
+
+    def progress(self, name, total=None):
+        """
+        Создание вывода прогресса с настройками инструментирования
+
+        :param name: название операции
+        :type name: str
+        :param total: общее количество элементов
+        :type total: int, optional
+        :return: прогресс
+        :rtype: class instrumentation.Progress
+        """
+        return Progress(name, total, self.progress_interval, self.verbose)
+
+    def summary(self):
+        """
+        Итог по всем этапам
+
+        :return: статистика этапов
+        :rtype: dict
+        """
+        return {'stages': self.stages}
+
+    def finish(self):
+        """
+        Завершение запуска: запись итога в 'report_path' и вывод при 'verbose'
+
+        :return: итог
+        :rtype: dict
+        """
+        summary = self.summary()
+        if self.report_path is not None:
+            with open(self.report_path, 'w', encoding='utf-8') as file:
+                json.dump(summary, file, indent=2, ensure_ascii=False)
+        if self.verbose:
+            for name, stats in self.stages.items():
+                print('{}: wall {:.3f}s, cpu {:.3f}s, {} queries, {} documents, db {:.3f}s'.format(
+                    name, stats['wall'], stats['cpu'], stats['queries'], stats['documents'], stats['db_latency']))
+        return summary
@@ -1,5 +1,11 @@
 from tokenizer import Tokenizer
 from markov_chain import MarkovChain
+from corpus import prepare_corpora
+from read_files import expand_paths
+from spill import SpillingModel
+
+# Наибольшая порция чтения текста при обучении с бюджетом памяти, в словах
+SPILL_CHUNK_SIZE = 1000000
 
 
 class MarkovGenerator:
@@ -10,89 +16,263 @@ class MarkovGenerator:
         """
         Базовая стратегия генератора
         """
-        def __init__(self, database, text_path, window_size):
+        def __init__(self, database, text_path, window_size, engine='python', chunk_size=None, workers=1,
+                     instrumentation=None, writers=1, min_window_size=None, corpus_cache=None, memory_budget=None):
             """
 
-            :param text_path: путь к датасету
-            :type text_path: str
+            :param text_path: путь к датасету, каталог, шаблон glob или список файлов, в том числе gz, bz2, xz
+            :type text_path: str, list
             :param window_size: размер окна
             :type window_size: int
+            :param engine: способ подсчета переходов: 'python', 'numpy' или 'packed'
+            :type engine: str
+            :param chunk_size: количество слов в порции при потоковом чтении, None - чтение целиком
+            :type chunk_size: int
+            :param workers: количество процессов для подсчета переходов и чтения файлов
+            :type workers: int
+            :param instrumentation: таймеры этапов и счетчики запросов
+            :type instrumentation: class instrumentation.Instrumentation, optional
+            :param writers: количество потоков записи модели
+            :type writers: int
+            :param min_window_size: наименьший размер окна: обучаются все размеры до 'window_size' за один проход
+            :type min_window_size: int, optional
+            :param corpus_cache: каталог подготовленных корпусов; повторное обучение тем же текстом
+                читает закодированный массив вместо текста, None - текст кодируется при каждом запуске
+            :type corpus_cache: str, optional
+            :param memory_budget: бюджет памяти модели в байтах, сверх него состояния сбрасываются на диск
+                и сливаются при записи; текст читается порциями, размер порции ограничен бюджетом
+            :type memory_budget: int, optional
             """
-            self.model = MarkovChain(database, window_size)
+            # Обучение не читает состояния - кэш не нужен
+            self.model = MarkovChain(database, window_size, cache_size=0, instrumentation=instrumentation,
+                                     writers=writers, min_window_size=min_window_size, memory_budget=memory_budget)
             self.text_path = text_path
+            self.engine = engine
+            if memory_budget:
+                # Текст целиком не читается, прирост модели за порцию не больше половины бюджета
+                chunk_size = min(chunk_size or SPILL_CHUNK_SIZE, self.model.budget_chunk_size())
+            self.chunk_size = chunk_size
+            self.workers = workers
+            self.corpus_cache = corpus_cache
+            self.corpora = None
+
+        def build_model(self, extend_vocabulary=False):
+            """
+            Построение модели по датасету целиком или порциями
+
+            :param extend_vocabulary: добавлять новые слова в токенизатор при кодировании
+            :type extend_vocabulary: bool
+            :return: модель цепи Маркова
+            :rtype: dict
+            """
+            paths = expand_paths(self.text_path)
+            if self.corpus_cache is not None:
+                if self.corpora is None:
+                    with self.model.instrumentation.stage('read'):
+                        self.corpora = prepare_corpora(paths, self.corpus_cache, self.workers)
+                return self.model.create_model_from_corpora(self.corpora, self.engine, self.workers, extend_vocabulary)
+            if self.chunk_size:
+                # Файлы читаются по очереди порциями в одну модель, бюджет памяти общий
+                model = None
+                for path in paths:
+                    model = self.model.create_model_from_stream(path, self.chunk_size, self.engine, self.workers,
+                                                                extend_vocabulary, model)
+                return model
+            if len(paths) > 1:
+                return self.model.create_model_from_files(paths, self.engine, self.workers, extend_vocabulary)
+            return self.model.create_model_from_text(paths[0], self.engine, self.workers, extend_vocabulary)
 
     class TrainStrategy(Strategy):
         """
         Стратегия для первичного запуска цепи Маркова
         """
-        def __init__(self, database, text_path, window_size):
+        def __init__(self, database, text_path, window_size, engine='python', chunk_size=None, workers=1,
+                     instrumentation=None, writers=1, min_window_size=None, corpus_cache=None, memory_budget=None):
             """
 
-            :param text_path: путь к датасету
-            :type text_path: str
+            :param text_path: путь к датасету, каталог, шаблон glob или список файлов, в том числе gz, bz2, xz
+            :type text_path: str, list
             :param window_size: размер окна
             :type window_size: int
+            :param engine: способ подсчета переходов: 'python', 'numpy' или 'packed'
+            :type engine: str
+            :param chunk_size: количество слов в порции при потоковом чтении, None - чтение целиком
+            :type chunk_size: int
+            :param workers: количество процессов для подсчета переходов и чтения файлов
+            :type workers: int
+            :param instrumentation: таймеры этапов и счетчики запросов
+            :type instrumentation: class instrumentation.Instrumentation, optional
+            :param writers: количество потоков записи модели
+            :type writers: int
+            :param min_window_size: наименьший размер окна: обучаются все размеры до 'window_size' за один проход
+            :type min_window_size: int, optional
+            :param corpus_cache: каталог подготовленных корпусов; повторное обучение тем же текстом
+                читает закодированный массив вместо текста, None - текст кодируется при каждом запуске
+            :type corpus_cache: str, optional
+            :param memory_budget: бюджет памяти модели в байтах, сверх него состояния сбрасываются на диск
+                и сливаются при записи; текст читается порциями, размер порции ограничен бюджетом
+            :type memory_budget: int, optional
             """
-            super().__init__(database, text_path, window_size)
-            self.tokenizer = Tokenizer(Tokenizer.GenerateNewStrategy(self.text_path))
+            super().__init__(database, text_path, window_size, engine, chunk_size, workers, instrumentation, writers,
+                             min_window_size, corpus_cache, memory_budget)
+            with self.model.instrumentation.stage('vocabulary'):
+                if corpus_cache is not None:
+                    # Словарь и закодированный текст строятся за один проход или берутся из кэша
+                    self.corpora = prepare_corpora(expand_paths(self.text_path), corpus_cache, self.workers)
+                    words = sorted(set().union(*(corpus.words for corpus in self.corpora)))
+                    self.tokenizer = Tokenizer(Tokenizer.CorpusStrategy(words))
+                else:
+                    self.tokenizer = Tokenizer(Tokenizer.GenerateNewStrategy(self.text_path, self.chunk_size,
+                                                                             self.workers))
             self.model.set_tokenizer(self.tokenizer)
             self.model.counter.initialize('tokens')
             self.train()
             self.model.counter.update('tokens')
+            self.model.instrumentation.finish()
 
         def train(self):
             """
             Запуск первичнго обучения цепи Маркова
             """
             print('SAVING A TOKENIZER')
-            self.model.tokenizer.save(self.model.tokens)
+            with self.model.instrumentation.stage('save tokenizer'):
+                self.model.tokenizer.save(self.model.storage)
             print('BUILDING A MODEL')
-            model = self.model.create_model_from_text(self.text_path)
+            model = self.build_model()
             print('SAVING A MODEL')
-            self.model.save(model)
+            try:
+                self.model.save(model)
+            finally:
+                if isinstance(model, SpillingModel):
+                    model.close()
 
     class RetrainStrategy(Strategy):
         """
-        Стратегия дообучения цепи Маркова
+        Стратегия дообучения цепи Маркова.
+        Дообучение идентифицируется хэшем текста: повторный запуск с тем же текстом продолжает
+        прерванное дообучение. Если дообучение этим текстом уже применено, запуск завершается
+        ошибкой ValueError и модель не изменяется - раньше частоты текста прибавлялись еще раз.
+        Чтобы учесть текст еще раз (например, увеличить его вес), нужен 'force=True'
         """
-        def __init__(self, database, text_path, window_size):
+        def __init__(self, database, text_path, window_size, engine='python', chunk_size=None, workers=1,
+                     instrumentation=None, writers=1, min_window_size=None, corpus_cache=None, memory_budget=None,
+                     force=False):
             """
 
-            :param text_path: путь к датасету
-            :type text_path: str
+            :param text_path: путь к датасету, каталог, шаблон glob или список файлов, в том числе gz, bz2, xz
+            :type text_path: str, list
             :param window_size: размер окна
             :type window_size: int
+            :param engine: способ подсчета переходов: 'python', 'numpy' или 'packed'
+            :type engine: str
+            :param chunk_size: количество слов в порции при потоковом чтении, None - чтение целиком
+            :type chunk_size: int
+            :param workers: количество процессов для подсчета переходов и чтения файлов
+            :type workers: int
+            :param instrumentation: таймеры этапов и счетчики запросов
+            :type instrumentation: class instrumentation.Instrumentation, optional
+            :param writers: количество потоков записи модели
+            :type writers: int
+            :param min_window_size: наименьший размер окна: обучаются все размеры до 'window_size' за один проход
+            :type min_window_size: int, optional
+            :param corpus_cache: каталог подготовленных корпусов; повторное обучение тем же текстом
+                читает закодированный массив вместо текста, None - текст кодируется при каждом запуске
+            :type corpus_cache: str, optional
+            :param memory_budget: бюджет памяти модели в байтах, сверх него состояния сбрасываются на диск
+                и сливаются при записи; текст читается порциями, размер порции ограничен бюджетом
+            :type memory_budget: int, optional
+            :param force: дообучить текстом, даже если дообучение им уже применено: текст учитывается еще раз.
+                Прерванное повторение продолжается следующим запуском, а не начинается заново
+            :type force: bool
             """
-            super().__init__(database, text_path, window_size)
-            self.tokenizer = Tokenizer(Tokenizer.LoadStrategy(self.model.tokens))
+            super().__init__(database, text_path, window_size, engine, chunk_size, workers, instrumentation, writers,
+                             min_window_size, corpus_cache, memory_budget)
+            self.force = force
+            self.tokenizer = Tokenizer(Tokenizer.CachingLoadStrategy(self.model.storage))
             self.model.set_tokenizer(self.tokenizer)
             self.model.counter.update('tokens')
             self.retrain()
+            self.model.instrumentation.finish()
 
         def retrain(self):
             """
-            Запуск дообучения цепи Маркова
+            Запуск дообучения цепи Маркова: текст читается один раз, новые слова добавляются
+            в токенизатор при кодировании, дообучение записывается в журнал и применяется к модели
+
+            :raises ValueError: дообучение этим текстом уже применено, а 'force' не задан
             """
-            print('SAVING A TOKENIZER')
-            self.model.tokenizer.strategy.update_from_text(self.text_path, self.model.counter)
-            print('BUILDING A MODEL')
-            model = self.model.create_model_from_text(self.text_path)
-            print('SAVING A MODEL')
-            self.model.save(model)
+            text_id = delta_id = self.model.delta_id(self.text_path)
+            entry = self.model.storage.find_delta(delta_id)
+            repeat = 0
+            while self.force and entry is not None and entry['applied']:
+                # Повторение того же текста - первое еще не примененное
+                repeat += 1
+                delta_id = '{}-repeat{}'.format(text_id, repeat)
+                entry = self.model.storage.find_delta(delta_id)
+            if entry is not None and entry['applied']:
+                raise ValueError('retrain {} is already applied: the same text is counted once, '
+                                 'use force=True to count it again'.format(delta_id))
+            model = None
+            if entry is None:
+                print('BUILDING A MODEL')
+                try:
+                    model = self.build_model(extend_vocabulary=True)
+                finally:
+                    self.model.lease.release()
+            try:
+                if entry is None:
+                    print('SAVING A DELTA')
+                    source = self.text_path if type(self.text_path) == str else ' '.join(self.text_path)
+                    self.model.log_delta(delta_id, source, model)
+                print('SAVING A MODEL')
+                self.model.apply_delta(delta_id, model)
+            finally:
+                if isinstance(model, SpillingModel):
+                    model.close()
 
     class GenerateStrategy:
         """
         Стратегия генерации текста
         """
-        def __init__(self, database, window_size):
+        def __init__(self, database, window_size, cache_size=100000, cache_bytes=None, warm_up=0,
+                     instrumentation=None, min_window_size=None):
             """
 
             :param window_size:
             :type window_size: int
+            :param cache_size: максимальное количество состояний в кэше
+            :type cache_size: int
+            :param cache_bytes: максимальный размер кэша состояний в байтах
+            :type cache_bytes: int
+            :param warm_up: количество самых частых состояний, загружаемых в кэш при запуске
+            :type warm_up: int
+            :param instrumentation: таймеры этапов и счетчики запросов
+            :type instrumentation: class instrumentation.Instrumentation, optional
+            :param min_window_size: наименьший размер окна для back-off, если модель обучена с несколькими размерами
+            :type min_window_size: int, optional
             """
-            self.model = MarkovChain(database, window_size)
-            self.tokenizer = Tokenizer(Tokenizer.LoadStrategy(self.model.tokens))
+            self.model = MarkovChain(database, window_size, cache_size=cache_size, cache_bytes=cache_bytes,
+                                     instrumentation=instrumentation, min_window_size=min_window_size)
+            self.tokenizer = Tokenizer(Tokenizer.CachingLoadStrategy(self.model.storage))
             self.model.set_tokenizer(self.tokenizer)
+            if warm_up:
+                print('WARMING UP A CACHE')
+                with self.model.instrumentation.stage('warm up'):
+                    self.model.warm_up(warm_up)
+
+    class OfflineStrategy:
+        """
+        Стратегия генерации текста по модели в памяти, без базы данных
+        """
+        def __init__(self, model):
+            """
+
+            :param model: замороженная модель, например 'MarkovChain.freeze()'
+            :type model: class frozen_model.FrozenModel
+            """
+            self.model = model
+            print('MODEL SIZE: {} states, {:.0f} bytes per million states'.format(
+                len(model), model.bytes_per_million_states()))
 
     def __init__(self, strategy):
         """
@@ -113,7 +293,7 @@ class MarkovGenerator:
         """
         return self.strategy.model.generate(size_sent)
 
-    def generate_sentences(self, count, size_sent):
+    def generate_sentences(self, count, size_sent, batched=False):
         """
         Генерация нескольких предложений
 
@@ -121,9 +301,15 @@ class MarkovGenerator:
         :type count: int
         :param size_sent: количесвто слов в предложение
         :type size_sent: int
+        :param batched: генерировать все предложения одновременно, один запрос к базе данных на шаг
+        :type batched: bool
         :return: сгенерированные предложения
         :rtype: list
         """
+        if batched:
+            res = [sentence + '\n' * 3 for sentence in self.strategy.model.generate_batch(count, size_sent)]
+            self.finish()
+            return res
         res = []
         for _ in range(count):
             try:
@@ -131,8 +317,17 @@ class MarkovGenerator:
                 res.append(sentence)
             except KeyboardInterrupt:
                 break
+        self.finish()
         return res
 
+    def finish(self):
+        """
+        Завершение запуска генерации: запись и вывод итога инструментирования
+        """
+        instrumentation = getattr(self.strategy.model, 'instrumentation', None)
+        if instrumentation is not None:
+            instrumentation.finish()
+
 
 def main():
     text_path = 'texts/corpus_100.txt'
@@ -1,28 +1,91 @@
-import pymongo
-from counter import Counter
-from dictogram import Dictogram
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from multiprocessing import Pool
+from bisect import bisect_right
+from operator import itemgetter
+from cache import LRUCache
+from counter import IdLease
+from dictogram import FrozenDictogram
+from frozen_model import FrozenModel
+from instrumentation import Instrumentation
 from tokenizer import Tokenizer
-from read_files import read_files
+from read_files import read_files, read_token_chunks, file_digest
+from packed_model import PackedModel, count_transitions_packed
+from spill import SpillingModel, STATE_BYTES, TRANSITION_BYTES
+from storage import Storage, MongoStorage, SQLiteStorage
+from training import count_transitions, count_transitions_multi, count_transitions_numpy, count_transitions_parallel, \
+    merge_models, count_file, translate_model
 
 
 class MarkovChain:
     """
     Цепь Маркова
     """
-    def __init__(self, database, window_size):
+    def __init__(self, database, window_size, cache_size=100000, cache_bytes=None, instrumentation=None,
+                 writers=1, save_batch_size=100000, write_concern=None, min_window_size=None, lease_size=10000,
+                 memory_budget=None, version_interval=1.0):
+        """
+
+        :param database: хранилище, имя базы данных MongoDB, база данных pymongo
+            или 'sqlite:///путь' для встроенного хранилища SQLite
+        :param window_size: размер окна
+        :type window_size: int
+        :param cache_size: максимальное количество состояний в кэше, 0 - кэш отключен
+        :type cache_size: int
+        :param cache_bytes: максимальный размер кэша состояний в байтах
+        :type cache_bytes: int
+        :param instrumentation: таймеры этапов и счетчики запросов; для готовой базы данных
+            счетчик запросов нужно зарегистрировать до создания клиента ('Instrumentation.register')
+        :type instrumentation: class instrumentation.Instrumentation, optional
+        :param writers: количество потоков записи модели
+        :type writers: int
+        :param save_batch_size: количество состояний в одном пакете записи
+        :type save_batch_size: int
+        :param write_concern: подтверждение записи для нового клиента MongoDB, например 1, 0 или 'majority'
+        :type write_concern: int, str, optional
+        :param min_window_size: наименьший размер окна при обучении: модель хранит окна всех размеров
+            от 'min_window_size' до 'window_size', None - только 'window_size'
+        :type min_window_size: int, optional
+        :param lease_size: количество индексов новых слов, арендуемых у счетчика за раз при дообучении
+        :type lease_size: int
+        :param memory_budget: бюджет памяти модели при обучении в байтах, сверх него состояния
+            сбрасываются на диск; None - модель целиком в памяти
+        :type memory_budget: int, optional
+        :param version_interval: как часто генерация проверяет версию модели в хранилище, в секундах.
+            Дообучение и сжатие в другом процессе увеличивают версию, и кэш генератора сбрасывается
+            при следующей проверке; None - не проверять
+        :type version_interval: float, optional
+        """
         self.window_size = window_size
+        self.orders = range(min_window_size or window_size, window_size + 1)
+        self.writers = writers
+        self.save_batch_size = save_batch_size
+        self.memory_budget = memory_budget
+        self.instrumentation = instrumentation if instrumentation is not None else Instrumentation()
 
         print('CONNECTING TO A DB')
-        if type(database) == str:
-            client = pymongo.MongoClient("mongodb://localhost:27017/")
-            self.db = client[database]
+        if isinstance(database, Storage):
+            self.storage = database
+        elif type(database) == str and database.startswith('sqlite:///'):
+            self.storage = SQLiteStorage(database[len('sqlite:///'):])
         else:
-            self.db = database
+            self.storage = MongoStorage(database, event_listeners=[self.instrumentation.listener],
+                                        write_concern=write_concern)
 
-        self.model = self.db['model']
-        self.tokens = self.db['tokens']
-
-        self.counter = Counter(self.db)
+        self.counter = self.storage.counter
+        # Несколько процессов дообучения с одной базой получают индексы новых слов из разных блоков
+        self.lease = IdLease(self.counter, lease_size)
+        self.cache = LRUCache(cache_size, cache_bytes, sizeof=FrozenDictogram.nbytes)
+        self.version_interval = version_interval
+        # Версия модели, которой соответствует кэш, и время ее последней проверки
+        self.version = None
+        self.version_checked = 0.0
+        # Индекс начал предложений с частотами, загружается при первой генерации
+        self.starts = None
 
     def set_tokenizer(self, tokenizer):
         """
@@ -40,9 +103,53 @@ class MarkovChain:
         :return: случайное начало предложения
         :rtype: str
         """
-        random_sequence = self.get_random_start_sequence()[0]
-        key, value = random_sequence['key'], random_sequence['value']
-        return ' '.join(key.split()[1:]) + ' ' + str(Dictogram(value).return_weighted_random_word())
+        return ' '.join(map(str, self.generate_random_start_sequences(1)[0]))
+
+    def generate_random_start_sequences(self, count):
+        """
+        Генерация 'count' начал предложений: взвешенная выборка из индекса начал в памяти,
+        распределения выбранных состояний загружаются одним запросом
+
+        :param count: количество начал
+        :type count: int
+        :return: начала предложений
+        :rtype: list
+        """
+        if self.starts is None:
+            self.load_starts()
+        if not self.starts.tokens:
+            # Индекса начал нет (модель сохранена без него) - случайные начала из хранилища
+            states = self.get_random_start_sequence(count)
+            if len(states) < count:
+                # Начал в базе меньше, чем требуется - выбираем с повторениями
+                states = random.choices(states, k=count)
+            return [self.start_from_state(window, value) for window, value in states]
+        windows = self.starts.return_weighted_random_words(count)
+        distributions = self.get_distributions(set(windows))
+        return [window[1:] + (distributions[window].return_weighted_random_word(),) for window in windows]
+
+    def load_starts(self):
+        """
+        Загрузка индекса начал предложений из хранилища в память
+        """
+        self.starts = FrozenDictogram(dict(self.storage.iter_starts()))
+
+    def start_from_state(self, window, value):
+        """
+        Построение окна начала предложения по состоянию начала
+
+        :param window: окно состояния начала
+        :type window: tuple
+        :param value: распределение состояния
+        :type value: dict
+        :return: окно начала предложения
+        :rtype: tuple
+        """
+        distribution = self.cache.get(window)
+        if distribution is None:
+            distribution = FrozenDictogram(value)
+            self.cache.put(window, distribution)
+        return window[1:] + (distribution.return_weighted_random_word(),)
 
     def generate_random_sentence(self, length, start_sequence):
         """
@@ -57,42 +164,319 @@ class MarkovChain:
         """
         current_word_sequence = tuple(map(int, start_sequence.split()))
         sentence = list(current_word_sequence)
+        # Распределения строятся один раз на состояние и переиспользуются
+        distributions = dict()
         sentence_num = 0
         while sentence_num < length:
-            current_dictogram = Dictogram(self.get_sequence(' '.join(map(str, current_word_sequence))))
-            random_weighted_word = current_dictogram.return_weighted_random_word()
-            current_word_sequence = current_word_sequence[1:] + tuple([random_weighted_word])
-            sentence.append(current_word_sequence[-1])
+            if current_word_sequence not in distributions:
+                distributions[current_word_sequence] = self.get_distribution(current_word_sequence)
+            if distributions[current_word_sequence] is None:
+                # Тупик даже для самого короткого окна - продолжаем с нового начала предложения
+                current_word_sequence = self.generate_random_start_sequences(1)[0]
+                sentence.extend(current_word_sequence)
+            else:
+                random_weighted_word = distributions[current_word_sequence].return_weighted_random_word()
+                current_word_sequence = current_word_sequence[1:] + tuple([random_weighted_word])
+                sentence.append(current_word_sequence[-1])
             sentence_num += 1
         return sentence
 
-    def create_model_from_text(self, text_path):
+    def create_model_from_text(self, text_path, engine='python', workers=1, extend_vocabulary=False, corpus=None):
         """
-        Создание цепи Маркова из текста
+        Создание цепи Маркова из текста или подготовленного корпуса
 
         :param text_path: путь к тексту
         :type text_path: str
+        :param engine: способ подсчета переходов: 'python', 'numpy' или 'packed'
+        :type engine: str
+        :param workers: количество процессов для подсчета переходов
+        :type workers: int
+        :param extend_vocabulary: добавлять новые слова в токенизатор при кодировании
+        :type extend_vocabulary: bool
+        :param corpus: подготовленный корпус этого текста; кодируется только его словарь
+        :type corpus: class corpus.EncodedCorpus, optional
         :return: модель цепи Маркова
         :rtype: dict
         """
-        markov_model = dict()
+        if corpus is not None:
+            return self.create_model_from_data(self.encode_corpus(corpus, extend_vocabulary), engine, workers)
         # Проверка наличия уже обученой модели
         print('-READING TEXT')
-        data = self.tokenizer.text_to_int(read_files(text_path).split())
-        self.tokenizer.change_strategy(Tokenizer.LoadStrategy(self.tokens))
-        range_len = len(data) - self.window_size
-        for current_word in range(0, len(data) - self.window_size):
-            print("creating: {}/{}".format(current_word + 1, range_len))
-            # Создаем окно
-            window = tuple(data[current_word: current_word + self.window_size])
-            # Добавляем в словарь
-            if window in markov_model:
-                # Присоединяем к уже существующему распределению
-                markov_model[window].update([data[current_word + self.window_size]])
+        with self.instrumentation.stage('read'):
+            text = read_files(text_path).split()
+        with self.instrumentation.stage('tokenize'):
+            data = self.tokenizer.text_to_int(text, self.lease if extend_vocabulary else None)
+        del text
+        self.tokenizer.change_strategy(Tokenizer.CachingLoadStrategy(self.storage))
+        return self.create_model_from_data(data, engine, workers)
+
+    def encode_corpus(self, corpus, extend_vocabulary=False):
+        """
+        Перевод подготовленного корпуса в индексы токенизатора, кодируется только словарь корпуса
+
+        :param corpus: подготовленный корпус
+        :type corpus: class corpus.EncodedCorpus
+        :param extend_vocabulary: добавлять новые слова в токенизатор при кодировании
+        :type extend_vocabulary: bool
+        :return: токенизированный текст
+        :rtype: array.array, list
+        """
+        with self.instrumentation.stage('tokenize'):
+            words = corpus.words_in_order()
+            idxs = self.tokenizer.text_to_int(words, self.lease if extend_vocabulary else None)
+            data = corpus.translate(dict(zip(words, idxs)))
+        self.tokenizer.change_strategy(Tokenizer.CachingLoadStrategy(self.storage))
+        return data
+
+    def create_model_from_corpora(self, corpora, engine='python', workers=1, extend_vocabulary=False):
+        """
+        Создание цепи Маркова из нескольких подготовленных корпусов, окна не выходят за границы корпуса
+
+        :param corpora: подготовленные корпуса
+        :type corpora: list
+        :param engine: способ подсчета переходов: 'python', 'numpy' или 'packed'
+        :type engine: str
+        :param workers: количество процессов для подсчета переходов
+        :type workers: int
+        :param extend_vocabulary: добавлять новые слова в токенизатор при кодировании
+        :type extend_vocabulary: bool
+        :return: модель цепи Маркова
+        :rtype: dict
+        """
+        markov_model = self.new_model(engine)
+        for corpus in corpora:
+            if not self.memory_budget:
+                merge_models(markov_model, self.create_model_from_text(None, engine, workers, extend_vocabulary,
+                                                                       corpus))
+                continue
+            # С бюджетом памяти корпус считается порциями, между порциями модель сбрасывается на диск
+            data = self.encode_corpus(corpus, extend_vocabulary)
+            chunk_size = self.budget_chunk_size()
+            for i in range(0, len(data), chunk_size):
+                start = min(self.window_size, i)
+                merge_models(markov_model, self.create_model_from_data(data[i - start: i + chunk_size], engine,
+                                                                       workers, start))
+                with self.instrumentation.stage('spill'):
+                    markov_model.maybe_spill(self.chunk_bytes(chunk_size))
+        return markov_model
+
+    def create_model_from_files(self, paths, engine='python', workers=1, extend_vocabulary=False):
+        """
+        Создание цепи Маркова из нескольких файлов: пул процессов читает файлы порциями и считает
+        переходы по словам, модели файлов по порядку переводятся в индексы и объединяются.
+        Окна не выходят за границы файла, текст корпуса целиком в памяти не собирается.
+        Переходы файла считаются по словам, поэтому способ подсчета определяет только объединенную модель
+
+        :param paths: пути к файлам
+        :type paths: list
+        :param engine: способ подсчета переходов: 'python', 'numpy' или 'packed'
+        :type engine: str
+        :param workers: количество процессов чтения и подсчета
+        :type workers: int
+        :param extend_vocabulary: добавлять новые слова в токенизатор при кодировании
+        :type extend_vocabulary: bool
+        :return: модель цепи Маркова
+        :rtype: dict, class spill.SpillingModel, class packed_model.PackedModel
+        """
+        print('-READING {} FILES'.format(len(paths)))
+        if engine == 'numpy':
+            print('-COUNTING FILES WITHOUT NUMPY')
+        markov_model = self.new_model(engine)
+        progress = self.instrumentation.progress('reading files')
+        with Pool(workers) as pool:
+            partial_models = pool.imap(partial(count_file, orders=self.orders), paths)
+            while True:
+                with self.instrumentation.stage('read'):
+                    partial_model = next(partial_models, None)
+                if partial_model is None:
+                    break
+                with self.instrumentation.stage('tokenize'):
+                    words = list(dict.fromkeys(word for window, value in partial_model.items()
+                                               for word in window + tuple(value)))
+                    idxs = self.tokenizer.text_to_int(words, self.lease if extend_vocabulary else None)
+                with self.instrumentation.stage('count'):
+                    merge_models(markov_model, translate_model(partial_model, dict(zip(words, idxs))))
+                    if self.memory_budget:
+                        markov_model.maybe_spill()
+                progress.update(len(markov_model))
+        self.tokenizer.change_strategy(Tokenizer.CachingLoadStrategy(self.storage))
+        return markov_model
+
+    def create_model_from_stream(self, text_path, chunk_size, engine='python', workers=1, extend_vocabulary=False,
+                                 markov_model=None):
+        """
+        Создание цепи Маркова из текста, читаемого порциями.
+        Пиковая память ограничена размером порции и размером модели
+
+        :param text_path: путь к тексту
+        :type text_path: str
+        :param chunk_size: количество слов в порции
+        :type chunk_size: int
+        :param engine: способ подсчета переходов: 'python', 'numpy' или 'packed'
+        :type engine: str
+        :param workers: количество процессов для подсчета переходов
+        :type workers: int
+        :param extend_vocabulary: добавлять новые слова в токенизатор при кодировании
+        :type extend_vocabulary: bool
+        :param markov_model: модель, в которую добавляются переходы, например модель предыдущих файлов
+        :type markov_model: dict, class spill.SpillingModel, class packed_model.PackedModel, optional
+        :return: модель цепи Маркова
+        :rtype: dict, class spill.SpillingModel, class packed_model.PackedModel
+        """
+        print('-READING TEXT BY CHUNKS')
+        if markov_model is None:
+            markov_model = self.new_model(engine)
+        chunks = read_token_chunks(text_path, chunk_size, overlap=self.window_size)
+        progress = self.instrumentation.progress('reading chunks')
+        # Первые 'window_size' слов каждой порции, кроме первой, уже учтены в предыдущей
+        start = 0
+        while True:
+            with self.instrumentation.stage('read'):
+                chunk = next(chunks, None)
+            if chunk is None:
+                break
+            with self.instrumentation.stage('tokenize'):
+                data = self.tokenizer.text_to_int(chunk, self.lease if extend_vocabulary else None)
+            if engine == 'python' and workers == 1 and not self.memory_budget:
+                with self.instrumentation.stage('count'):
+                    if len(self.orders) == 1:
+                        count_transitions(data, self.window_size, markov_model)
+                    else:
+                        count_transitions_multi(data, self.orders, markov_model, start)
+            elif engine == 'packed' and workers == 1 and isinstance(markov_model, PackedModel):
+                with self.instrumentation.stage('count'):
+                    for window_size in self.orders:
+                        count_transitions_packed(data, window_size, markov_model, start)
             else:
-                markov_model[window] = Dictogram([data[current_word + self.window_size]])
+                merge_models(markov_model, self.create_model_from_data(data, engine, workers, start))
+            if self.memory_budget:
+                with self.instrumentation.stage('spill'):
+                    markov_model.maybe_spill(self.chunk_bytes(chunk_size))
+            progress.update(len(markov_model))
+            start = min(self.window_size, len(chunk))
+        self.tokenizer.change_strategy(Tokenizer.CachingLoadStrategy(self.storage))
         return markov_model
 
+    def chunk_bytes(self, chunk_size):
+        """
+        Наибольший прирост оценки памяти модели за порцию: каждое слово добавляет
+        не больше одного состояния и одного перехода на каждый размер окна
+
+        :param chunk_size: количество слов в порции
+        :type chunk_size: int
+        :return: размер в байтах
+        :rtype: int
+        """
+        return chunk_size * len(self.orders) * (STATE_BYTES + TRANSITION_BYTES)
+
+    def budget_chunk_size(self):
+        """
+        Размер порции, прирост модели за которую не больше половины бюджета памяти:
+        модель сбрасывается на диск до порции, которая могла бы превысить бюджет
+
+        :return: количество слов в порции
+        :rtype: int
+        """
+        return max(1, self.memory_budget // (2 * self.chunk_bytes(1)))
+
+    def new_model(self, engine='python'):
+        """
+        Пустая модель для накопления переходов: с бюджетом памяти - сбрасываемая на диск,
+        для способа 'packed' - с упакованными ключами
+
+        :param engine: способ подсчета переходов
+        :type engine: str
+        :return: модель цепи Маркова
+        :rtype: dict, class spill.SpillingModel, class packed_model.PackedModel
+        """
+        if self.memory_budget:
+            return SpillingModel(self.memory_budget)
+        if engine == 'packed':
+            return PackedModel()
+        return dict()
+
+    @staticmethod
+    def iter_model(data):
+        """
+        Перебор состояний модели; сброшенная на диск модель перебирается слиянием в порядке окон
+
+        :param data: модель цепи Маркова
+        :type data: dict, class spill.SpillingModel, class packed_model.PackedModel
+        :return: пары (окно, распределение)
+        :rtype: iterable
+        """
+        if isinstance(data, SpillingModel) and data.runs or isinstance(data, PackedModel):
+            return data.sorted_items()
+        return data.items()
+
+    @staticmethod
+    def sorted_model(data):
+        """
+        Перебор состояний модели в порядке окон
+
+        :param data: модель цепи Маркова
+        :type data: dict, class spill.SpillingModel, class packed_model.PackedModel
+        :return: пары (окно, распределение), отсортированные по окну
+        :rtype: iterable
+        """
+        if isinstance(data, (SpillingModel, PackedModel)):
+            return data.sorted_items()
+        return sorted(data.items(), key=itemgetter(0))
+
+    @staticmethod
+    def skip_applied(items, batches):
+        """
+        Пропуск состояний из уже примененных пакетов дообучения
+
+        :param items: пары (окно, распределение), отсортированные по окну
+        :type items: iterable
+        :param batches: диапазоны окон (первое, последнее) примененных пакетов
+        :type batches: list
+        :return: пары вне примененных пакетов
+        :rtype: generator
+        """
+        batches = sorted(batches)
+        firsts = [first for first, _ in batches]
+        for window, value in items:
+            i = bisect_right(firsts, window) - 1
+            if i >= 0 and window <= batches[i][1]:
+                continue
+            yield window, value
+
+    def create_model_from_data(self, data, engine='python', workers=1, start=0):
+        """
+        Создание цепи Маркова из токенизированного текста
+
+        :param data: токенизированный текст
+        :type data: list
+        :param engine: способ подсчета переходов: 'python', 'numpy' или 'packed'
+        :type engine: str
+        :param workers: количество процессов для подсчета переходов
+        :type workers: int
+        :param start: позиция первого учитываемого следующего слова, слова до нее - только контекст
+        :type start: int
+        :return: модель цепи Маркова
+        :rtype: dict, class packed_model.PackedModel
+        """
+        if engine not in ('python', 'numpy', 'packed'):
+            raise ValueError('unknown engine: {}'.format(engine))
+        with self.instrumentation.stage('count'):
+            if engine == 'python' and workers == 1 and len(self.orders) > 1:
+                return count_transitions_multi(data, self.orders, start=start)
+            markov_model = PackedModel() if engine == 'packed' else dict()
+            for window_size in self.orders:
+                # Окна разной длины не пересекаются, модели объединяются без слияния распределений
+                part = data[start - window_size:] if start > window_size else data
+                if engine == 'packed' and workers == 1:
+                    count_transitions_packed(part, window_size, markov_model)
+                elif workers > 1:
+                    markov_model.update(count_transitions_parallel(part, window_size, workers, engine))
+                elif engine == 'python':
+                    markov_model.update(count_transitions(part, window_size))
+                else:
+                    markov_model.update(count_transitions_numpy(part, window_size))
+            return markov_model
+
     def generate(self, length):
         """
         Генерация предложения
@@ -102,52 +486,258 @@ class MarkovChain:
         :return: сгенерированное предложение
         :rtype: str
         """
+        with self.instrumentation.stage('generate'):
+            self.check_version()
+            start = self.generate_random_start_sequence()
+            sentence = self.generate_random_sentence(length, start)
+
+            return self.tokenizer.int_to_text([word for word in sentence if word != self.tokenizer.end_symbol])
+
+    def generate_batch(self, count, length):
+        """
+        Пошаговая генерация нескольких предложений одновременно.
+        На каждом шаге все нужные состояния загружаются одним запросом
+
+        :param count: количество предложений
+        :type count: int
+        :param length: количество слов в предложении
+        :type length: int
+        :return: сгенерированные предложения
+        :rtype: list
+        """
+        with self.instrumentation.stage('generate'):
+            self.check_version()
+            windows = self.generate_random_start_sequences(count)
+            sentences = [list(window) for window in windows]
+            for _ in range(length):
+                distributions = self.get_distributions(set(windows))
+                for i, window in enumerate(windows):
+                    if window not in distributions:
+                        # Тупик даже для самого короткого окна - продолжаем с нового начала предложения
+                        windows[i] = self.generate_random_start_sequences(1)[0]
+                        sentences[i].extend(windows[i])
+                        continue
+                    word = distributions[window].return_weighted_random_word()
+                    windows[i] = window[1:] + (word,)
+                    sentences[i].append(word)
+            return [self.tokenizer.int_to_text([word for word in sentence if word != self.tokenizer.end_symbol])
+                    for sentence in sentences]
 
-        start = self.generate_random_start_sequence()
-        sentence = self.generate_random_sentence(length, start)
+    def is_start(self, window):
+        """
+        Является ли окно началом предложения: окно полного размера, начинающееся с символа конца
 
-        return self.tokenizer.int_to_text([word for word in sentence if word != self.tokenizer.end_symbol])
+        :param window: окно
+        :type window: tuple
+        :rtype: bool
+        """
+        return len(window) == self.window_size and window[0] == self.tokenizer.end_symbol
 
-    def save(self, data):
+    def save(self, data, delta_id=None):
         """
         Сохранение цепи Маркова в базу данных
 
+        :param data: модель цепи Маркова
+        :type data: dict, class spill.SpillingModel, class packed_model.PackedModel
+        :param delta_id: идентификатор дообучения: пакеты записываются с отметкой в журнале,
+            пакеты, отмеченные до сбоя, пропускаются
+        :type delta_id: str, optional
+        """
+        with self.instrumentation.stage('save') as stats:
+            if delta_id is not None:
+                batches = self.storage.find_delta(delta_id)['batches']
+                states = self.save_items(self.skip_applied(self.sorted_model(data), batches), delta_id)
+            elif isinstance(data, SpillingModel) and data.runs or isinstance(data, PackedModel):
+                states = self.save_items(data.sorted_items())
+            else:
+                self.save_model(data)
+                states = len(data)
+        stats['states'] = stats.get('states', 0) + states
+        stats['states_per_sec'] = stats['states'] / max(stats['wall'], 1e-9)
+        print('SAVED {} STATES ({:.0f}/s)'.format(states, stats['states_per_sec']))
+
+    def save_model(self, data):
+        """
+        Запись цепи Маркова в хранилище. В пустое хранилище состояния просто вставляются,
+        индексы строятся после загрузки; иначе отсортированные ключи делятся на диапазоны,
+        которые записываются пакетами увеличений частот в 'writers' потоков
+
         :param data: модель цепи Маркова
         :type data: dict
         """
         # TODO: end_symbol is not enough add some start ones
-        # Creating indexes
-        self.model.create_index([('key', pymongo.ASCENDING)], name='keys', unique=True)
-
-        res = list()
-        items = data.items()
-        ln = len(items)
-        batch_size = 1e5
-        for i, (key, value) in enumerate(data.items()):
-            print('saving: {}/{}'.format(i + 1, ln))
-            start = key[0] == self.tokenizer.end_symbol
-            key = ' '.join(map(str, key))
-            value = {str(value_key): value_value for value_key, value_value in value.items()}
-            increments = {'value.{}'.format(k): val for k, val in value.items()}
-            if start:
-                res.append(pymongo.UpdateOne({'key': key}, {'$inc': increments, '$set': {'start': start}}, upsert=True))
+        fresh = self.storage.is_empty()
+        if fresh:
+            write = self.storage.insert_states
+        else:
+            self.storage.create_indexes()
+            write = self.storage.increment_states
+
+        keys = sorted(data)
+        writers = self.writers if self.storage.concurrent_writes else 1
+        size = -(-len(keys) // max(writers, 1))
+        partitions = [keys[i: i + size] for i in range(0, len(keys), size)]
+        progress = self.instrumentation.progress('saving', len(keys))
+        lock = threading.Lock()
+        saved = [0]
+
+        def write_partition(partition):
+            for i in range(0, len(partition), self.save_batch_size):
+                res = [(key, data[key], self.is_start(key)) for key in partition[i: i + self.save_batch_size]]
+                self.write_rows(write, res)
+                with lock:
+                    saved[0] += len(res)
+                    progress.update(saved[0])
+
+        if len(partitions) > 1:
+            with ThreadPoolExecutor(len(partitions)) as executor:
+                list(executor.map(self.instrumentation.bind(write_partition), partitions))
+        else:
+            for partition in partitions:
+                write_partition(partition)
+        if fresh:
+            self.storage.create_indexes()
+
+    def write_rows(self, write, rows):
+        """
+        Запись пакета состояний и увеличение частот начал предложений
+
+        :param write: метод записи хранилища: 'insert_states' или 'increment_states'
+        :type write: callable
+        :param rows: тройки (окно, распределение, является ли началом)
+        :type rows: list
+        """
+        write(rows)
+        # Частота начала - сколько раз состояние встретилось в тексте
+        self.storage.increment_starts([(key, sum(value.values())) for key, value, start in rows if start])
+
+    def save_items(self, items, delta_id=None):
+        """
+        Запись потока состояний, отсортированных по окну, без сборки модели в памяти:
+        пакеты записываются в 'writers' потоков, в очереди не больше двух пакетов на поток
+
+        :param items: пары (окно, распределение)
+        :type items: iterable
+        :param delta_id: идентификатор дообучения, пакеты которого отмечаются в журнале
+        :type delta_id: str, optional
+        :return: количество записанных состояний
+        :rtype: int
+        """
+        fresh = delta_id is None and self.storage.is_empty()
+        if fresh:
+            write_batch = partial(self.write_rows, self.storage.insert_states)
+        else:
+            self.storage.create_indexes()
+            if delta_id is None:
+                write_batch = partial(self.write_rows, self.storage.increment_states)
             else:
-                res.append(pymongo.UpdateOne({'key': key}, {'$inc': increments, '$setOnInsert': {'start': start}},
-                                             upsert=True))
-            if (i + 1) % batch_size == 0:
-                self.model.bulk_write(res, ordered=False)
-                res = list()
-        if len(res) > 0:
-            self.model.bulk_write(res, ordered=False)
+                write_batch = partial(self.storage.apply_delta_batch, delta_id)
+        # Запросы потоков записи учитываются в этапе записи
+        write_batch = self.instrumentation.bind(write_batch)
+        writers = self.writers if self.storage.concurrent_writes else 1
+        progress = self.instrumentation.progress('saving')
+        saved = 0
+        pending = deque()
+        with ThreadPoolExecutor(writers) as executor:
+            rows = list()
+            for key, value in items:
+                rows.append((key, value, self.is_start(key)))
+                if len(rows) < self.save_batch_size:
+                    continue
+                pending.append(executor.submit(write_batch, rows))
+                saved += len(rows)
+                rows = list()
+                if len(pending) > 2 * writers:
+                    pending.popleft().result()
+                progress.update(saved)
+            if rows:
+                pending.append(executor.submit(write_batch, rows))
+                saved += len(rows)
+            for future in pending:
+                future.result()
+        progress.update(saved)
+        if fresh:
+            self.storage.create_indexes()
+        return saved
+
+    def delta_id(self, text_path):
+        """
+        Идентификатор дообучения: хэш текста и размеры окна.
+        Повторное дообучение тем же текстом распознается по журналу
+
+        :param text_path: путь к тексту
+        :type text_path: str
+        :return: идентификатор
+        :rtype: str
+        """
+        if len(self.orders) == 1:
+            return '{}-{}'.format(file_digest(text_path), self.window_size)
+        return '{}-{}-{}'.format(file_digest(text_path), self.orders[0], self.window_size)
+
+    def log_delta(self, delta_id, source, data):
+        """
+        Запись локально накопленного дообучения в журнал
+
+        :param delta_id: идентификатор дообучения
+        :type delta_id: str
+        :param source: источник дообучения
+        :type source: str
+        :param data: модель дообучения
+        :type data: dict, class spill.SpillingModel, class packed_model.PackedModel
+        """
+        entry = {'id': delta_id, 'source': source, 'timestamp': time.time(), 'window_size': self.window_size,
+                 'states': 0, 'transitions': 0}
+
+        def rows():
+            # Запись журнала сохраняется после переходов, поэтому итоги считаются по ходу записи
+            for key, value in self.iter_model(data):
+                entry['states'] += 1
+                entry['transitions'] += sum(value.values())
+                yield key, value, self.is_start(key)
+
+        with self.instrumentation.stage('log delta'):
+            self.storage.append_delta(entry, rows())
+
+    def apply_delta(self, delta_id, data=None):
+        """
+        Применение дообучения из журнала к модели пакетным слиянием. Каждый пакет отмечается
+        в журнале, поэтому повторное применение после сбоя не учитывает записанные пакеты дважды
 
-    def get_random_start_sequence(self):
+        :param delta_id: идентификатор дообучения
+        :type delta_id: str
+        :param data: модель дообучения, None - загрузить из журнала
+        :type data: dict, class spill.SpillingModel, class packed_model.PackedModel, optional
         """
-        Получение случайного начала предложения из базы данных
+        if data is None:
+            data = {window: value for window, value, _ in self.storage.iter_delta_rows(delta_id)}
+        self.save(data, delta_id)
+        self.storage.mark_delta_applied(delta_id)
+        self.invalidate_cache()
 
-        :return: начало предложения
+    def replay_deltas(self):
+        """
+        Применение записанных, но не примененных дообучений в порядке журнала
+
+        :return: количество примененных дообучений
+        :rtype: int
+        """
+        applied = 0
+        for entry in list(self.storage.iter_deltas()):
+            if not entry['applied']:
+                self.apply_delta(entry['id'])
+                applied += 1
+        return applied
+
+    def get_random_start_sequence(self, size=1):
+        """
+        Получение случайного начала предложения из хранилища
+
+        :param size: количество начал
+        :type size: int
+        :return: пары (окно, распределение)
         :rtype: list
         """
-        return list(self.model.aggregate([{'$match': {'start': True}}, {'$sample': {'size': 1}}]))
+        return self.storage.sample_starts(size)
 
     def get_sequence(self, key):
         """
@@ -156,5 +746,120 @@ class MarkovChain:
         :param key: ключ
         :type key: str
         """
-        res = self.model.find_one({'key': key})
-        return {int(key): value for key, value in res['value'].items()}
+        return self.storage.find_state(tuple(map(int, key.split())))
+
+    def get_distribution(self, window):
+        """
+        Получение распределения, готового для выборки, по окну
+
+        :param window: окно
+        :type window: tuple
+        :return: распределение следующих слов или None, если окно и его суффиксы не встречались
+        :rtype: class dictogram.FrozenDictogram
+        """
+        return self.get_distributions([window]).get(window)
+
+    def get_distributions(self, windows):
+        """
+        Получение распределений для нескольких окон, промахи кэша загружаются одним запросом '$in'.
+        Для окна, которого нет в модели, используется самый длинный найденный суффикс
+        не короче 'min_window_size' (back-off)
+
+        :param windows: окна
+        :type windows: iterable
+        :return: распределения по окнам, окна без распределения отсутствуют
+        :rtype: dict
+        """
+        res = dict()
+        missing = list()
+        for window in windows:
+            distribution = self.cache.get(window)
+            if distribution is None:
+                missing.append(window)
+            else:
+                res[window] = distribution
+        if missing:
+            # Окна и их суффиксы загружаются одним запросом
+            found = self.storage.find_distributions(list({window[i:] for window in missing
+                                                          for i in range(len(window) - self.orders[0] + 1)}))
+            for window in missing:
+                for i in range(len(window) - self.orders[0] + 1):
+                    distribution = found.get(window[i:])
+                    if distribution is not None:
+                        res[window] = distribution
+                        self.cache.put(window, distribution)
+                        break
+        return res
+
+    def warm_up(self, top_n):
+        """
+        Предварительная загрузка в кэш 'top_n' самых частых состояний
+
+        :param top_n: количество состояний
+        :type top_n: int
+        """
+        for window, value in self.storage.top_states(top_n):
+            self.cache.put(window, FrozenDictogram(value))
+
+    def freeze(self):
+        """
+        Загрузка модели и словаря из хранилища в неизменяемую модель в памяти
+
+        :return: модель, не требующая базы данных для генерации
+        :rtype: class frozen_model.FrozenModel
+        """
+        return FrozenModel.from_storage(self.storage, self.window_size)
+
+    def invalidate_cache(self):
+        """
+        Сброс кэша состояний и индекса начал, необходим после изменения модели.
+        Версия модели в хранилище увеличивается, поэтому генераторы в других процессах
+        сбрасывают свои кэши при следующей проверке версии ('check_version')
+        """
+        self.cache.clear()
+        self.starts = None
+        self.version = self.storage.bump_model_version()
+        self.version_checked = time.monotonic()
+
+    def version_due(self):
+        """
+        Пора ли проверить версию модели: не чаще раза в 'version_interval' секунд
+
+        :rtype: bool
+        """
+        if self.version_interval is None:
+            return False
+        now = time.monotonic()
+        if self.version is not None and now - self.version_checked < self.version_interval:
+            return False
+        self.version_checked = now
+        return True
+
+    def apply_version(self, version):
+        """
+        Сброс кэша состояний, если версия модели в хранилище отличается от версии кэша.
+        Индекс начал не сбрасывается - его загружает заново вызывающий код
+
+        :param version: версия модели в хранилище
+        :type version: int
+        :return: был ли сброшен кэш
+        :rtype: bool
+        """
+        changed = self.version is not None and version != self.version
+        self.version = version
+        if changed:
+            self.cache.clear()
+        return changed
+
+    def check_version(self):
+        """
+        Сброс кэша состояний и загрузка индекса начал, если модель в хранилище изменил другой процесс
+
+        :return: был ли сброшен кэш
+        :rtype: bool
+        """
+        if not self.version_due() or not self.apply_version(self.storage.model_version()):
+            return False
+        if self.starts is not None:
+            self.load_starts()
+        return True
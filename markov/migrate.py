@@ -0,0 +1,29 @@
+import argparse
+import json
+import pymongo
+from storage import migrate_to_binary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Перенос модели в компактную двоичную схему')
+    parser.add_argument('--database', default='markov', help='имя базы данных на локальном сервере')
+    parser.add_argument('--source', default='model', help='коллекция модели в исходной схеме')
+    parser.add_argument('--target', default='model_binary', help='коллекция для модели в компактной схеме')
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--swap', action='store_true',
+                        help="переименовать коллекции модели и начал: исходные - в '<source>_v1', новые - в '<source>'")
+    args = parser.parse_args()
+
+    db = pymongo.MongoClient("mongodb://localhost:27017/")[args.database]
+    print('MIGRATING A MODEL')
+    report = migrate_to_binary(db, args.source, args.target, args.batch_size)
+    if args.swap:
+        for suffix in ('', '_starts'):
+            if args.source + suffix in db.list_collection_names():
+                db[args.source + suffix].rename(args.source + suffix + '_v1')
+            db[args.target + suffix].rename(args.source + suffix)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+import heapq
+import sys
+from array import array
+
+# Индекс слова занимает 32 бита: в ключе - на каждое слово окна, в значении - младшие биты
+BITS = 32
+LOW = (1 << BITS) - 1
+ONE = 1 << BITS
+# Больше стольких следующих слов - распределение хранится словарем
+SMALL_LIMIT = 8
+
+
+def pack_window(window):
+    """
+    Упаковка окна в число: ведущая единица, затем индексы по 32 бита, первый - старший.
+    Ведущая единица различает окна разной длины, порядок окон одной длины сохраняется
+
+    :param window: окно
+    :type window: tuple
+    :return: упакованный ключ
+    :rtype: int
+    """
+    key = 1
+    for idx in window:
+        key = key << BITS | idx
+    return key
+
+
+def unpack_window(key):
+    """
+    Распаковка ключа в окно
+
+    :param key: упакованный ключ
+    :type key: int
+    :return: окно
+    :rtype: tuple
+    """
+    window = list()
+    while key > 1:
+        window.append(key & LOW)
+        key >>= BITS
+    return tuple(reversed(window))
+
+
+class SmallCounts(array):
+    """
+    Распределение с несколькими следующими словами: массив чисел 'частота << 32 | индекс'
+    в порядке появления слов, без словаря и атрибутов на объекте
+    """
+    __slots__ = ()
+
+    def __new__(cls, entries=()):
+        return super().__new__(cls, 'Q', entries)
+
+
+def iter_counts(value):
+    """
+    Пары (следующее слово, частота) значения упакованной модели
+
+    :param value: одно упакованное число, 'class packed_model.SmallCounts' или словарь
+    :return: пары в порядке появления слов
+    :rtype: iterable
+    """
+    if value.__class__ is int:
+        return ((value & LOW, value >> BITS),)
+    if value.__class__ is SmallCounts:
+        return ((entry & LOW, entry >> BITS) for entry in value)
+    return value.items()
+
+
+class PackedModel(dict):
+    """
+    Компактная модель для подсчета переходов: ключ - окно, упакованное в одно число,
+    значение - одно число 'частота << 32 | индекс' для единственного следующего слова,
+    'class packed_model.SmallCounts' для нескольких и словарь {индекс: частота} для многих.
+    Для записи распаковывается в пары (окно, {индекс: частота}) с тем же порядком слов, что у 'Dictogram'
+    """
+    def add(self, key, successor, count=1):
+        """
+        Увеличение частоты перехода
+
+        :param key: упакованное окно
+        :type key: int
+        :param successor: следующее слово
+        :type successor: int
+        :param count: приращение частоты
+        :type count: int
+        """
+        value = self.get(key)
+        if value is None:
+            self[key] = count << BITS | successor
+        elif value.__class__ is int:
+            if value & LOW == successor:
+                self[key] = value + (count << BITS)
+            else:
+                try:
+                    self[key] = SmallCounts((value, count << BITS | successor))
+                except OverflowError:
+                    # Частота не помещается в 32 бита - сразу словарь
+                    self[key] = {value & LOW: value >> BITS, successor: count}
+        elif value.__class__ is SmallCounts:
+            for i, entry in enumerate(value):
+                if entry & LOW == successor:
+                    try:
+                        value[i] = entry + (count << BITS)
+                    except OverflowError:
+                        # Частота не помещается в 32 бита - переходим к словарю
+                        self[key] = value = dict(iter_counts(value))
+                        value[successor] += count
+                    return
+            if len(value) < SMALL_LIMIT:
+                try:
+                    value.append(count << BITS | successor)
+                    return
+                except OverflowError:
+                    pass
+            self[key] = value = dict(iter_counts(value))
+            value[successor] = count
+        else:
+            value[successor] = value.get(successor, 0) + count
+
+    def merge(self, other):
+        """
+        Добавление переходов другой модели: упакованной или словаря окон
+
+        :param other: модель
+        :type other: class packed_model.PackedModel, dict
+        :return: объединенная модель
+        :rtype: class packed_model.PackedModel
+        """
+        if isinstance(other, PackedModel):
+            for key, value in other.items():
+                if key not in self:
+                    self[key] = value if value.__class__ is int else value.__class__(value)
+                    continue
+                for successor, count in iter_counts(value):
+                    self.add(key, successor, count)
+        else:
+            for window, value in other.items():
+                key = pack_window(window)
+                for successor, count in value.items():
+                    self.add(key, successor, count)
+        return self
+
+    def sorted_items(self):
+        """
+        Распакованные состояния в порядке окон, как у 'SpillingModel.sorted_items'.
+        Ключи одной длины упорядочены как окна, окна разной длины сливаются
+
+        :return: генератор пар (окно, {индекс: частота})
+        :rtype: generator
+        """
+        orders = dict()
+        for key in self:
+            orders.setdefault(key.bit_length(), list()).append(key)
+        runs = [((unpack_window(key), key) for key in sorted(keys)) for keys in orders.values()]
+        for window, key in heapq.merge(*runs):
+            yield window, dict(iter_counts(self[key]))
+
+    def transitions(self):
+        """
+        Количество переходов
+
+        :rtype: int
+        """
+        return sum(1 if value.__class__ is int else len(value) for value in self.values())
+
+    def nbytes(self):
+        """
+        Размер модели в памяти: таблица, ключи и значения
+
+        :return: размер в байтах
+        :rtype: int
+        """
+        size = sys.getsizeof(self)
+        for key, value in self.items():
+            size += sys.getsizeof(key) + sys.getsizeof(value)
+            if value.__class__ is dict:
+                size += sum(map(sys.getsizeof, value.values()))
+        return size
+
+
+def count_transitions_packed(data, window_size, markov_model=None, start=0):
+    """
+    Подсчет переходов в упакованную модель: ключ окна обновляется сдвигом, без создания кортежей
+
+    :param data: токенизированный текст
+    :type data: list
+    :param window_size: размер окна
+    :type window_size: int
+    :param markov_model: модель, в которую добавляются переходы
+    :type markov_model: class packed_model.PackedModel, optional
+    :param start: позиция первого учитываемого следующего слова, слова до нее - только контекст
+    :type start: int
+    :return: упакованная модель
+    :rtype: class packed_model.PackedModel
+    """
+    if markov_model is None:
+        markov_model = PackedModel()
+    first = max(start, window_size)
+    marker = 1 << BITS * window_size
+    mask = marker - 1
+    key = 0
+    for idx in data[first - window_size: first]:
+        key = key << BITS | idx
+    get = markov_model.get
+    add = markov_model.add
+    for i in range(first, len(data)):
+        successor = data[i]
+        packed = key | marker
+        # Частые случаи - новое состояние, повтор единственного слова и словарь - без вызова метода
+        value = get(packed)
+        if value is None:
+            markov_model[packed] = ONE | successor
+        elif value.__class__ is int and value & LOW == successor:
+            markov_model[packed] = value + ONE
+        elif value.__class__ is dict:
+            value[successor] = value.get(successor, 0) + 1
+        else:
+            add(packed, successor)
+        key = (key << BITS | successor) & mask
+    return markov_model
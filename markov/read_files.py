@@ -1,17 +1,153 @@
+import bz2
+import glob
+import gzip
+import hashlib
+import lzma
+import os
+
+# Сжатые файлы распознаются по расширению
+OPENERS = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open, '.lzma': lzma.open}
+
+
+def expand_paths(text_path):
+    """
+    Список файлов корпуса: файл, каталог (все файлы рекурсивно), шаблон glob или список из них
+
+    :param text_path: путь, каталог, шаблон или список
+    :type text_path: str, list
+    :return: пути к файлам в отсортированном порядке
+    :rtype: list
+    """
+    if type(text_path) in (list, tuple):
+        return [filename for path in text_path for filename in expand_paths(path)]
+    if type(text_path) != str:
+        raise TypeError
+    if os.path.isdir(text_path):
+        return sorted(os.path.join(root, name) for root, _, names in os.walk(text_path) for name in names)
+    if any(char in text_path for char in '*?['):
+        paths = sorted(path for path in glob.glob(text_path, recursive=True) if os.path.isfile(path))
+        if not paths:
+            raise FileNotFoundError(text_path)
+        return paths
+    return [text_path]
+
+
+def open_text(filename):
+    """
+    Открытие текстового файла, сжатого gzip, bz2, xz или несжатого
+
+    :param filename: путь к файлу
+    :type filename: str
+    :return: текстовый файл
+    :rtype: io.TextIOBase
+    """
+    opener = OPENERS.get(os.path.splitext(filename)[1].lower())
+    if opener is None:
+        return open(filename, 'r', encoding='utf-8')
+    return opener(filename, 'rt', encoding='utf-8')
+
+
 def read_files(filenames):
     """
     Чтение текстовых файлов
 
-    :param filenames: список путей к файлам
-    :type filenames: str, optional
+    :param filenames: путь к файлу, каталог, шаблон glob или список из них
+    :type filenames: str, list
     :return: text
     :rtype: str
     """
 
-    text = str()
-    if type(filenames) == str:
-        with open(filenames, 'r', encoding='utf-8') as file:
-            text = file.read()
-    else:
+    paths = expand_paths(filenames)
+    if len(paths) == 1:
+        with open_text(paths[0]) as file:
+            return file.read()
+    # Файлы разделяются переводом строки, чтобы последнее и первое слова соседних файлов не склеились
+    texts = list()
+    for path in paths:
+        with open_text(path) as file:
+            texts.append(file.read())
+    return '\n'.join(texts)
+
+
+def read_word_set(filename, chunk_size=1 << 20):
+    """
+    Уникальные слова одного файла в нижнем регистре, выполняется в процессе-обработчике.
+    Файл читается порциями и целиком в памяти не собирается
+
+    :param filename: путь к файлу
+    :type filename: str
+    :param chunk_size: количество слов в порции
+    :type chunk_size: int
+    :return: слова
+    :rtype: set
+    """
+    words = set()
+    for chunk in read_token_chunks(filename, chunk_size):
+        words.update(word.lower() for word in chunk)
+    return words
+
+
+def read_token_chunks(filename, chunk_size, overlap=0, block_size=1 << 20):
+    """
+    Потоковое чтение текстового файла порциями слов.
+    Каждая порция начинается с 'overlap' последних слов предыдущей,
+    поэтому окна на границах порций не теряются
+
+    :param filename: путь к файлу
+    :type filename: str
+    :param chunk_size: количество новых слов в порции
+    :type chunk_size: int
+    :param overlap: количество слов, переносимых из предыдущей порции
+    :type overlap: int
+    :param block_size: размер блока чтения в символах
+    :type block_size: int
+    :return: генератор порций слов
+    :rtype: generator
+    """
+    if type(filename) != str:
         raise TypeError
-    return text
+    chunk = list()
+    carried = 0
+    tail = str()
+    with open_text(filename) as file:
+        while True:
+            block = file.read(block_size)
+            if not block:
+                break
+            block = tail + block
+            words = block.split()
+            # Последнее слово может продолжиться в следующем блоке
+            tail = words.pop() if words and not block[-1].isspace() else str()
+            chunk.extend(words)
+            while len(chunk) >= carried + chunk_size:
+                full = chunk[:carried + chunk_size]
+                yield full
+                carried = min(overlap, len(full))
+                chunk = full[len(full) - carried:] + chunk[len(full):]
+    if tail:
+        chunk.append(tail)
+    if len(chunk) > carried:
+        yield chunk
+
+
+def file_digest(filename, block_size=1 << 20):
+    """
+    Хэш содержимого файла без чтения его целиком.
+    Для нескольких файлов - хэш от хэшей файлов по порядку
+
+    :param filename: путь к файлу, каталог, шаблон glob или список из них
+    :type filename: str, list
+    :param block_size: размер блока чтения в байтах
+    :type block_size: int
+    :return: шестнадцатеричный SHA-256
+    :rtype: str
+    """
+    paths = expand_paths(filename)
+    if len(paths) != 1:
+        return hashlib.sha256(' '.join(file_digest(path, block_size) for path in paths).encode()).hexdigest()
+    filename = paths[0]
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
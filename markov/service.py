@@ -0,0 +1,309 @@
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+import pymongo
+from benchmark import percentiles
+from markov import MarkovGenerator
+
+
+class StateLoader:
+    """
+    Загрузка распределений для одновременных запросов: промахи кэша, накопленные за один
+    проход цикла событий, загружаются одним запросом, одинаковые состояния - один раз
+    """
+    def __init__(self, model, executor):
+        """
+
+        :param model: цепь Маркова с кэшем состояний
+        :type model: class markov_chain.MarkovChain
+        :param executor: пул потоков для запросов к хранилищу
+        :type executor: concurrent.futures.ThreadPoolExecutor
+        """
+        self.model = model
+        self.executor = executor
+        self.futures = dict()
+        self.queue = list()
+        self.fetches = 0
+        self.coalesced = 0
+
+    async def load(self, window):
+        """
+        Распределение состояния из кэша или хранилища
+
+        :param window: окно
+        :type window: tuple
+        :return: распределение или None, если состояния нет в модели
+        :rtype: class dictogram.FrozenDictogram
+        """
+        distribution = self.model.cache.get(window)
+        if distribution is not None:
+            return distribution
+        future = self.futures.get(window)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self.futures[window] = future
+            if not self.queue:
+                asyncio.get_running_loop().call_soon(self.dispatch)
+            self.queue.append(window)
+        else:
+            self.coalesced += 1
+        # Отмена одного запроса по таймауту не должна отменять общую загрузку
+        return await asyncio.shield(future)
+
+    def dispatch(self):
+        """
+        Отправка накопленных окон одним запросом в пуле потоков
+        """
+        windows, self.queue = self.queue, list()
+        self.fetches += 1
+        task = asyncio.get_running_loop().run_in_executor(self.executor, self.model.storage.find_distributions,
+                                                          windows)
+        task.add_done_callback(lambda done: self.resolve(windows, done))
+
+    def resolve(self, windows, done):
+        """
+        Раздача результатов загрузки ожидающим запросам
+
+        :param windows: загруженные окна
+        :type windows: list
+        :param done: завершенная загрузка
+        :type done: asyncio.Future
+        """
+        error = done.exception()
+        distributions = dict() if error is not None else done.result()
+        for window in windows:
+            future = self.futures.pop(window)
+            if error is not None:
+                future.set_exception(error)
+                continue
+            distribution = distributions.get(window)
+            if distribution is not None:
+                self.model.cache.put(window, distribution)
+            future.set_result(distribution)
+
+
+class GenerationService:
+    """
+    Асинхронный сервис генерации: одна модель и один пул соединений на все запросы
+    """
+    def __init__(self, strategy, workers=16, timeout=5.0, latency_window=10000, max_count=100, max_size=1000):
+        """
+
+        :param strategy: стратегия генерации
+        :type strategy: class markov.MarkovGenerator.GenerateStrategy
+        :param workers: количество потоков для запросов к хранилищу
+        :type workers: int
+        :param timeout: ограничение времени одного запроса в секундах
+        :type timeout: float
+        :param latency_window: количество последних запросов для перцентилей задержки
+        :type latency_window: int
+        :param max_count: наибольшее количество предложений в одном запросе
+        :type max_count: int
+        :param max_size: наибольшее количество слов в предложении
+        :type max_size: int
+        """
+        self.model = strategy.model
+        self.tokenizer = strategy.tokenizer
+        self.timeout = timeout
+        self.max_count = max_count
+        self.max_size = max_size
+        self.executor = ThreadPoolExecutor(workers)
+        # Кэш токенизатора не потокобезопасен - его запросы идут в одном потоке
+        self.tokenizer_executor = ThreadPoolExecutor(1)
+        self.loader = StateLoader(self.model, self.executor)
+        self.latencies = deque(maxlen=latency_window)
+        self.started = time.monotonic()
+        self.requests = 0
+        self.completed = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    async def start(self):
+        """
+        Загрузка индекса начал предложений до приема запросов
+        """
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.model.load_starts)
+
+    async def random_start(self):
+        """
+        Случайное состояние начала предложения
+
+        :return: окно
+        :rtype: tuple
+        """
+        if self.model.starts.tokens:
+            return self.model.starts.return_weighted_random_word()
+        states = await asyncio.get_running_loop().run_in_executor(self.executor, self.model.storage.sample_starts, 1)
+        return states[0][0]
+
+    async def generate_sentence(self, size_sent):
+        """
+        Генерация предложения, шаги ждут загрузки состояний без блокировки других запросов
+
+        :param size_sent: количество слов в предложении
+        :type size_sent: int
+        :return: сгенерированное предложение
+        :rtype: str
+        """
+        window = await self.random_start()
+        sentence = list(window[1:])
+        for _ in range(size_sent + 1):
+            distribution = await self.loader.load(window)
+            # Back-off к более коротким окнам модели с несколькими порядками
+            for i in range(1, len(window) - self.model.orders[0] + 1):
+                if distribution is not None:
+                    break
+                distribution = await self.loader.load(window[i:])
+            if distribution is None:
+                # Тупик даже для самого короткого окна - продолжаем с нового начала предложения,
+                # как 'MarkovChain.generate_random_sentence'
+                window = await self.random_start()
+                sentence.extend(window[1:])
+                continue
+            window = window[1:] + (distribution.return_weighted_random_word(),)
+            sentence.append(window[-1])
+        words = [word for word in sentence if word != self.tokenizer.end_symbol]
+        return await asyncio.get_running_loop().run_in_executor(self.tokenizer_executor,
+                                                                self.tokenizer.int_to_text, words)
+
+    async def handle(self, count, size_sent):
+        """
+        Обработка запроса с ограничением времени и размера: запрос с 'count' вне 1..'max_count'
+        или 'size_sent' вне 1..'max_size' отклоняется до генерации
+
+        :param count: количество предложений
+        :type count: int
+        :param size_sent: количество слов в предложении
+        :type size_sent: int
+        :return: HTTP-статус и тело ответа
+        :rtype: tuple
+        """
+        self.requests += 1
+        if not (1 <= count <= self.max_count and 1 <= size_sent <= self.max_size):
+            return 400, {'error': 'count must be in 1..{}, size in 1..{}'.format(self.max_count, self.max_size)}
+        started = time.perf_counter()
+        try:
+            if self.model.version_due():
+                version = await asyncio.get_running_loop().run_in_executor(self.executor,
+                                                                           self.model.storage.model_version)
+                # Модель изменена дообучением или сжатием. Кэш сбрасывается в потоке цикла событий,
+                # индекс начал заменяется целиком после загрузки
+                if self.model.apply_version(version):
+                    await asyncio.get_running_loop().run_in_executor(self.executor, self.model.load_starts)
+            sentences = await asyncio.wait_for(
+                asyncio.gather(*(self.generate_sentence(size_sent) for _ in range(count))), self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            return 504, {'error': 'timeout'}
+        except Exception as error:
+            self.errors += 1
+            return 500, {'error': repr(error)}
+        self.completed += 1
+        self.latencies.append(time.perf_counter() - started)
+        return 200, {'sentences': sentences}
+
+    def stats(self):
+        """
+        Пропускная способность, задержки, загрузки состояний и кэш
+
+        :return: статистика сервиса
+        :rtype: dict
+        """
+        uptime = time.monotonic() - self.started
+        return {'uptime': uptime, 'requests': self.requests, 'completed': self.completed,
+                'timeouts': self.timeouts, 'errors': self.errors,
+                'requests_per_sec': self.completed / max(uptime, 1e-9),
+                'latency': percentiles(self.latencies),
+                'fetches': self.loader.fetches, 'coalesced': self.loader.coalesced,
+                'cache': self.model.cache.stats(), 'model_version': self.model.version}
+
+    async def serve_client(self, reader, writer):
+        """
+        Минимальный HTTP/1.1: 'GET /generate?count=1&size=20' и 'GET /stats', ответы в JSON
+
+        :param reader: входной поток соединения
+        :type reader: asyncio.StreamReader
+        :param writer: выходной поток соединения
+        :type writer: asyncio.StreamWriter
+        """
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            url = urlsplit(parts[1] if len(parts) > 1 else '/')
+            query = parse_qs(url.query)
+            if url.path == '/generate':
+                status, body = await self.handle(int(query.get('count', ['1'])[0]),
+                                                 int(query.get('size', ['20'])[0]))
+            elif url.path == '/stats':
+                status, body = 200, self.stats()
+            else:
+                status, body = 404, {'error': 'not found'}
+        except ValueError:
+            status, body = 400, {'error': 'bad request'}
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json; charset=utf-8\r\n'
+                     'Content-Length: {}\r\nConnection: close\r\n\r\n'.format(
+                         status, {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+                                  500: 'Internal Server Error', 504: 'Gateway Timeout'}[status],
+                         len(data)).encode('latin-1') + data)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8080, unix_path=None):
+        """
+        Запуск сервиса на TCP-порту или Unix-сокете
+
+        :param host: адрес
+        :type host: str
+        :param port: порт
+        :type port: int
+        :param unix_path: путь к Unix-сокету, вместо TCP
+        :type unix_path: str, optional
+        """
+        await self.start()
+        if unix_path is not None:
+            server = await asyncio.start_unix_server(self.serve_client, unix_path)
+        else:
+            server = await asyncio.start_server(self.serve_client, host, port)
+        print('SERVING')
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Асинхронный сервис генерации предложений')
+    parser.add_argument('--database', default='mydatabase', help='имя базы данных или sqlite:///путь')
+    parser.add_argument('--window-size', type=int, default=2)
+    parser.add_argument('--min-window-size', type=int, default=None, help='наименьший размер окна для back-off')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--unix', default=None, help='путь к Unix-сокету')
+    parser.add_argument('--workers', type=int, default=16, help='потоки и соединения с базой данных')
+    parser.add_argument('--timeout', type=float, default=5.0, help='ограничение времени запроса в секундах')
+    parser.add_argument('--max-count', type=int, default=100, help='наибольшее количество предложений в запросе')
+    parser.add_argument('--max-size', type=int, default=1000, help='наибольшее количество слов в предложении')
+    parser.add_argument('--cache-size', type=int, default=100000)
+    parser.add_argument('--warm-up', type=int, default=0)
+    args = parser.parse_args()
+
+    database = args.database
+    if not database.startswith('sqlite:///'):
+        # Один клиент с пулом по числу потоков на весь сервис
+        database = pymongo.MongoClient("mongodb://localhost:27017/", maxPoolSize=args.workers)[database]
+    strategy = MarkovGenerator.GenerateStrategy(database, args.window_size, cache_size=args.cache_size,
+                                                warm_up=args.warm_up, min_window_size=args.min_window_size)
+    service = GenerationService(strategy, workers=args.workers, timeout=args.timeout, max_count=args.max_count,
+                                max_size=args.max_size)
+    asyncio.run(service.serve(args.host, args.port, args.unix))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+import argparse
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+from frozen_model import FrozenModel
+
+MAGIC = b'MARKOVSN'
+VERSION = 1
+# magic, версия, размер окна, символ конца, резерв, основание упаковки,
+# количество состояний, переходов, начал, слов и размер текста словаря
+HEADER = struct.Struct('<8sIIIIQQQQQQ')
+
+
+def align(offset, alignment=8):
+    """
+    Выравнивание смещения
+
+    :param offset: смещение
+    :type offset: int
+    :param alignment: кратность
+    :type alignment: int
+    :return: выровненное смещение
+    :rtype: int
+    """
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def layout(states, transitions, starts, words, text_size):
+    """
+    Расположение массивов снимка: все массивы фиксированной ширины, выровнены по 8 байт
+
+    :param states: количество состояний
+    :type states: int
+    :param transitions: количество переходов
+    :type transitions: int
+    :param starts: количество начал предложений
+    :type starts: int
+    :param words: размер словаря
+    :type words: int
+    :param text_size: размер текста словаря в байтах
+    :type text_size: int
+    :return: список (имя, тип массива, смещение, длина) и размер файла
+    :rtype: tuple
+    """
+    sections = [('keys', 'Q', states), ('offsets', 'Q', states + 1), ('successors', 'I', transitions),
+                ('cum_counts', 'Q', transitions), ('start_states', 'Q', starts), ('start_cum_weights', 'Q', starts),
+                ('word_offsets', 'Q', words + 1), ('text', 'B', text_size)]
+    res = list()
+    offset = align(HEADER.size)
+    for name, typecode, length in sections:
+        res.append((name, typecode, offset, length))
+        offset = align(offset + length * struct.calcsize(typecode))
+    return res, offset
+
+
+class Vocabulary:
+    """
+    Словарь 'idx -> word' поверх отображенного в память снимка, слова декодируются при обращении
+    """
+    def __init__(self, word_offsets, text):
+        """
+
+        :param word_offsets: смещения слов в тексте, длина на единицу больше словаря
+        :type word_offsets: memoryview
+        :param text: слова в UTF-8 подряд
+        :type text: memoryview
+        """
+        self.word_offsets = word_offsets
+        self.text = text
+
+    def __len__(self):
+        return len(self.word_offsets) - 1
+
+    def __getitem__(self, idx):
+        return str(self.text[self.word_offsets[idx]: self.word_offsets[idx + 1]], 'utf-8')
+
+
+def write_snapshot(path, model):
+    """
+    Запись модели, словаря и индекса начал предложений в один файл.
+    Файл записывается рядом и переименовывается, читатели не видят его частично записанным
+
+    :param path: путь к файлу снимка
+    :type path: str
+    :param model: замороженная модель со словарем
+    :type model: class frozen_model.FrozenModel
+    :return: размер файла в байтах
+    :rtype: int
+    """
+    if model.base ** model.window_size > 2 ** 64:
+        raise ValueError('packed keys do not fit into 64 bits')
+    if model.start_cum_weights:
+        start_states, start_cum_weights = model.start_states, model.start_cum_weights
+    else:
+        # Без индекса начал - все начала равновероятны
+        start_states, start_cum_weights = model.starts, range(1, len(model.starts) + 1)
+    words = [(word or '').encode('utf-8') for word in model.vocabulary or ()]
+    word_offsets = [0]
+    for word in words:
+        word_offsets.append(word_offsets[-1] + len(word))
+    arrays = {'keys': array('Q', model.keys), 'offsets': array('Q', model.offsets),
+              'successors': array('I', model.successors), 'cum_counts': array('Q', model.cum_counts),
+              'start_states': array('Q', start_states), 'start_cum_weights': array('Q', start_cum_weights),
+              'word_offsets': array('Q', word_offsets), 'text': array('B', b''.join(words))}
+    if sys.byteorder != 'little':
+        for values in arrays.values():
+            values.byteswap()
+    sections, size = layout(len(model.keys), len(model.successors), len(start_states), len(words),
+                            word_offsets[-1])
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(HEADER.pack(MAGIC, VERSION, model.window_size, model.end_symbol, 0, model.base,
+                               len(model.keys), len(model.successors), len(start_states), len(words),
+                               word_offsets[-1]))
+        for name, _, offset, _ in sections:
+            file.write(b'\0' * (offset - file.tell()))
+            arrays[name].tofile(file)
+        file.write(b'\0' * (size - file.tell()))
+    os.replace(tmp_path, path)
+    return size
+
+
+def load_snapshot(path):
+    """
+    Загрузка снимка отображением файла в память, без копирования массивов.
+    Процессы, загрузившие один файл, используют одни и те же страницы памяти
+
+    :param path: путь к файлу снимка
+    :type path: str
+    :return: замороженная модель со словарем
+    :rtype: class frozen_model.FrozenModel
+    """
+    if sys.byteorder != 'little':
+        raise ValueError('snapshots can be mapped only on little-endian hosts')
+    with open(path, 'rb') as file:
+        buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    (magic, version, window_size, end_symbol, _, base, states, transitions, starts, words,
+     text_size) = HEADER.unpack_from(buffer)
+    if magic != MAGIC:
+        raise ValueError('{} is not a model snapshot'.format(path))
+    if version != VERSION:
+        raise ValueError('unsupported snapshot version {}'.format(version))
+    sections, size = layout(states, transitions, starts, words, text_size)
+    if len(buffer) < size:
+        raise ValueError('{} is truncated'.format(path))
+    view = memoryview(buffer)
+    arrays = dict()
+    for name, typecode, offset, length in sections:
+        arrays[name] = view[offset: offset + length * struct.calcsize(typecode)].cast(typecode)
+    return FrozenModel(arrays['keys'], arrays['offsets'], arrays['successors'], arrays['cum_counts'],
+                       window_size, base, end_symbol, Vocabulary(arrays['word_offsets'], arrays['text']),
+                       arrays['start_states'], arrays['start_cum_weights'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Снимок модели в одном файле, отображаемом в память')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export_parser = subparsers.add_parser('export', help='записать снимок модели из хранилища')
+    export_parser.add_argument('output', help='путь к файлу снимка')
+    export_parser.add_argument('--database', default='mydatabase', help='имя базы данных или sqlite:///путь')
+    export_parser.add_argument('--window-size', type=int, default=2)
+    generate_parser = subparsers.add_parser('generate', help='генерация предложений из снимка')
+    generate_parser.add_argument('snapshot', help='путь к файлу снимка')
+    generate_parser.add_argument('--count', type=int, default=1)
+    generate_parser.add_argument('--size', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        # Хранилище нужно только для записи снимка, генерация из снимка обходится без pymongo
+        from markov_chain import MarkovChain
+        print('EXPORTING A MODEL')
+        model = MarkovChain(args.database, args.window_size, cache_size=0).freeze()
+        size = write_snapshot(args.output, model)
+        print('EXPORTED {} STATES, {} BYTES'.format(len(model), size))
+    else:
+        started = time.perf_counter()
+        model = load_snapshot(args.snapshot)
+        print('LOADED {} STATES IN {:.1f} MS'.format(len(model), (time.perf_counter() - started) * 1000))
+        for sentence in model.generate_batch(args.count, args.size):
+            print(sentence)
+
+
+if __name__ == "__main__":
+    main()
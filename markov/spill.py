@@ -0,0 +1,197 @@
+import heapq
+import os
+import pickle
+import tempfile
+from operator import itemgetter
+from dictogram import Dictogram
+
+# Оценка памяти модели в Python: состояние с окном и распределением и каждый переход
+STATE_BYTES = 700
+TRANSITION_BYTES = 50
+
+
+def write_run(path, items, block_size=10000):
+    """
+    Запись отсортированных пар (окно, распределение) в файл блоками
+
+    :param path: путь к файлу
+    :type path: str
+    :param items: пары, отсортированные по окну
+    :type items: iterable
+    :param block_size: количество пар в одном блоке
+    :type block_size: int
+    :return: количество пар
+    :rtype: int
+    """
+    written = 0
+    block = list()
+    with open(path, 'wb') as file:
+        for window, value in items:
+            block.append((window, dict(value)))
+            if len(block) == block_size:
+                pickle.dump(block, file, pickle.HIGHEST_PROTOCOL)
+                written += len(block)
+                block = list()
+        if block:
+            pickle.dump(block, file, pickle.HIGHEST_PROTOCOL)
+            written += len(block)
+    return written
+
+
+def read_run(path):
+    """
+    Чтение пар (окно, распределение) из файла по блокам
+
+    :param path: путь к файлу
+    :type path: str
+    :return: генератор пар в порядке записи
+    :rtype: generator
+    """
+    with open(path, 'rb') as file:
+        while True:
+            try:
+                block = pickle.load(file)
+            except EOFError:
+                return
+            yield from block
+
+
+def merge_runs(runs):
+    """
+    K-путевое слияние отсортированных последовательностей пар, частоты одинаковых окон складываются.
+    Распределения входных последовательностей не изменяются
+
+    :param runs: последовательности пар, отсортированных по окну
+    :type runs: list
+    :return: генератор пар, отсортированных по окну, каждое окно один раз
+    :rtype: generator
+    """
+    window, value, copied = None, None, False
+    for key, distribution in heapq.merge(*runs, key=itemgetter(0)):
+        if key != window:
+            if window is not None:
+                yield window, value
+            window, value, copied = key, distribution, False
+            continue
+        if not copied:
+            value, copied = dict(value), True
+        for successor, count in distribution.items():
+            value[successor] = value.get(successor, 0) + count
+    if window is not None:
+        yield window, value
+
+
+class SpillingModel(dict):
+    """
+    Модель цепи Маркова с ограничением памяти: при превышении бюджета состояния сбрасываются
+    на диск отсортированным файлом и модель очищается. Итог - слияние файлов и остатка в памяти
+    в один отсортированный поток, который записывается в хранилище без сборки модели целиком.
+    Переходы добавляются частичными моделями через 'merge', который ведет счетчик переходов в памяти
+    """
+    def __init__(self, memory_budget, directory=None, fan_in=64):
+        """
+
+        :param memory_budget: бюджет памяти модели в байтах
+        :type memory_budget: int
+        :param directory: каталог временных файлов, None - системный
+        :type directory: str, optional
+        :param fan_in: количество файлов, после которого они сливаются в один
+        :type fan_in: int
+        """
+        super().__init__()
+        self.memory_budget = memory_budget
+        self.fan_in = fan_in
+        # Каталог удаляется вместе с объектом или при 'close'
+        self.directory = tempfile.TemporaryDirectory(prefix='markov-spill-', dir=directory)
+        self.runs = list()
+        self.spilled = 0
+        # Количество переходов в памяти, чтобы оценка памяти не перебирала все состояния
+        self.transitions = 0
+
+    def merge(self, items):
+        """
+        Добавление переходов частичной модели с учетом новых переходов в оценке памяти
+
+        :param items: пары (окно, распределение)
+        :type items: iterable
+        :return: объединенная модель
+        :rtype: class spill.SpillingModel
+        """
+        for window, value in items:
+            dictogram = self.get(window)
+            if dictogram is None:
+                if not isinstance(value, Dictogram):
+                    value = Dictogram.from_counts(list(value), list(value.values()))
+                self[window] = value
+                self.transitions += len(value)
+            else:
+                size = len(dictogram)
+                dictogram.add_counts(value)
+                self.transitions += len(dictogram) - size
+        return self
+
+    def nbytes(self):
+        """
+        Оценка памяти состояний в памяти
+
+        :return: размер в байтах
+        :rtype: int
+        """
+        return len(self) * STATE_BYTES + self.transitions * TRANSITION_BYTES
+
+    def maybe_spill(self, reserve=0):
+        """
+        Сброс на диск, если бюджет памяти превышен или будет превышен следующей порцией
+
+        :param reserve: наибольший прирост оценки памяти до следующей проверки
+        :type reserve: int
+        :return: был ли сброс
+        :rtype: bool
+        """
+        if self.nbytes() + reserve <= self.memory_budget:
+            return False
+        self.spill()
+        return True
+
+    def new_run_path(self):
+        """
+        Путь к следующему файлу
+
+        :rtype: str
+        """
+        return os.path.join(self.directory.name, 'run-{}'.format(self.spilled))
+
+    def spill(self):
+        """
+        Запись состояний в памяти отсортированным файлом и очистка модели
+        """
+        path = self.new_run_path()
+        self.spilled += 1
+        write_run(path, sorted(self.items(), key=itemgetter(0)))
+        self.clear()
+        self.transitions = 0
+        self.runs.append(path)
+        if len(self.runs) >= self.fan_in:
+            # Слишком много одновременно открытых файлов при слиянии - сливаем накопленные в один
+            path = self.new_run_path()
+            self.spilled += 1
+            write_run(path, merge_runs([read_run(run) for run in self.runs]))
+            for run in self.runs:
+                os.remove(run)
+            self.runs = [path]
+
+    def sorted_items(self):
+        """
+        Слияние файлов и состояний в памяти
+
+        :return: генератор пар (окно, распределение), отсортированных по окну
+        :rtype: generator
+        """
+        return merge_runs([read_run(run) for run in self.runs] + [sorted(self.items(), key=itemgetter(0))])
+
+    def close(self):
+        """
+        Удаление временных файлов
+        """
+        self.runs = list()
+        self.directory.cleanup()
@@ -0,0 +1,1301 @@
+import sqlite3
+import struct
+import threading
+import bson
+import pymongo
+from pymongo.errors import BulkWriteError
+from pymongo.write_concern import WriteConcern
+from counter import Counter
+from dictogram import FrozenDictogram
+
+
+def encode_key(window):
+    """
+    Ключ состояния в хранилище
+
+    :param window: окно
+    :type window: tuple
+    :return: индексы окна через пробел
+    :rtype: str
+    """
+    return ' '.join(map(str, window))
+
+
+def decode_key(key):
+    """
+    Окно по ключу состояния в хранилище
+
+    :param key: индексы окна через пробел
+    :type key: str
+    :return: окно
+    :rtype: tuple
+    """
+    return tuple(map(int, key.split()))
+
+
+def duplicate_key_errors(error):
+    """
+    Номера операций пакета, не выполненных из-за одновременной вставки документа с тем же ключом
+
+    :param error: ошибка пакетной записи
+    :type error: pymongo.errors.BulkWriteError
+    :return: номера операций или None, если есть ошибки другого рода
+    :rtype: list
+    """
+    errors = error.details.get('writeErrors', [])
+    if any(item['code'] != 11000 for item in errors):
+        return None
+    return [item['index'] for item in errors]
+
+
+def bulk_write(collection, requests, attempts=10):
+    """
+    Пакетная запись без порядка. Из одновременных upsert одного ключа один вставляет документ,
+    остальные получают ошибку дубликата ключа; такие операции повторяются и находят документ
+
+    :param collection: коллекция
+    :type collection: pymongo.collection.Collection
+    :param requests: операции записи
+    :type requests: list
+    :param attempts: количество попыток
+    :type attempts: int
+    """
+    for attempt in range(attempts):
+        try:
+            collection.bulk_write(requests, ordered=False)
+            return
+        except BulkWriteError as error:
+            failed = duplicate_key_errors(error)
+            if failed is None or attempt == attempts - 1:
+                raise
+            requests = [requests[i] for i in failed]
+
+
+def bulk_write_once(collection, updates, delta_id, attempts=10):
+    """
+    Пакетная запись увеличений, которая выполняется для документа не больше одного раза на дообучение.
+    Документ отмечается идентификатором дообучения в поле 'deltas' тем же запросом, что и увеличение,
+    отмеченные документы не изменяются: повтор пакета после сбоя пропускает уже увеличенные документы.
+    Upsert отмеченного документа упирается в уникальный ключ; такие документы пропускаются,
+    а вставленные одновременно другим запросом - перечитываются и увеличиваются повторно
+
+    :param collection: коллекция с уникальным полем 'key'
+    :type collection: pymongo.collection.Collection
+    :param updates: пары (ключ документа, обновление)
+    :type updates: list
+    :param delta_id: идентификатор дообучения
+    :type delta_id: str
+    :param attempts: количество попыток
+    :type attempts: int
+    """
+    for attempt in range(attempts):
+        if not updates:
+            return
+        try:
+            collection.bulk_write([pymongo.UpdateOne({'key': key, 'deltas': {'$ne': delta_id}},
+                                                     dict(update, **{'$addToSet': {'deltas': delta_id}}), upsert=True)
+                                   for key, update in updates], ordered=False)
+            return
+        except BulkWriteError as error:
+            failed = duplicate_key_errors(error)
+            if failed is None or attempt == attempts - 1:
+                raise
+            updates = [updates[i] for i in failed]
+            applied = {document['key'] for document in collection.find(
+                {'key': {'$in': [key for key, _ in updates]}, 'deltas': delta_id}, {'key': 1})}
+            updates = [(key, update) for key, update in updates if key not in applied]
+
+
+class Storage:
+    """
+    Базовое хранилище модели, токенизатора и счетчиков.
+    Окна - кортежи индексов, распределения - словари {индекс: частота}
+    """
+    counter = None
+    # Можно ли записывать состояния из нескольких потоков одновременно
+    concurrent_writes = False
+
+    def create_indexes(self):
+        """
+        Создание индексов модели и токенизатора
+        """
+        raise NotImplementedError
+
+    def create_token_indexes(self):
+        """
+        Создание индексов токенизатора
+        """
+        raise NotImplementedError
+
+    def is_empty(self):
+        """
+        Нет ли в модели ни одного состояния
+
+        :rtype: bool
+        """
+        raise NotImplementedError
+
+    def insert_states(self, rows):
+        """
+        Запись пакета новых состояний, которых еще нет в модели
+
+        :param rows: тройки (окно, распределение, является ли началом)
+        :type rows: list
+        """
+        raise NotImplementedError
+
+    def increment_states(self, rows):
+        """
+        Увеличение частот переходов пакетом
+
+        :param rows: тройки (окно, {индекс: частота}, является ли окно началом предложения)
+        :type rows: list
+        """
+        raise NotImplementedError
+
+    def find_state(self, window):
+        """
+        Распределение состояния
+
+        :param window: окно
+        :type window: tuple
+        :return: распределение или None
+        :rtype: dict
+        """
+        raise NotImplementedError
+
+    def find_states(self, windows):
+        """
+        Распределения нескольких состояний одним запросом
+
+        :param windows: окна
+        :type windows: list
+        :return: распределения найденных состояний по окнам
+        :rtype: dict
+        """
+        raise NotImplementedError
+
+    def find_distributions(self, windows):
+        """
+        Распределения нескольких состояний, готовые для выборки
+
+        :param windows: окна
+        :type windows: list
+        :return: распределения найденных состояний по окнам
+        :rtype: dict
+        """
+        return {window: FrozenDictogram(value) for window, value in self.find_states(windows).items()}
+
+    def sample_starts(self, size):
+        """
+        Случайные состояния начала предложения
+
+        :param size: количество состояний
+        :type size: int
+        :return: пары (окно, распределение)
+        :rtype: list
+        """
+        raise NotImplementedError
+
+    def increment_starts(self, rows):
+        """
+        Увеличение частот в индексе начал предложений
+
+        :param rows: пары (окно, частота)
+        :type rows: list
+        """
+        raise NotImplementedError
+
+    def iter_starts(self):
+        """
+        Перебор индекса начал предложений
+
+        :return: пары (окно, частота)
+        :rtype: generator
+        """
+        raise NotImplementedError
+
+    def top_states(self, n):
+        """
+        Самые частые состояния
+
+        :param n: количество состояний
+        :type n: int
+        :return: пары (окно, распределение)
+        :rtype: list
+        """
+        raise NotImplementedError
+
+    def iter_states(self):
+        """
+        Перебор всех состояний
+
+        :return: пары (окно, распределение)
+        :rtype: generator
+        """
+        raise NotImplementedError
+
+    def count_states(self):
+        """
+        Количество состояний
+
+        :rtype: int
+        """
+        raise NotImplementedError
+
+    def append_delta(self, entry, rows):
+        """
+        Запись дообучения в журнал: сначала переходы, затем запись журнала,
+        поэтому запись журнала существует только с полным набором переходов
+
+        :param entry: запись журнала: 'id', 'source', 'timestamp', 'window_size', 'states', 'transitions'
+        :type entry: dict
+        :param rows: тройки (окно, распределение, является ли началом)
+        :type rows: iterable
+        """
+        raise NotImplementedError
+
+    def find_delta(self, delta_id):
+        """
+        Запись журнала дообучений
+
+        :param delta_id: идентификатор дообучения
+        :type delta_id: str
+        :return: запись журнала с полями 'applied' и 'batches' - диапазоны окон (первое, последнее)
+            уже примененных пакетов, или None
+        :rtype: dict
+        """
+        raise NotImplementedError
+
+    def iter_deltas(self):
+        """
+        Перебор журнала дообучений в порядке записи
+
+        :return: записи журнала
+        :rtype: generator
+        """
+        raise NotImplementedError
+
+    def iter_delta_rows(self, delta_id):
+        """
+        Перебор переходов дообучения из журнала
+
+        :param delta_id: идентификатор дообучения
+        :type delta_id: str
+        :return: тройки (окно, распределение, является ли началом)
+        :rtype: generator
+        """
+        raise NotImplementedError
+
+    def mark_delta_batch(self, delta_id, first, last):
+        """
+        Отметка пакета дообучения примененным
+
+        :param delta_id: идентификатор дообучения
+        :type delta_id: str
+        :param first: первое окно пакета
+        :type first: tuple
+        :param last: последнее окно пакета
+        :type last: tuple
+        """
+        raise NotImplementedError
+
+    def apply_delta_batch(self, delta_id, rows):
+        """
+        Увеличение частот пакета дообучения и начал предложений с отметкой пакета в журнале.
+        Повторное применение дообучения после сбоя пропускает отмеченные пакеты
+
+        :param delta_id: идентификатор дообучения
+        :type delta_id: str
+        :param rows: тройки (окно, распределение, является ли началом), отсортированные по окну
+        :type rows: list
+        """
+        self.increment_states(rows)
+        self.increment_starts([(window, sum(value.values())) for window, value, start in rows if start])
+        self.mark_delta_batch(delta_id, rows[0][0], rows[-1][0])
+
+    def model_version(self):
+        """
+        Версия модели: увеличивается при каждом изменении модели дообучением или сжатием
+
+        :return: версия, 0 - модель не изменялась
+        :rtype: int
+        """
+        raise NotImplementedError
+
+    def bump_model_version(self):
+        """
+        Увеличение версии модели
+
+        :return: новая версия
+        :rtype: int
+        """
+        raise NotImplementedError
+
+    def mark_delta_applied(self, delta_id):
+        """
+        Отметка о применении дообучения к модели
+
+        :param delta_id: идентификатор дообучения
+        :type delta_id: str
+        """
+        raise NotImplementedError
+
+    def insert_tokens(self, pairs):
+        """
+        Запись токенизатора
+
+        :param pairs: пары (индекс, слово)
+        :type pairs: list
+        """
+        raise NotImplementedError
+
+    def add_tokens(self, pairs):
+        """
+        Добавление слов, которых еще нет в токенизаторе
+
+        :param pairs: пары (индекс, слово)
+        :type pairs: list
+        """
+        raise NotImplementedError
+
+    def find_idxs(self, words):
+        """
+        Индексы слов
+
+        :param words: уникальные слова
+        :type words: list
+        :return: словарь {слово: индекс} для найденных слов
+        :rtype: dict
+        """
+        raise NotImplementedError
+
+    def find_words(self, idxs):
+        """
+        Слова по индексам
+
+        :param idxs: уникальные индексы
+        :type idxs: list
+        :return: словарь {индекс: слово} для найденных индексов
+        :rtype: dict
+        """
+        raise NotImplementedError
+
+    def iter_tokens(self):
+        """
+        Перебор токенизатора
+
+        :return: пары (индекс, слово)
+        :rtype: generator
+        """
+        raise NotImplementedError
+
+    def replace_states(self, rows):
+        """
+        Замена распределений существующих состояний. Частота начала предложения заменяется
+        суммой нового распределения, окна, не являющиеся началом, удаляются из индекса начал
+
+        :param rows: тройки (окно, распределение, является ли началом)
+        :type rows: list
+        """
+        raise NotImplementedError
+
+    def delete_states(self, windows):
+        """
+        Удаление состояний вместе с их записями в индексе начал
+
+        :param windows: окна
+        :type windows: list
+        """
+        raise NotImplementedError
+
+    def delete_tokens(self, idxs):
+        """
+        Удаление слов из токенизатора
+
+        :param idxs: индексы
+        :type idxs: list
+        """
+        raise NotImplementedError
+
+    def rebuild_indexes(self):
+        """
+        Перестроение индексов и освобождение места после удалений
+        """
+        raise NotImplementedError
+
+    def state_nbytes(self, window, value, start):
+        """
+        Размер состояния в хранилище
+
+        :param window: окно
+        :type window: tuple
+        :param value: распределение
+        :type value: dict
+        :param start: является ли состояние началом предложения
+        :type start: bool
+        :return: размер в байтах
+        :rtype: int
+        """
+        raise NotImplementedError
+
+
+class MongoStorage(Storage):
+    """
+    Хранилище в MongoDB: коллекции 'model', 'model_starts', 'tokens', 'counter'
+    и журнал дообучений 'deltas' с переходами в 'delta_rows'
+    """
+    key_field = 'key'
+    concurrent_writes = True
+
+    def __init__(self, database, event_listeners=None, batch_size=50000, write_concern=None):
+        """
+
+        :param database: имя базы данных на локальном сервере или база данных pymongo
+        :param event_listeners: обработчики событий pymongo для нового клиента
+        :type event_listeners: list, optional
+        :param batch_size: количество ключей в одном запросе '$in'
+        :type batch_size: int
+        :param write_concern: подтверждение записи модели, например 1, 0 или 'majority'; None - по умолчанию
+        :type write_concern: int, str, optional
+        """
+        if type(database) == str:
+            client = pymongo.MongoClient("mongodb://localhost:27017/", event_listeners=event_listeners or [])
+            self.db = client[database]
+        else:
+            self.db = database
+        self.write_concern = None if write_concern is None else WriteConcern(w=write_concern)
+        self.model = self.collection('model')
+        self.starts = self.collection('model_starts')
+        self.tokens = self.db['tokens']
+        self.deltas = self.db['deltas']
+        self.delta_rows = self.db['delta_rows']
+        self.counter = Counter(self.db)
+        self.batch_size = batch_size
+
+    def collection(self, name):
+        """
+        Коллекция модели с заданным подтверждением записи
+
+        :param name: имя коллекции
+        :type name: str
+        :return: коллекция
+        """
+        return self.db.get_collection(name, write_concern=self.write_concern)
+
+    def create_indexes(self):
+        self.model.create_index([('key', pymongo.ASCENDING)], name='keys', unique=True)
+        self.starts.create_index([('key', pymongo.ASCENDING)], name='keys', unique=True)
+        self.create_delta_indexes()
+        self.create_token_indexes()
+
+    def create_delta_indexes(self):
+        """
+        Индексы журнала дообучений и отметок применяемых дообучений в документах модели
+        """
+        self.delta_rows.create_index([('delta', pymongo.ASCENDING)], name='deltas')
+        self.model.create_index([('deltas', pymongo.ASCENDING)], name='applying', sparse=True)
+        self.starts.create_index([('deltas', pymongo.ASCENDING)], name='applying', sparse=True)
+
+    def create_token_indexes(self):
+        self.tokens.create_index([('idx', pymongo.ASCENDING)], name='idx2word', unique=True)
+        self.tokens.create_index([('word', pymongo.ASCENDING)], name='word2idx', unique=True)
+
+    def is_empty(self):
+        return self.model.find_one({}, {'_id': 1}) is None
+
+    @staticmethod
+    def encode_document(key, value, start):
+        """
+        Документ модели для новой записи
+
+        :param key: ключ документа
+        :param value: распределение {индекс: частота}
+        :type value: dict
+        :param start: является ли состояние началом предложения
+        :type start: bool
+        :return: документ
+        :rtype: dict
+        """
+        return {'key': key, 'value': {str(k): count for k, count in value.items()}, 'start': start}
+
+    def insert_states(self, rows):
+        if rows:
+            self.model.insert_many([self.encode_document(self.encode_key(window), value, start)
+                                    for window, value, start in rows], ordered=False)
+
+    def increment_states(self, rows, delta_id=None):
+        """
+        Увеличение частот переходов пакетом
+
+        :param rows: тройки (окно, {индекс: частота}, является ли окно началом предложения)
+        :type rows: list
+        :param delta_id: идентификатор дообучения: каждое состояние увеличивается им не больше одного раза
+        :type delta_id: str, optional
+        """
+        updates = list()
+        for window, value, start in rows:
+            increments = {'value.{}'.format(k): val for k, val in value.items()}
+            if start:
+                updates.append((encode_key(window), {'$inc': increments, '$set': {'start': start}}))
+            else:
+                updates.append((encode_key(window), {'$inc': increments, '$setOnInsert': {'start': start}}))
+        if delta_id is not None:
+            bulk_write_once(self.model, updates, delta_id)
+        elif updates:
+            bulk_write(self.model, [pymongo.UpdateOne({'key': key}, update, upsert=True) for key, update in updates])
+
+    @staticmethod
+    def encode_key(window):
+        """
+        Ключ документа модели по окну
+
+        :param window: окно
+        :type window: tuple
+        :return: ключ документа
+        """
+        return encode_key(window)
+
+    @staticmethod
+    def decode_key(key):
+        """
+        Окно по ключу документа модели
+
+        :param key: ключ документа
+        :return: окно
+        :rtype: tuple
+        """
+        return decode_key(key)
+
+    @staticmethod
+    def decode_value(document):
+        """
+        Преобразование документа распределения из базы данных
+
+        :param document: документ модели, распределение с ключами-строками в поле 'value'
+        :type document: dict
+        :return: распределение с ключами-индексами
+        :rtype: dict
+        """
+        return {int(key): count for key, count in document['value'].items()}
+
+    def find_documents(self, windows):
+        """
+        Загрузка документов модели запросами '$in'
+
+        :param windows: окна
+        :type windows: list
+        :return: документы модели
+        :rtype: generator
+        """
+        keys = [self.encode_key(window) for window in windows]
+        for i in range(0, len(keys), self.batch_size):
+            yield from self.model.find({self.key_field: {'$in': keys[i: i + self.batch_size]}})
+
+    def find_state(self, window):
+        res = self.model.find_one({self.key_field: self.encode_key(window)})
+        return None if res is None else self.decode_value(res)
+
+    def find_states(self, windows):
+        return {self.decode_key(document[self.key_field]): self.decode_value(document)
+                for document in self.find_documents(windows)}
+
+    def sample_starts(self, size):
+        return [(self.decode_key(document[self.key_field]), self.decode_value(document))
+                for document in self.model.aggregate([{'$match': {'start': True}}, {'$sample': {'size': size}}])]
+
+    def increment_starts(self, rows, delta_id=None):
+        """
+        Увеличение частот в индексе начал предложений
+
+        :param rows: пары (окно, частота)
+        :type rows: list
+        :param delta_id: идентификатор дообучения: каждое начало увеличивается им не больше одного раза
+        :type delta_id: str, optional
+        """
+        updates = [(self.encode_key(window), {'$inc': {'count': count}}) for window, count in rows]
+        if delta_id is not None:
+            bulk_write_once(self.starts, updates, delta_id)
+        elif updates:
+            bulk_write(self.starts, [pymongo.UpdateOne({'key': key}, update, upsert=True) for key, update in updates])
+
+    def iter_starts(self):
+        for document in self.starts.find({}, {'_id': 0}):
+            yield self.decode_key(document['key']), document['count']
+
+    def top_states(self, n):
+        pipeline = [
+            {'$project': {'key': 1, 'value': 1, 'total': {'$sum': {'$map': {'input': {'$objectToArray': '$value'},
+                                                                            'as': 'item', 'in': '$$item.v'}}}}},
+            {'$sort': {'total': -1}},
+            {'$limit': n},
+        ]
+        return [(self.decode_key(document[self.key_field]), self.decode_value(document))
+                for document in self.model.aggregate(pipeline, allowDiskUse=True)]
+
+    def iter_states(self):
+        for document in self.model.find({}, {'_id': 0, 'start': 0}):
+            yield self.decode_key(document[self.key_field]), self.decode_value(document)
+
+    def count_states(self):
+        return self.model.count_documents({})
+
+    def append_delta(self, entry, rows):
+        # Переходы из прерванной записи того же дообучения удаляются
+        self.delta_rows.delete_many({'delta': entry['id']})
+        res = list()
+        for window, value, start in rows:
+            res.append({'delta': entry['id'], 'key': encode_key(window),
+                        'value': {str(k): count for k, count in value.items()}, 'start': start})
+            if len(res) == self.batch_size:
+                self.delta_rows.insert_many(res, ordered=False)
+                res = list()
+        if res:
+            self.delta_rows.insert_many(res, ordered=False)
+        self.deltas.insert_one(dict(entry, _id=entry['id'], applied=False))
+
+    @staticmethod
+    def decode_delta(document):
+        """
+        Запись журнала дообучений из документа
+
+        :param document: документ журнала
+        :type document: dict
+        :return: запись журнала
+        :rtype: dict
+        """
+        document['batches'] = [(decode_key(first), decode_key(last)) for first, last in document.get('batches', [])]
+        return document
+
+    def find_delta(self, delta_id):
+        document = self.deltas.find_one({'_id': delta_id}, {'_id': 0})
+        return None if document is None else self.decode_delta(document)
+
+    def iter_deltas(self):
+        for document in self.deltas.find({}, {'_id': 0}).sort('timestamp', pymongo.ASCENDING):
+            yield self.decode_delta(document)
+
+    def iter_delta_rows(self, delta_id):
+        for document in self.delta_rows.find({'delta': delta_id}):
+            yield decode_key(document['key']), MongoStorage.decode_value(document), document['start']
+
+    def mark_delta_applied(self, delta_id):
+        # Все пакеты записаны и отмечены в журнале - отметки в документах больше не нужны
+        self.model.update_many({'deltas': delta_id}, {'$pull': {'deltas': delta_id}})
+        self.starts.update_many({'deltas': delta_id}, {'$pull': {'deltas': delta_id}})
+        self.deltas.update_one({'_id': delta_id}, {'$set': {'applied': True}})
+
+    def mark_delta_batch(self, delta_id, first, last):
+        self.deltas.update_one({'_id': delta_id}, {'$push': {'batches': [encode_key(first), encode_key(last)]}})
+
+    def apply_delta_batch(self, delta_id, rows):
+        # Без транзакций пакет и отметка о нем - разные запросы. Сбой между ними повторяет пакет,
+        # но документы, уже увеличенные этим дообучением, отмечены и повторно не увеличиваются
+        self.increment_states(rows, delta_id)
+        self.increment_starts([(window, sum(value.values())) for window, value, start in rows if start], delta_id)
+        self.mark_delta_batch(delta_id, rows[0][0], rows[-1][0])
+
+    def model_version(self):
+        document = self.db['counter'].find_one({'name': 'model_version'})
+        return 0 if document is None else document['last_id']
+
+    def bump_model_version(self):
+        document = self.db['counter'].find_one_and_update({'name': 'model_version'}, {'$inc': {'last_id': 1}},
+                                                          upsert=True, return_document=pymongo.ReturnDocument.AFTER)
+        return document['last_id']
+
+    def insert_tokens(self, pairs):
+        self.tokens.insert_many([{'idx': idx, 'word': word} for idx, word in pairs])
+
+    def add_tokens(self, pairs):
+        if pairs:
+            bulk_write(self.tokens, [pymongo.UpdateOne({'word': word}, {'$setOnInsert': {'idx': idx}}, upsert=True)
+                                     for idx, word in pairs])
+
+    def find_idxs(self, words):
+        res = dict()
+        for i in range(0, len(words), self.batch_size):
+            for pair in self.tokens.find({'word': {'$in': words[i: i + self.batch_size]}}, {'_id': 0}):
+                res[pair['word']] = pair['idx']
+        return res
+
+    def find_words(self, idxs):
+        res = dict()
+        for i in range(0, len(idxs), self.batch_size):
+            for pair in self.tokens.find({'idx': {'$in': idxs[i: i + self.batch_size]}}, {'_id': 0}):
+                res[pair['idx']] = pair['word']
+        return res
+
+    def iter_tokens(self):
+        for pair in self.tokens.find({}, {'_id': 0, 'idx': 1, 'word': 1}):
+            yield pair['idx'], pair['word']
+
+    def replace_states(self, rows):
+        res, starts = list(), list()
+        for window, value, start in rows:
+            key = self.encode_key(window)
+            res.append(pymongo.ReplaceOne({self.key_field: key}, self.encode_document(key, value, start)))
+            if start:
+                starts.append(pymongo.UpdateOne({'key': key}, {'$set': {'count': sum(value.values())}}, upsert=True))
+            else:
+                starts.append(pymongo.DeleteOne({'key': key}))
+        if res:
+            self.model.bulk_write(res, ordered=False)
+            self.starts.bulk_write(starts, ordered=False)
+
+    def delete_states(self, windows):
+        keys = [self.encode_key(window) for window in windows]
+        for i in range(0, len(keys), self.batch_size):
+            self.model.delete_many({self.key_field: {'$in': keys[i: i + self.batch_size]}})
+            self.starts.delete_many({'key': {'$in': keys[i: i + self.batch_size]}})
+
+    def delete_tokens(self, idxs):
+        for i in range(0, len(idxs), self.batch_size):
+            self.tokens.delete_many({'idx': {'$in': idxs[i: i + self.batch_size]}})
+
+    def rebuild_indexes(self):
+        for collection in (self.model, self.starts, self.tokens):
+            collection.drop_indexes()
+        self.create_indexes()
+
+    def state_nbytes(self, window, value, start):
+        return len(bson.encode(self.encode_document(self.encode_key(window), value, start)))
+
+
+class BinaryMongoStorage(MongoStorage):
+    """
+    Хранилище в MongoDB с компактной схемой модели (версия 2): ключ документа '_id' - окно
+    в виде двоичной строки 32-битных индексов, 'value' - упакованные параллельные массивы
+    следующих слов и накопленных частот, 'total' - сумма частот, 'start' - только у начал предложений
+    """
+    key_field = '_id'
+    schema = 2
+
+    def __init__(self, database, event_listeners=None, batch_size=50000, write_concern=None, collection='model'):
+        """
+
+        :param database: имя базы данных на локальном сервере или база данных pymongo
+        :param event_listeners: обработчики событий pymongo для нового клиента
+        :type event_listeners: list, optional
+        :param batch_size: количество ключей в одном запросе '$in'
+        :type batch_size: int
+        :param write_concern: подтверждение записи модели, например 1, 0 или 'majority'; None - по умолчанию
+        :type write_concern: int, str, optional
+        :param collection: имя коллекции модели
+        :type collection: str
+        """
+        super().__init__(database, event_listeners, batch_size, write_concern)
+        self.model = self.collection(collection)
+        self.starts = self.collection(collection + '_starts')
+
+    def create_indexes(self):
+        # Индекс по ключу не нужен: ключ хранится в '_id'
+        self.model.create_index([('total', pymongo.DESCENDING)], name='totals')
+        self.starts.create_index([('key', pymongo.ASCENDING)], name='keys', unique=True)
+        self.create_delta_indexes()
+        self.create_token_indexes()
+
+    @staticmethod
+    def encode_key(window):
+        # Старший байт первым: порядок двоичных ключей совпадает с порядком окон
+        return struct.pack('>{}I'.format(len(window)), *window)
+
+    @staticmethod
+    def decode_key(key):
+        return struct.unpack('>{}I'.format(len(key) // 4), key)
+
+    @staticmethod
+    def encode_document(key, value, start):
+        """
+        Документ модели в компактной схеме
+
+        :param key: двоичный ключ
+        :type key: bytes
+        :param value: распределение {индекс: частота}
+        :type value: dict
+        :param start: является ли состояние началом предложения
+        :type start: bool
+        :return: документ
+        :rtype: dict
+        """
+        cum_counts = list()
+        total = 0
+        for count in value.values():
+            total += count
+            cum_counts.append(total)
+        # Первый байт - ширина накопленной частоты: 4 байта, 8 только для очень частых состояний
+        width = 4 if total < 2 ** 32 else 8
+        packed = struct.pack('<B{0}I{0}{1}'.format(len(value), 'I' if width == 4 else 'Q'),
+                             width, *value.keys(), *cum_counts)
+        document = {'_id': key, 'value': packed, 'total': total}
+        if start:
+            document['start'] = True
+        return document
+
+    @staticmethod
+    def decode_arrays(document):
+        """
+        Распаковка параллельных массивов документа
+
+        :param document: документ модели
+        :type document: dict
+        :return: следующие слова и накопленные частоты
+        :rtype: tuple
+        """
+        packed = document['value']
+        width = packed[0]
+        n = (len(packed) - 1) // (4 + width)
+        return (struct.unpack_from('<{}I'.format(n), packed, 1),
+                struct.unpack_from('<{}{}'.format(n, 'I' if width == 4 else 'Q'), packed, 1 + 4 * n))
+
+    @classmethod
+    def decode_value(cls, document):
+        successors, cum_counts = cls.decode_arrays(document)
+        return dict(zip(successors, (b - a for a, b in zip((0,) + cum_counts, cum_counts))))
+
+    @classmethod
+    def decode_distribution(cls, document):
+        """
+        Распределение, готовое для выборки, прямо из упакованных массивов
+
+        :param document: документ модели
+        :type document: dict
+        :return: распределение
+        :rtype: class dictogram.FrozenDictogram
+        """
+        return FrozenDictogram.from_cumulative(*cls.decode_arrays(document))
+
+    def increment_states(self, rows, delta_id=None, attempts=100):
+        # Упакованные массивы нельзя увеличить на сервере: существующие состояния
+        # загружаются, объединяются локально и записываются целиком.
+        # Замена выполняется, только если 'total' не изменился с чтения; иначе upsert
+        # упирается в существующий '_id', и состояние перечитывается и объединяется заново.
+        # Отметки дообучений 'deltas' переносятся в новый документ, состояния с отметкой 'delta_id' пропускаются
+        for attempt in range(attempts):
+            existing = {bytes(document['_id']): document
+                        for document in self.find_documents([row[0] for row in rows])}
+            res, written = list(), list()
+            for row in rows:
+                window, value, start = row
+                key = self.encode_key(window)
+                document = existing.get(key)
+                total = 0
+                deltas = list()
+                if document is not None:
+                    deltas = document.get('deltas', [])
+                    if delta_id in deltas:
+                        continue
+                    merged = self.decode_value(document)
+                    for successor, count in value.items():
+                        merged[successor] = merged.get(successor, 0) + count
+                    value, start, total = merged, start or document.get('start', False), document['total']
+                new_document = self.encode_document(key, value, start)
+                if delta_id is not None:
+                    deltas = deltas + [delta_id]
+                if deltas:
+                    new_document['deltas'] = deltas
+                res.append(pymongo.ReplaceOne({'_id': key, 'total': total}, new_document, upsert=True))
+                written.append(row)
+            if not res:
+                return
+            try:
+                self.model.bulk_write(res, ordered=False)
+                return
+            except BulkWriteError as error:
+                failed = duplicate_key_errors(error)
+                if failed is None or attempt == attempts - 1:
+                    raise
+                rows = [written[i] for i in failed]
+
+    def find_distributions(self, windows):
+        return {self.decode_key(document['_id']): self.decode_distribution(document)
+                for document in self.find_documents(windows)}
+
+    def top_states(self, n):
+        return [(self.decode_key(document['_id']), self.decode_value(document))
+                for document in self.model.find().sort('total', pymongo.DESCENDING).limit(n)]
+
+    def iter_states(self):
+        for document in self.model.find({}, {'value': 1}):
+            yield self.decode_key(document['_id']), self.decode_value(document)
+
+
+def migrate_to_binary(database, source='model', target='model_binary', batch_size=10000):
+    """
+    Перенос модели из исходной схемы в компактную (версия 2) вместе с индексом начал предложений
+
+    :param database: база данных pymongo
+    :param source: коллекция модели в исходной схеме
+    :type source: str
+    :param target: коллекция для модели в компактной схеме
+    :type target: str
+    :param batch_size: количество документов в одной записи
+    :type batch_size: int
+    :return: количество документов и их суммарный размер в BSON до и после переноса
+    :rtype: dict
+    """
+    binary = BinaryMongoStorage(database, collection=target)
+    binary.create_indexes()
+    binary.starts.drop()
+    report = {'documents': 0, 'source_bytes': 0, 'target_bytes': 0}
+    res, starts = list(), list()
+    for document in database[source].find():
+        key = binary.encode_key(decode_key(document['key']))
+        new_document = binary.encode_document(key, MongoStorage.decode_value(document), document['start'])
+        report['documents'] += 1
+        report['source_bytes'] += len(bson.encode(document))
+        report['target_bytes'] += len(bson.encode(new_document))
+        res.append(pymongo.ReplaceOne({'_id': key}, new_document, upsert=True))
+        if document['start']:
+            starts.append((decode_key(document['key']), new_document['total']))
+        if len(res) == batch_size:
+            binary.model.bulk_write(res, ordered=False)
+            binary.increment_starts(starts)
+            res, starts = list(), list()
+    if res:
+        binary.model.bulk_write(res, ordered=False)
+        binary.increment_starts(starts)
+    report['reduction'] = 1 - report['target_bytes'] / max(report['source_bytes'], 1)
+    return report
+
+
+class SQLiteCounter:
+    """
+    Счетчик индексов в базе данных SQLite, повторяет интерфейс 'class counter.Counter'
+    """
+    def __init__(self, connection, lock=None):
+        """
+
+        :param connection: соединение с базой данных
+        :type connection: sqlite3.Connection
+        :param lock: блокировка транзакций записи соединения
+        :type lock: threading.RLock, optional
+        """
+        self.connection = connection
+        self.lock = lock if lock is not None else threading.RLock()
+
+    def initialize(self, collection_name, last_id: int = 0):
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO counter (name, last_id) VALUES (?, ?)',
+                                    (collection_name, last_id))
+
+    def update(self, collection_name):
+        with self.lock, self.connection:
+            # MAX с двумя аргументами возвращает NULL, если таблица пуста
+            self.connection.execute('UPDATE counter SET last_id = MAX(last_id, COALESCE((SELECT MAX(idx) FROM {}), '
+                                    'last_id)) WHERE name = ?'.format(collection_name), (collection_name,))
+
+    def increment(self, collection_name, increment_amount: int = 1):
+        with self.lock, self.connection:
+            self.connection.execute('UPDATE counter SET last_id = last_id + ? WHERE name = ?',
+                                    (increment_amount, collection_name))
+
+    def reserve(self, collection_name, amount):
+        with self.lock, self.connection:
+            self.connection.execute('UPDATE counter SET last_id = last_id + ? WHERE name = ?',
+                                    (amount, collection_name))
+            last_id = self.connection.execute('SELECT last_id FROM counter WHERE name = ?',
+                                              (collection_name,)).fetchone()[0]
+        return last_id - amount + 1
+
+    def release(self, collection_name, first_id, last_id):
+        with self.lock, self.connection:
+            cursor = self.connection.execute('UPDATE counter SET last_id = ? WHERE name = ? AND last_id = ?',
+                                             (first_id - 1, collection_name, last_id))
+        return cursor.rowcount == 1
+
+    def get(self, collection_name):
+        return self.connection.execute('SELECT last_id FROM counter WHERE name = ?', (collection_name,)).fetchone()[0]
+
+
+class SQLiteStorage(Storage):
+    """
+    Встроенное хранилище в файле SQLite: без сервера и сетевых запросов.
+    Переходы хранятся по строке на пару (состояние, следующее слово)
+    """
+    def __init__(self, path, batch_size=900):
+        """
+
+        :param path: путь к файлу базы данных, ':memory:' - база в памяти
+        :type path: str
+        :param batch_size: количество параметров в одном запросе 'IN'
+        :type batch_size: int
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        # Соединение общее для потоков записи: транзакции одного потока не должны фиксировать
+        # частично выполненные транзакции другого, поэтому выполняются по одной
+        self.lock = threading.RLock()
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS states (key TEXT PRIMARY KEY, start INTEGER NOT NULL)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS transitions (key TEXT NOT NULL, '
+                                    'successor INTEGER NOT NULL, count INTEGER NOT NULL, '
+                                    'PRIMARY KEY (key, successor)) WITHOUT ROWID')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS start_counts (key TEXT PRIMARY KEY, '
+                                    'count INTEGER NOT NULL)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS tokens (idx INTEGER PRIMARY KEY, '
+                                    'word TEXT NOT NULL UNIQUE)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS counter (name TEXT PRIMARY KEY, last_id INTEGER)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS deltas (id TEXT PRIMARY KEY, source TEXT, '
+                                    'timestamp REAL, window_size INTEGER, states INTEGER, transitions INTEGER, '
+                                    'applied INTEGER NOT NULL)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS delta_rows (delta TEXT NOT NULL, key TEXT NOT NULL, '
+                                    'successor INTEGER NOT NULL, count INTEGER NOT NULL, start INTEGER NOT NULL)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS delta_batches (delta TEXT NOT NULL, '
+                                    'first TEXT NOT NULL, last TEXT NOT NULL)')
+        self.counter = SQLiteCounter(self.connection, self.lock)
+
+    def create_indexes(self):
+        with self.lock, self.connection:
+            self.connection.execute('CREATE INDEX IF NOT EXISTS starts ON states (start)')
+
+    def create_token_indexes(self):
+        # Индексы токенизатора - ограничения таблицы 'tokens'
+        pass
+
+    def is_empty(self):
+        return self.connection.execute('SELECT 1 FROM states LIMIT 1').fetchone() is None
+
+    def insert_states(self, rows):
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT INTO states (key, start) VALUES (?, ?)',
+                                        ((encode_key(window), int(start)) for window, _, start in rows))
+            self.connection.executemany(
+                'INSERT INTO transitions (key, successor, count) VALUES (?, ?, ?)',
+                ((encode_key(window), successor, count)
+                 for window, value, _ in rows for successor, count in value.items()))
+
+    def increment_states(self, rows):
+        with self.lock, self.connection:
+            self.upsert_states(rows)
+
+    def upsert_states(self, rows):
+        """
+        Увеличение частот переходов пакетом в текущей транзакции, без ее фиксации
+
+        :param rows: тройки (окно, {индекс: частота}, является ли окно началом предложения)
+        :type rows: list
+        """
+        self.connection.executemany(
+            'INSERT INTO states (key, start) VALUES (?, ?) '
+            'ON CONFLICT (key) DO UPDATE SET start = MAX(start, excluded.start)',
+            ((encode_key(window), int(start)) for window, _, start in rows))
+        self.connection.executemany(
+            'INSERT INTO transitions (key, successor, count) VALUES (?, ?, ?) '
+            'ON CONFLICT (key, successor) DO UPDATE SET count = count + excluded.count',
+            ((encode_key(window), successor, count)
+             for window, value, _ in rows for successor, count in value.items()))
+
+    def select_states(self, keys):
+        """
+        Распределения состояний по ключам
+
+        :param keys: ключи состояний
+        :type keys: list
+        :return: распределения по окнам
+        :rtype: dict
+        """
+        res = dict()
+        for i in range(0, len(keys), self.batch_size):
+            batch = keys[i: i + self.batch_size]
+            query = 'SELECT key, successor, count FROM transitions WHERE key IN ({})'.format(
+                ', '.join('?' * len(batch)))
+            for key, successor, count in self.connection.execute(query, batch):
+                res.setdefault(decode_key(key), dict())[successor] = count
+        return res
+
+    def find_state(self, window):
+        res = dict(self.connection.execute('SELECT successor, count FROM transitions WHERE key = ?',
+                                           (encode_key(window),)))
+        return res or None
+
+    def find_states(self, windows):
+        return self.select_states([encode_key(window) for window in windows])
+
+    def sample_starts(self, size):
+        keys = [key for key, in self.connection.execute(
+            'SELECT key FROM states WHERE start = 1 ORDER BY RANDOM() LIMIT ?', (size,))]
+        return list(self.select_states(keys).items())
+
+    def increment_starts(self, rows):
+        with self.lock, self.connection:
+            self.upsert_starts(rows)
+
+    def upsert_starts(self, rows):
+        """
+        Увеличение частот начал предложений в текущей транзакции, без ее фиксации
+
+        :param rows: пары (окно, частота)
+        :type rows: list
+        """
+        self.connection.executemany(
+            'INSERT INTO start_counts (key, count) VALUES (?, ?) '
+            'ON CONFLICT (key) DO UPDATE SET count = count + excluded.count',
+            ((encode_key(window), count) for window, count in rows))
+
+    def iter_starts(self):
+        for key, count in self.connection.execute('SELECT key, count FROM start_counts'):
+            yield decode_key(key), count
+
+    def top_states(self, n):
+        keys = [key for key, in self.connection.execute(
+            'SELECT key FROM transitions GROUP BY key ORDER BY SUM(count) DESC LIMIT ?', (n,))]
+        return list(self.select_states(keys).items())
+
+    def iter_states(self):
+        window, value = None, None
+        query = 'SELECT key, successor, count FROM transitions ORDER BY key'
+        for key, successor, count in self.connection.execute(query):
+            key = decode_key(key)
+            if key != window:
+                if window is not None:
+                    yield window, value
+                window, value = key, dict()
+            value[successor] = count
+        if window is not None:
+            yield window, value
+
+    def count_states(self):
+        return self.connection.execute('SELECT COUNT(*) FROM states').fetchone()[0]
+
+    delta_columns = ('id', 'source', 'timestamp', 'window_size', 'states', 'transitions', 'applied')
+
+    def append_delta(self, entry, rows):
+        with self.lock, self.connection:
+            self.connection.execute('CREATE INDEX IF NOT EXISTS delta_keys ON delta_rows (delta)')
+            self.connection.execute('DELETE FROM delta_rows WHERE delta = ?', (entry['id'],))
+            self.connection.executemany(
+                'INSERT INTO delta_rows (delta, key, successor, count, start) VALUES (?, ?, ?, ?, ?)',
+                ((entry['id'], encode_key(window), successor, count, int(start))
+                 for window, value, start in rows for successor, count in value.items()))
+            self.connection.execute('INSERT INTO deltas ({}) VALUES (?, ?, ?, ?, ?, ?, 0)'.format(
+                ', '.join(self.delta_columns)), tuple(entry[column] for column in self.delta_columns[:-1]))
+
+    def decode_delta(self, res):
+        """
+        Запись журнала дообучений из строки таблицы и отметок примененных пакетов
+
+        :param res: строка таблицы 'deltas'
+        :type res: tuple
+        :return: запись журнала
+        :rtype: dict
+        """
+        batches = [(decode_key(first), decode_key(last)) for first, last in self.connection.execute(
+            'SELECT first, last FROM delta_batches WHERE delta = ?', (res[0],))]
+        return dict(zip(self.delta_columns, res), applied=bool(res[-1]), batches=batches)
+
+    def find_delta(self, delta_id):
+        res = self.connection.execute('SELECT {} FROM deltas WHERE id = ?'.format(', '.join(self.delta_columns)),
+                                      (delta_id,)).fetchone()
+        return None if res is None else self.decode_delta(res)
+
+    def iter_deltas(self):
+        query = 'SELECT {} FROM deltas ORDER BY timestamp'.format(', '.join(self.delta_columns))
+        for res in self.connection.execute(query).fetchall():
+            yield self.decode_delta(res)
+
+    def iter_delta_rows(self, delta_id):
+        window, value, start = None, None, None
+        query = 'SELECT key, successor, count, start FROM delta_rows WHERE delta = ? ORDER BY key'
+        for key, successor, count, is_start in self.connection.execute(query, (delta_id,)):
+            key = decode_key(key)
+            if key != window:
+                if window is not None:
+                    yield window, value, start
+                window, value, start = key, dict(), bool(is_start)
+            value[successor] = count
+        if window is not None:
+            yield window, value, start
+
+    def mark_delta_applied(self, delta_id):
+        with self.lock, self.connection:
+            self.connection.execute('UPDATE deltas SET applied = 1 WHERE id = ?', (delta_id,))
+
+    def mark_delta_batch(self, delta_id, first, last):
+        with self.lock, self.connection:
+            self.connection.execute('INSERT INTO delta_batches (delta, first, last) VALUES (?, ?, ?)',
+                                    (delta_id, encode_key(first), encode_key(last)))
+
+    def apply_delta_batch(self, delta_id, rows):
+        # Пакет и отметка о нем фиксируются одной транзакцией
+        with self.lock, self.connection:
+            self.upsert_states(rows)
+            self.upsert_starts([(window, sum(value.values())) for window, value, start in rows if start])
+            self.connection.execute('INSERT INTO delta_batches (delta, first, last) VALUES (?, ?, ?)',
+                                    (delta_id, encode_key(rows[0][0]), encode_key(rows[-1][0])))
+
+    def model_version(self):
+        res = self.connection.execute("SELECT last_id FROM counter WHERE name = 'model_version'").fetchone()
+        return 0 if res is None else res[0]
+
+    def bump_model_version(self):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT INTO counter (name, last_id) VALUES ('model_version', 1) "
+                                    "ON CONFLICT (name) DO UPDATE SET last_id = last_id + 1")
+        return self.model_version()
+
+    def insert_tokens(self, pairs):
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT INTO tokens (idx, word) VALUES (?, ?)', pairs)
+
+    def add_tokens(self, pairs):
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR IGNORE INTO tokens (idx, word) VALUES (?, ?)', pairs)
+
+    def find_idxs(self, words):
+        res = dict()
+        for i in range(0, len(words), self.batch_size):
+            batch = words[i: i + self.batch_size]
+            query = 'SELECT word, idx FROM tokens WHERE word IN ({})'.format(', '.join('?' * len(batch)))
+            res.update(self.connection.execute(query, batch))
+        return res
+
+    def find_words(self, idxs):
+        res = dict()
+        for i in range(0, len(idxs), self.batch_size):
+            batch = idxs[i: i + self.batch_size]
+            query = 'SELECT idx, word FROM tokens WHERE idx IN ({})'.format(', '.join('?' * len(batch)))
+            res.update(self.connection.execute(query, batch))
+        return res
+
+    def iter_tokens(self):
+        yield from self.connection.execute('SELECT idx, word FROM tokens')
+
+    def replace_states(self, rows):
+        with self.lock, self.connection:
+            self.connection.executemany('DELETE FROM transitions WHERE key = ?',
+                                        ((encode_key(window),) for window, _, _ in rows))
+            self.connection.executemany(
+                'INSERT INTO transitions (key, successor, count) VALUES (?, ?, ?)',
+                ((encode_key(window), successor, count)
+                 for window, value, _ in rows for successor, count in value.items()))
+            self.connection.executemany('UPDATE states SET start = ? WHERE key = ?',
+                                        ((int(start), encode_key(window)) for window, _, start in rows))
+            self.connection.executemany('DELETE FROM start_counts WHERE key = ?',
+                                        ((encode_key(window),) for window, _, start in rows if not start))
+            self.connection.executemany('INSERT OR REPLACE INTO start_counts (key, count) VALUES (?, ?)',
+                                        ((encode_key(window), sum(value.values()))
+                                         for window, value, start in rows if start))
+
+    def delete_states(self, windows):
+        keys = [(encode_key(window),) for window in windows]
+        with self.lock, self.connection:
+            for table in ('states', 'transitions', 'start_counts'):
+                self.connection.executemany('DELETE FROM {} WHERE key = ?'.format(table), keys)
+
+    def delete_tokens(self, idxs):
+        with self.lock, self.connection:
+            self.connection.executemany('DELETE FROM tokens WHERE idx = ?', ((idx,) for idx in idxs))
+
+    def rebuild_indexes(self):
+        with self.lock:
+            self.connection.execute('REINDEX')
+            self.connection.execute('VACUUM')
+
+    def state_nbytes(self, window, value, start):
+        # Оценка: ключ хранится в строке состояния и в каждой строке перехода
+        key = len(encode_key(window).encode('utf-8'))
+        return key + 2 + len(value) * (key + 16)
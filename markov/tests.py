@@ -1,7 +1,34 @@
+import asyncio
+import contextlib
+import gzip
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
 import unittest
 import pymongo
+from concurrent.futures import ThreadPoolExecutor
 
 from markov import MarkovGenerator
+from dictogram import Dictogram
+from training import count_transitions, count_transitions_multi, count_transitions_numpy, count_transitions_parallel, \
+    split_shards, merge_models
+from read_files import read_files, read_token_chunks, expand_paths
+from frozen_model import FrozenModel
+from storage import SQLiteStorage, MongoStorage, BinaryMongoStorage
+from service import GenerationService
+from compact import compact
+from snapshot import write_snapshot, load_snapshot
+from tokenizer import Tokenizer
+from corpus import prepare_corpus
+from counter import IdLease
+from instrumentation import Instrumentation, Progress
+from spill import SpillingModel, STATE_BYTES, TRANSITION_BYTES
+from packed_model import PackedModel, count_transitions_packed, pack_window, unpack_window
 
 
 class TrainTests_lol(unittest.TestCase):
@@ -67,8 +94,878 @@ class TrainTests_lol(unittest.TestCase):
 
         self.assertEqual(dual_manual_model, model)
 
+    def test_delta_resume(self):
+        for storage in (MongoStorage(self.db), BinaryMongoStorage(self.client['test_db_binary'])):
+            generator = MarkovGenerator(MarkovGenerator.TrainStrategy(database=storage,
+                                                                      text_path='test_texts/test.txt', window_size=2))
+            chain = generator.strategy.model
+            model, starts = dict(storage.iter_states()), dict(storage.iter_starts())
+            chain.log_delta('interrupted', 'test', model)
+            chain.save_batch_size = 2
+            mark_delta_batch = storage.mark_delta_batch
+
+            def interrupted(delta_id, first, last):
+                # Сбой после записи третьего пакета, до его отметки в журнале
+                if len(storage.find_delta(delta_id)['batches']) == 2:
+                    raise RuntimeError('interrupted')
+                mark_delta_batch(delta_id, first, last)
+
+            storage.mark_delta_batch = interrupted
+            with self.assertRaises(RuntimeError):
+                chain.apply_delta('interrupted')
+            del storage.mark_delta_batch
+            self.assertEqual(chain.replay_deltas(), 1)
+            doubled = {window: {successor: count * 2 for successor, count in value.items()}
+                       for window, value in model.items()}
+            self.assertEqual(dict(storage.iter_states()), doubled)
+            self.assertEqual(dict(storage.iter_starts()), {window: count * 2 for window, count in starts.items()})
+            # Отметки примененного дообучения удалены из документов
+            self.assertEqual(storage.model.count_documents({'deltas': 'interrupted'}), 0)
+            self.assertEqual(storage.starts.count_documents({'deltas': 'interrupted'}), 0)
+
+    def test_writers(self):
+        states = list()
+        for writers in (1, 4):
+            self.client.drop_database('test_db')
+            generator = MarkovGenerator(MarkovGenerator.TrainStrategy(database=self.db, text_path='test_texts/test.txt',
+                                                                      window_size=2, writers=writers))
+            chain = generator.strategy.model
+            # Повторная запись увеличивает частоты пакетами по диапазонам ключей
+            chain.save_batch_size = 2
+            chain.save_model(dict(chain.storage.iter_states()))
+            states.append((dict(chain.storage.iter_states()), dict(chain.storage.iter_starts())))
+        self.assertEqual(states[0], states[1])
+
+    def test_compact_starts(self):
+        for storage in (MongoStorage(self.db), BinaryMongoStorage(self.client['test_db_binary'])):
+            generator = MarkovGenerator(MarkovGenerator.TrainStrategy(database=storage, text_path='test_texts/test.txt',
+                                                                      window_size=2, min_window_size=1))
+            idxs = storage.find_idxs(['end', 'бои', 'у', 'и'])
+            start, back_off = (idxs['end'], idxs['бои']), (idxs['end'],)
+            storage.increment_states([(start, {idxs['у']: 2, idxs['и']: 1}, True),
+                                      (back_off, {idxs['бои']: 2, idxs['и']: 1}, False)])
+            storage.increment_starts([(start, 3)])
+
+            compact(generator.strategy.model, top_k=1, prune_tokens=False, dry_run=False, sentences=0)
+            self.assertEqual(dict(storage.iter_starts()), {start: 3})
+            self.assertEqual([window for window, _ in storage.sample_starts(10)], [start])
+
     def tearDown(self):
         self.client.drop_database('test_db')
+        self.client.drop_database('test_db_binary')
+
+
+class SQLiteStorageTests(unittest.TestCase):
+    def test_retrain(self):
+        storage = SQLiteStorage(':memory:')
+        MarkovGenerator(MarkovGenerator.TrainStrategy(database=storage, text_path='test_texts/test.txt', window_size=2))
+        retrain_generator = MarkovGenerator(MarkovGenerator.RetrainStrategy(database=storage,
+                                                                            text_path='test_texts/retrain_test',
+                                                                            window_size=2))
+
+        tokenizer = retrain_generator.strategy.tokenizer
+        model = dict()
+        for window, value in storage.iter_states():
+            line_key = ' '.join([tokenizer.idx2word(idx) for idx in window])
+            model[line_key] = {tokenizer.idx2word(key): count for key, count in value.items()}
+
+        self.assertEqual(len(model), 14)
+        self.assertEqual(model['германцев .'], {'end': 1})
+        self.assertEqual(model['сообщает afp'], {'.': 1})
+        self.assertEqual({' '.join(tokenizer.idx2word(idx) for idx in window) for window, _ in storage.sample_starts(10)},
+                         {'end бои', 'end об'})
+        self.assertEqual({' '.join(tokenizer.idx2word(idx) for idx in window): count
+                          for window, count in storage.iter_starts()}, {'end бои': 1, 'end об': 1})
+        self.assertEqual(storage.counter.get('tokens'), len(list(storage.iter_tokens())) - 1)
+
+    def test_back_off(self):
+        storage = SQLiteStorage(':memory:')
+        MarkovGenerator(MarkovGenerator.TrainStrategy(database=storage, text_path='test_texts/test.txt', window_size=3,
+                                                      min_window_size=1))
+        self.assertEqual({len(window) for window, _ in storage.iter_states()}, {1, 2, 3})
+        self.assertEqual(len(list(storage.iter_starts())), 1)
+
+        generator = MarkovGenerator(MarkovGenerator.GenerateStrategy(storage, 3, min_window_size=1))
+        model = generator.strategy.model
+        tokenizer = generator.strategy.tokenizer
+        unseen = (tokenizer.word2idx('германцев'), tokenizer.word2idx('бои'), tokenizer.word2idx('у'))
+        self.assertEqual(model.get_distribution(unseen).words, (tokenizer.word2idx('сопоцкина'),))
+        # Окно в конце текста - тупик без back-off
+        last = (tokenizer.word2idx('германцев'), tokenizer.word2idx('.'), tokenizer.word2idx('end'))
+        self.assertIsNone(MarkovGenerator(MarkovGenerator.GenerateStrategy(storage, 3)).strategy.model.get_distribution(
+            last))
+        self.assertEqual(model.get_distribution(last).words, (tokenizer.word2idx('бои'),))
+        self.assertEqual(len(generator.generate_sentences(2, 30)), 2)
+        self.assertEqual(len(generator.generate_sentences(2, 30, batched=True)), 2)
+
+    def test_writers(self):
+        states = list()
+        for writers in (1, 4):
+            storage = SQLiteStorage(':memory:')
+            # Записи SQLite сериализуются блокировкой соединения
+            storage.concurrent_writes = True
+            generator = MarkovGenerator(MarkovGenerator.TrainStrategy(database=storage, text_path='test_texts/test.txt',
+                                                                      window_size=2, writers=writers))
+            chain = generator.strategy.model
+            chain.save_batch_size = 2
+            chain.save_model(dict(storage.iter_states()))
+            states.append((dict(storage.iter_states()), dict(storage.iter_starts())))
+        self.assertEqual(states[0], states[1])
+        self.assertEqual({count for value in states[0][0].values() for count in value.values()}, {2})
+
+    def test_delta_log(self):
+        storage = SQLiteStorage(':memory:')
+        MarkovGenerator(MarkovGenerator.TrainStrategy(database=storage, text_path='test_texts/test.txt', window_size=2))
+        retrain_generator = MarkovGenerator(MarkovGenerator.RetrainStrategy(database=storage,
+                                                                            text_path='test_texts/retrain_test',
+                                                                            window_size=2))
+        # Повторное дообучение тем же текстом - ошибка, модель не изменяется
+        with self.assertRaisesRegex(ValueError, 'already applied'):
+            MarkovGenerator(MarkovGenerator.RetrainStrategy(database=storage, text_path='test_texts/retrain_test',
+                                                            window_size=2))
+        model = dict(storage.iter_states())
+        self.assertEqual(sum(sum(value.values()) for value in model.values()), 14)
+        entries = list(storage.iter_deltas())
+        self.assertEqual(len(entries), 1)
+        self.assertTrue(entries[0]['applied'])
+        self.assertEqual(entries[0]['transitions'], 5)
+
+        chain = retrain_generator.strategy.model
+        chain.log_delta('replayed', 'test', model)
+        self.assertEqual(chain.replay_deltas(), 1)
+        self.assertEqual(chain.replay_deltas(), 0)
+        doubled = {window: {successor: count * 2 for successor, count in value.items()}
+                   for window, value in model.items()}
+        self.assertEqual(dict(storage.iter_states()), doubled)
+
+    def test_delta_resume(self):
+        storage = SQLiteStorage(':memory:')
+        generator = MarkovGenerator(MarkovGenerator.TrainStrategy(database=storage, text_path='test_texts/test.txt',
+                                                                  window_size=2))
+        chain = generator.strategy.model
+        model, starts = dict(storage.iter_states()), dict(storage.iter_starts())
+        chain.log_delta('interrupted', 'test', model)
+        chain.save_batch_size = 2
+        apply_delta_batch = storage.apply_delta_batch
+
+        def interrupted(delta_id, rows):
+            # Сбой после двух записанных пакетов
+            if len(storage.find_delta(delta_id)['batches']) == 2:
+                raise RuntimeError('interrupted')
+            apply_delta_batch(delta_id, rows)
+
+        storage.apply_delta_batch = interrupted
+        with self.assertRaises(RuntimeError):
+            chain.apply_delta('interrupted')
+        del storage.apply_delta_batch
+        self.assertEqual(chain.replay_deltas(), 1)
+        doubled = {window: {successor: count * 2 for successor, count in value.items()} for window, value in model.items()}
+        self.assertEqual(dict(storage.iter_states()), doubled)
+        self.assertEqual(dict(storage.iter_starts()), {window: count * 2 for window, count in starts.items()})
+
+    def test_forced_retrain(self):
+        storage = SQLiteStorage(':memory:')
+        MarkovGenerator(MarkovGenerator.TrainStrategy(database=storage, text_path='test_texts/test.txt', window_size=2))
+        for force in (False, True):
+            MarkovGenerator(MarkovGenerator.RetrainStrategy(database=storage, text_path='test_texts/retrain_test',
+                                                            window_size=2, force=force))
+        with self.assertRaises(ValueError):
+            MarkovGenerator(MarkovGenerator.RetrainStrategy(database=storage, text_path='test_texts/retrain_test',
+                                                            window_size=2))
+        self.assertEqual(len(list(storage.iter_deltas())), 2)
+        self.assertEqual(sum(sum(value.values()) for _, value in storage.iter_states()), 19)
+
+    def test_cache_invalidation(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = 'sqlite:///' + os.path.join(directory, 'model.db')
+            MarkovGenerator(MarkovGenerator.TrainStrategy(database=path, text_path='test_texts/test.txt',
+                                                          window_size=2))
+            generator = MarkovGenerator(MarkovGenerator.GenerateStrategy(path, 2))
+            model = generator.strategy.model
+            model.version_interval = 0
+            generator.generate_sentences(1, 5)
+            self.assertGreater(len(model.cache), 0)
+            # Дообучение в другом экземпляре увеличивает версию модели в хранилище
+            MarkovGenerator(MarkovGenerator.RetrainStrategy(database=path, text_path='test_texts/retrain_test',
+                                                            window_size=2))
+            self.assertTrue(model.check_version())
+            self.assertEqual(len(model.cache), 0)
+            self.assertFalse(model.check_version())
+
+
+class IdLeaseTests(unittest.TestCase):
+    def test_lease(self):
+        counter = SQLiteStorage(':memory:').counter
+        counter.initialize('tokens', 10)
+        first, second = IdLease(counter, 5), IdLease(counter, 5)
+        self.assertEqual(first.reserve('tokens', 2), 11)
+        self.assertEqual(second.reserve('tokens', 3), 16)
+        self.assertEqual(first.reserve('tokens', 3), 13)
+        self.assertEqual(first.reserve('tokens', 7), 21)
+        first.release()
+        self.assertEqual(counter.get('tokens'), 27)
+        second.release()
+        self.assertEqual(counter.get('tokens'), 27)
+
+    def test_update_empty(self):
+        counter = SQLiteStorage(':memory:').counter
+        counter.initialize('tokens', 5)
+        counter.update('tokens')
+        self.assertEqual(counter.get('tokens'), 5)
+        self.assertEqual(counter.reserve('tokens', 2), 6)
+
+    def test_concurrent_writes(self):
+        storage = SQLiteStorage(':memory:')
+        rows = [((i, i + 1), {i: 1, i + 1: 2}, False) for i in range(200)]
+        jobs = [threading.Thread(target=lambda: [storage.increment_states(rows[i: i + 10])
+                                                 for i in range(0, len(rows), 10)]) for _ in range(4)]
+        for job in jobs:
+            job.start()
+        for job in jobs:
+            job.join()
+        expected = {window: {successor: count * 4 for successor, count in value.items()} for window, value, _ in rows}
+        self.assertEqual(dict(storage.iter_states()), expected)
+
+    def test_concurrent_retrain(self):
+        texts = ['test_texts/retrain_test', 'test_texts/test.txt']
+        with tempfile.TemporaryDirectory() as directory:
+            path = 'sqlite:///' + os.path.join(directory, 'model.db')
+            MarkovGenerator(MarkovGenerator.TrainStrategy(database=path, text_path='test_texts/test.txt',
+                                                          window_size=2))
+            jobs = [threading.Thread(target=lambda text=text: MarkovGenerator(MarkovGenerator.RetrainStrategy(
+                database=path, text_path=text, window_size=2))) for text in texts]
+            for job in jobs:
+                job.start()
+            for job in jobs:
+                job.join()
+            storage = SQLiteStorage(path[len('sqlite:///'):])
+            tokens = list(storage.iter_tokens())
+            self.assertEqual(len({idx for idx, _ in tokens}), len({word for _, word in tokens}))
+            total = sum(sum(value.values()) for _, value in storage.iter_states())
+            expected = sum(len(read_files(text).split()) - 2 for text in texts + ['test_texts/test.txt'])
+            self.assertEqual(total, expected)
+
+
+class TokenizerStrategyTests(unittest.TestCase):
+    def setUp(self):
+        self.storage = SQLiteStorage(':memory:')
+        self.storage.insert_tokens([(0, 'end'), (1, 'бои'), (2, 'у')])
+        self.storage.counter.initialize('tokens', 2)
+        self.queries = []
+        find_idxs = self.storage.find_idxs
+
+        def counted(words):
+            self.queries.append(list(words))
+            return find_idxs(words)
+
+        self.storage.find_idxs = counted
+
+    def test_update_many(self):
+        strategy = Tokenizer.LoadStrategy(self.storage)
+        words = ['Бои', 'у', 'сопоцкина', 'бои', 'и', 'Сопоцкина', 'друскеник', 'у', 'и']
+        res = strategy.update_many(words, self.storage.counter, batch_size=2)
+
+        # Повторы убраны с учетом регистра, порции не больше 'batch_size'
+        self.assertEqual(set(res), {'бои', 'у', 'сопоцкина', 'и', 'друскеник'})
+        self.assertTrue(all(len(query) <= 2 for query in self.queries))
+        self.assertEqual(sorted(self.queries[0]), ['бои', 'у'])
+        # Существующие слова сохраняют индексы, новые получают индексы подряд без пропусков
+        self.assertEqual((res['бои'], res['у']), (1, 2))
+        self.assertEqual(sorted(res[word] for word in ('сопоцкина', 'и', 'друскеник')), [3, 4, 5])
+        self.assertEqual(self.storage.counter.get('tokens'), 5)
+        self.assertEqual(dict(self.storage.iter_tokens()), dict([(0, 'end')] + [(idx, word) for word, idx in res.items()]))
+
+        # Повторное добавление не создает слов и не расходует индексы
+        del self.queries[:]
+        self.assertEqual(strategy.update_many(words, self.storage.counter, batch_size=2), res)
+        self.assertEqual(len(self.queries), 3)
+        self.assertEqual(self.storage.counter.get('tokens'), 5)
+        self.assertEqual(len(list(self.storage.iter_tokens())), 6)
+
+    def test_update_many_race(self):
+        strategy = Tokenizer.LoadStrategy(self.storage)
+        add_tokens = self.storage.add_tokens
+
+        def raced(pairs):
+            # Другой процесс успевает записать то же слово со своим индексом
+            add_tokens([(10, 'сопоцкина')])
+            add_tokens(pairs)
+
+        self.storage.add_tokens = raced
+        res = strategy.update_many(['сопоцкина', 'и'], self.storage.counter)
+        self.assertEqual(res['сопоцкина'], 10)
+        self.assertEqual(res, {word: idx for idx, word in self.storage.iter_tokens() if word in res})
+
+    def test_caching_strategy(self):
+        strategy = Tokenizer.CachingLoadStrategy(self.storage, cache_size=3)
+        word_queries = []
+        find_words = self.storage.find_words
+
+        def counted(idxs):
+            word_queries.append(list(idxs))
+            return find_words(idxs)
+
+        self.storage.find_words = counted
+        # Промахи загружаются одним запросом, повторы в списке не запрашиваются дважды
+        self.assertEqual(strategy.words_to_idx(['бои', 'у', 'бои']), [1, 2, 1])
+        self.assertEqual([sorted(query) for query in self.queries], [['бои', 'у']])
+        # Загруженные пары попадают в оба направления кэша, попадания не обращаются к хранилищу
+        self.assertEqual(strategy.idxs_to_words([2, 1, '2']), ['у', 'бои', 'у'])
+        self.assertEqual(strategy.word_to_idx('у'), 2)
+        self.assertEqual((len(self.queries), len(word_queries)), (1, 0))
+        self.assertEqual(strategy.idxs_to_words([0, 1]), ['end', 'бои'])
+        self.assertEqual(word_queries, [[0]])
+        self.assertEqual(strategy.word_to_idx('end'), 0)
+        self.assertEqual((len(self.queries), len(word_queries)), (1, 1))
+
+        # Запрашиваются только промахи, индексы новых слов сразу попадают в оба направления
+        res = strategy.update_many(['end', 'Сопоцкина', 'и', 'и'], self.storage.counter)
+        self.assertEqual(set(res), {'сопоцкина', 'и'})
+        self.assertEqual(sorted(self.queries[1]), ['и', 'сопоцкина'])
+        queries = (len(self.queries), len(word_queries))
+        self.assertEqual(strategy.idxs_to_words([res['и'], res['сопоцкина']]), ['и', 'сопоцкина'])
+        self.assertEqual(strategy.words_to_idx(['и', 'сопоцкина']), [res['и'], res['сопоцкина']])
+        self.assertEqual((len(self.queries), len(word_queries)), queries)
+
+        # После вытеснения направления кэша согласованы друг с другом и с хранилищем
+        tokens = dict(self.storage.iter_tokens())
+        self.assertEqual((len(strategy.word2idx), len(strategy.idx2word)), (3, 3))
+        for word, idx in strategy.word2idx.data.items():
+            self.assertEqual(tokens[idx], word)
+        for idx, word in strategy.idx2word.data.items():
+            self.assertEqual(tokens[idx], word)
+
+
+class CompactTests(unittest.TestCase):
+    def test_compact(self):
+        storage = SQLiteStorage(':memory:')
+        generator = MarkovGenerator(MarkovGenerator.TrainStrategy(database=storage, text_path='test_texts/test.txt',
+                                                                  window_size=2))
+        states = storage.count_states()
+
+        report = compact(generator.strategy.model, min_count=2, sentences=0)
+        self.assertEqual(report['states_removed'], states)
+        self.assertEqual(storage.count_states(), states)
+
+        compact(generator.strategy.model, top_k=1, dry_run=False, sentences=0)
+        self.assertTrue(all(len(value) == 1 for _, value in storage.iter_states()))
+        compact(generator.strategy.model, min_count=2, dry_run=False, sentences=0)
+        self.assertEqual(storage.count_states(), 0)
+        self.assertEqual([word for _, word in storage.iter_tokens()], ['end'])
+
+
+    def test_dry_run_version(self):
+        storage = SQLiteStorage(':memory:')
+        generator = MarkovGenerator(MarkovGenerator.TrainStrategy(database=storage, text_path='test_texts/test.txt',
+                                                                  window_size=2))
+        version = storage.model_version()
+        report = compact(generator.strategy.model, top_k=1, sentences=5)
+        self.assertIn('latency_before', report)
+        self.assertEqual(storage.model_version(), version)
+
+    def test_starts(self):
+        storage = SQLiteStorage(':memory:')
+        generator = MarkovGenerator(MarkovGenerator.TrainStrategy(database=storage, text_path='test_texts/test.txt',
+                                                                  window_size=2, min_window_size=1))
+        idxs = storage.find_idxs(['end', 'бои', 'у', 'и'])
+        start, back_off = (idxs['end'], idxs['бои']), (idxs['end'],)
+        storage.increment_states([(start, {idxs['у']: 2, idxs['и']: 1}, True),
+                                  (back_off, {idxs['бои']: 2, idxs['и']: 1}, False)])
+        storage.increment_starts([(start, 3)])
+
+        compact(generator.strategy.model, top_k=1, prune_tokens=False, dry_run=False, sentences=0)
+        self.assertEqual(storage.find_states([start, back_off]), {start: {idxs['у']: 3}, back_off: {idxs['бои']: 3}})
+        # Частота начала - сумма оставшихся переходов, окно отката не становится началом
+        self.assertEqual(dict(storage.iter_starts()), {start: 3})
+        self.assertEqual([window for window, _ in storage.sample_starts(10)], [start])
+
+
+class BinaryMongoStorageTests(unittest.TestCase):
+    def test_document(self):
+        key = BinaryMongoStorage.encode_key((3, 70000))
+        self.assertEqual(BinaryMongoStorage.decode_key(key), (3, 70000))
+        self.assertLess(key, BinaryMongoStorage.encode_key((4, 0)))
+
+        document = BinaryMongoStorage.encode_document(key, {5: 2, 1: 3}, True)
+        self.assertEqual(document['total'], 5)
+        self.assertTrue(document['start'])
+        self.assertEqual(BinaryMongoStorage.decode_value(document), {5: 2, 1: 3})
+        distribution = BinaryMongoStorage.decode_distribution(document)
+        self.assertEqual(distribution.words, (5, 1))
+        self.assertEqual(distribution.cum_weights, (2, 5))
+        self.assertNotIn('start', BinaryMongoStorage.encode_document(key, {5: 2}, False))
+
+        document = BinaryMongoStorage.encode_document(key, {5: 2 ** 32, 1: 1}, False)
+        self.assertEqual(BinaryMongoStorage.decode_value(document), {5: 2 ** 32, 1: 1})
+
+
+class BatchedGenerationTests(unittest.TestCase):
+    def setUp(self):
+        self.storage = SQLiteStorage(':memory:')
+        MarkovGenerator(MarkovGenerator.TrainStrategy(database=self.storage, text_path='test_texts/test.txt',
+                                                      window_size=2))
+        MarkovGenerator(MarkovGenerator.RetrainStrategy(database=self.storage, text_path='test_texts/retrain_test',
+                                                        window_size=2))
+        self.texts = [[word for word in read_files(path).lower().split() if word != 'end']
+                      for path in ('test_texts/test.txt', 'test_texts/retrain_test')]
+
+    def assertSentences(self, words):
+        # Сгенерированный текст - последовательность предложений корпуса, последнее может быть оборвано
+        i = 0
+        while i < len(words):
+            matches = [text for text in self.texts if words[i: i + len(text)] == text[: len(words) - i]]
+            self.assertTrue(matches, ' '.join(words))
+            i += len(matches[0])
+
+    def test_lengths(self):
+        generator = MarkovGenerator(MarkovGenerator.GenerateStrategy(self.storage, 2))
+        for length in (1, 5, 30):
+            sentences = generator.generate_sentences(7, length, batched=True)
+            self.assertEqual(len(sentences), 7)
+            for sentence in sentences:
+                self.assertTrue(sentence.endswith('\n' * 3))
+                words = sentence.split()
+                # Окно начала и 'length' шагов без символов конца; после тупика - два слова нового начала
+                self.assertIn(len(words), (length + 1, length + 2))
+                self.assertSentences(words)
+
+    def test_dead_ends(self):
+        chain = MarkovGenerator(MarkovGenerator.GenerateStrategy(self.storage, 2)).strategy.model
+        find_distributions = self.storage.find_distributions
+        queries = []
+
+        def counted(windows):
+            queries.append(windows)
+            return find_distributions(windows)
+
+        self.storage.find_distributions = counted
+        # Предложения разной длины упираются в тупик '. end' на разных шагах одного пакета
+        sentences = chain.generate_batch(20, 40)
+        self.assertEqual(len(sentences), 20)
+        for sentence in sentences:
+            words = sentence.split()
+            self.assertGreater(len(words), len(self.texts[0]))
+            self.assertSentences(words)
+        # Состояния корпуса уже в кэше: не больше одного запроса на шаг для всего пакета
+        del queries[:]
+        self.assertEqual(len(chain.generate_batch(20, 40)), 20)
+        self.assertLessEqual(len(queries), 40)
+
+
+class GenerationServiceTests(unittest.TestCase):
+    def test_concurrent_requests(self):
+        storage = SQLiteStorage(':memory:')
+        MarkovGenerator(MarkovGenerator.TrainStrategy(database=storage, text_path='test_texts/test.txt', window_size=2))
+        service = GenerationService(MarkovGenerator.GenerateStrategy(storage, 2), workers=2)
+
+        async def run():
+            await service.start()
+            return await asyncio.gather(*(service.handle(2, 5) for _ in range(20)))
+
+        responses = asyncio.run(run())
+        self.assertEqual({status for status, _ in responses}, {200})
+        self.assertTrue(all(len(body['sentences']) == 2 for _, body in responses))
+        stats = service.stats()
+        self.assertEqual(stats['completed'], 20)
+        self.assertGreater(stats['coalesced'], 0)
+
+    def test_dead_end(self):
+        storage = SQLiteStorage(':memory:')
+        MarkovGenerator(MarkovGenerator.TrainStrategy(database=storage, text_path='test_texts/test.txt', window_size=2))
+        service = GenerationService(MarkovGenerator.GenerateStrategy(storage, 2), workers=2)
+        words = [word for word in read_files('test_texts/test.txt').lower().split() if word != 'end']
+
+        async def run():
+            await service.start()
+            return await service.handle(5, len(words) * 3)
+
+        status, body = asyncio.run(run())
+        self.assertEqual(status, 200)
+        # Предложения длиннее текста продолжаются с нового начала после тупика в конце текста
+        for sentence in body['sentences']:
+            self.assertEqual(sentence.split(), (words * 4)[:len(sentence.split())])
+            self.assertGreater(len(sentence.split()), len(words) * 2)
+
+    def test_limits(self):
+        storage = SQLiteStorage(':memory:')
+        MarkovGenerator(MarkovGenerator.TrainStrategy(database=storage, text_path='test_texts/test.txt', window_size=2))
+        service = GenerationService(MarkovGenerator.GenerateStrategy(storage, 2), max_count=3, max_size=10)
+
+        async def run(count, size_sent):
+            await service.start()
+            return await service.handle(count, size_sent)
+
+        for count, size_sent in ((0, 5), (-1, 5), (4, 5), (1, 0), (1, -5), (1, 11), (10 ** 9, 10 ** 9)):
+            status, body = asyncio.run(run(count, size_sent))
+            self.assertEqual(status, 400)
+            self.assertIn('1..3', body['error'])
+        status, body = asyncio.run(run(3, 10))
+        self.assertEqual((status, len(body['sentences'])), (200, 3))
+        self.assertEqual(service.stats()['completed'], 1)
+
+
+class InstrumentationTests(unittest.TestCase):
+    @staticmethod
+    def event(command_name, reply, duration_micros=1500):
+        return types.SimpleNamespace(command_name=command_name, reply=reply, duration_micros=duration_micros)
+
+    def test_stage_timers(self):
+        instrumentation = Instrumentation()
+        for _ in range(2):
+            with instrumentation.stage('save') as stats:
+                time.sleep(0.01)
+                with instrumentation.stage('count'):
+                    self.assertEqual(instrumentation.current_stage(), 'count')
+                self.assertEqual(instrumentation.current_stage(), 'save')
+        self.assertEqual(instrumentation.current_stage(), 'other')
+        self.assertIs(stats, instrumentation.summary()['stages']['save'])
+        self.assertEqual(stats['calls'], 2)
+        self.assertGreaterEqual(stats['wall'], 0.02)
+        self.assertEqual(instrumentation.stages['count']['calls'], 2)
+        self.assertLess(instrumentation.stages['count']['wall'], stats['wall'])
+
+    def test_command_counters(self):
+        instrumentation = Instrumentation()
+        listener = instrumentation.listener
+        with instrumentation.stage('generate'):
+            listener.succeeded(self.event('find', {'cursor': {'firstBatch': [{}, {}, {}]}}))
+            listener.succeeded(self.event('getMore', {'cursor': {'nextBatch': [{}]}}))
+            listener.succeeded(self.event('update', {'n': 2, 'upserted': [{}]}))
+            listener.succeeded(self.event('findAndModify', {'value': None}))
+            listener.failed(self.event('find', {}))
+        listener.succeeded(self.event('insert', {'n': 5}))
+        stats = instrumentation.stages['generate']
+        self.assertEqual((stats['queries'], stats['documents'], stats['failed']), (5, 7, 1))
+        self.assertAlmostEqual(stats['db_latency'], 5 * 0.0015)
+        self.assertEqual(stats['commands'], {'find': 2, 'getMore': 1, 'update': 1, 'findAndModify': 1})
+        self.assertEqual(instrumentation.stages['other']['documents'], 5)
+
+    def test_thread_stages(self):
+        instrumentation = Instrumentation()
+        listener = instrumentation.listener
+        started, recorded = threading.Event(), threading.Event()
+
+        def worker():
+            # Поток без своего этапа не получает этап другого потока
+            started.wait()
+            listener.succeeded(self.event('find', {'n': 1}))
+            recorded.set()
+
+        thread = threading.Thread(target=worker)
+        thread.start()
+        with instrumentation.stage('save'):
+            started.set()
+            recorded.wait()
+            with ThreadPoolExecutor(4) as executor:
+                record = instrumentation.bind(lambda _: listener.succeeded(self.event('update', {'n': 1})))
+                list(executor.map(record, range(100)))
+        thread.join()
+        self.assertEqual(instrumentation.stages['other']['commands'], {'find': 1})
+        self.assertEqual(instrumentation.stages['save']['commands'], {'update': 100})
+        self.assertEqual(instrumentation.stages['save']['queries'], 100)
+
+    def test_progress_throttling(self):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            progress = Progress('saving', total=10, interval=3600, verbose=True)
+            for done in range(1, 11):
+                progress.update(done)
+        # До завершения вывод не чаще 'interval', последнее значение выводится всегда
+        self.assertEqual(output.getvalue().splitlines()[0].split(' (')[0], 'saving: 10/10')
+        self.assertEqual(len(output.getvalue().splitlines()), 1)
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            progress = Progress('saving', interval=0, verbose=True)
+            for done in range(1, 4):
+                progress.update(done)
+            Instrumentation(progress_interval=0).progress('quiet', 3).update(3)
+        self.assertEqual([line.split(' (')[0] for line in output.getvalue().splitlines()],
+                         ['saving: 1', 'saving: 2', 'saving: 3'])
+
+
+class FrozenDictogramTests(unittest.TestCase):
+    def test_counts(self):
+        frozen = Dictogram(['a', 'b', 'a', 'c', 'a']).freeze()
+
+        self.assertEqual(frozen.tokens, 5)
+        self.assertEqual(frozen.types, 3)
+        self.assertEqual(dict(frozen.items()), {'a': 3, 'b': 1, 'c': 1})
+        self.assertEqual(frozen.count('a'), 3)
+        self.assertEqual(frozen.count('d'), 0)
+
+    def test_sampling(self):
+        frozen = Dictogram(['a', 'b', 'b']).freeze()
+
+        self.assertIn(frozen.return_weighted_random_word(), {'a', 'b'})
+        words = frozen.return_weighted_random_words(1000)
+        self.assertEqual(len(words), 1000)
+        self.assertEqual(set(words), {'a', 'b'})
+        self.assertEqual(Dictogram(['x']).freeze().return_weighted_random_words(3), ['x', 'x', 'x'])
+
+
+class CountTransitionsTests(unittest.TestCase):
+    def test_numpy_engine(self):
+        data = [0, 1, 2, 1, 2, 3, 0, 1, 2, 0, 1, 3, 3, 3, 0]
+        for window_size in range(1, 5):
+            self.assertEqual(count_transitions(data, window_size), count_transitions_numpy(data, window_size))
+        self.assertEqual(count_transitions_numpy(data[:2], 2), dict())
+
+    def test_numpy_engine_large_ids(self):
+        data = [0, 2 ** 40, 5, 2 ** 40, 5, 0, 2 ** 40]
+        self.assertEqual(count_transitions(data, 2), count_transitions_numpy(data, 2))
+
+    def test_parallel(self):
+        data = [0, 1, 2, 1, 2, 3, 0, 1, 2, 0, 1, 3, 3, 3, 0]
+        for shards in range(1, 20):
+            self.assertEqual(sum(len(shard) - 2 for shard in split_shards(data, 2, shards)), len(data) - 2)
+        self.assertEqual(count_transitions(data, 2), count_transitions_parallel(data, 2, workers=3))
+        self.assertEqual(count_transitions(data, 3), count_transitions_parallel(data, 3, workers=2, engine='numpy'))
+
+    def test_multi_order(self):
+        data = [0, 1, 2, 1, 2, 3, 0, 1, 2, 0, 1, 3, 3, 3, 0]
+        model = dict()
+        for window_size in range(1, 4):
+            model.update(count_transitions(data, window_size))
+        self.assertEqual(count_transitions_multi(data, range(1, 4)), model)
+        # Слова до 'start' - только контекст: порция с перекрытием не учитывает их повторно
+        self.assertEqual(count_transitions_multi(data[7:], range(1, 4), count_transitions_multi(data[:10], range(1, 4)),
+                                                 start=3), model)
+
+
+class ReadTokenChunksTests(unittest.TestCase):
+    def test_chunks(self):
+        words = read_files('test_texts/test.txt').split()
+        for chunk_size in range(1, len(words) + 2):
+            chunks = list(read_token_chunks('test_texts/test.txt', chunk_size, block_size=7))
+            self.assertEqual(sum(chunks, []), words)
+
+            model = dict()
+            for chunk in read_token_chunks('test_texts/test.txt', chunk_size, overlap=2, block_size=7):
+                count_transitions(chunk, 2, model)
+            self.assertEqual(model, count_transitions(words, 2))
+
+
+class SpillingModelTests(unittest.TestCase):
+    def test_merge(self):
+        words = read_files('test_texts/test.txt').split()
+        model = SpillingModel(memory_budget=0, fan_in=3)
+        for i in range(0, len(words), 4):
+            count_transitions(words[i: i + 6], 2, model)
+            model.maybe_spill()
+        count_transitions(words[:3], 2, model)
+        self.assertLess(len(model.runs), 3)
+
+        merged = list(model.sorted_items())
+        expected = count_transitions(words, 2)
+        merge_models(expected, count_transitions(words[:3], 2))
+        self.assertEqual([window for window, _ in merged], sorted(expected))
+        self.assertEqual({window: dict(value) for window, value in merged},
+                         {window: dict(value) for window, value in expected.items()})
+        model.close()
+
+    def test_budget(self):
+        words = read_files('test_texts/test.txt').split() * 20
+        model = SpillingModel(memory_budget=6 * (STATE_BYTES + TRANSITION_BYTES))
+        chunk_size = 2
+        for i in range(0, len(words), chunk_size):
+            start = min(2, i)
+            merge_models(model, count_transitions(words[i - start: i + chunk_size], 2))
+            # Сброс до порции, которая могла бы превысить бюджет, держит оценку в пределах бюджета
+            self.assertLessEqual(model.nbytes(), model.memory_budget)
+            self.assertEqual(model.transitions, sum(map(len, model.values())))
+            model.maybe_spill(chunk_size * (STATE_BYTES + TRANSITION_BYTES))
+        self.assertGreater(len(model.runs), 0)
+        model.close()
+
+        strategy = MarkovGenerator.TrainStrategy(database=SQLiteStorage(':memory:'), text_path='test_texts/test.txt',
+                                                 window_size=2, memory_budget=10 * 2 * (STATE_BYTES + TRANSITION_BYTES))
+        self.assertEqual(strategy.chunk_size, 10)
+
+    def test_train(self):
+        storage, spilled_storage = SQLiteStorage(':memory:'), SQLiteStorage(':memory:')
+        MarkovGenerator(MarkovGenerator.TrainStrategy(database=storage, text_path='test_texts/test.txt', window_size=2))
+        MarkovGenerator(MarkovGenerator.TrainStrategy(database=spilled_storage, text_path='test_texts/test.txt',
+                                                      window_size=2, chunk_size=3, memory_budget=1))
+        self.assertEqual(sorted(spilled_storage.iter_states()), sorted(storage.iter_states()))
+        self.assertEqual(sorted(spilled_storage.iter_starts()), sorted(storage.iter_starts()))
+
+
+class PackedModelTests(unittest.TestCase):
+    def test_count(self):
+        words = read_files('test_texts/test.txt').split()
+        ids = dict()
+        data = [ids.setdefault(word, len(ids)) for word in words] * 3
+        for window_size in (1, 2, 3):
+            expected = count_transitions(data, window_size)
+            packed = count_transitions_packed(data, window_size)
+            self.assertEqual(len(packed), len(expected))
+            # Распакованные распределения совпадают вместе с порядком следующих слов
+            self.assertEqual([(window, list(value.items())) for window, value in packed.sorted_items()],
+                             [(window, list(expected[window].items())) for window in sorted(expected)])
+
+        expected = count_transitions_multi(data, [1, 2], start=5)
+        packed = PackedModel()
+        for window_size in (1, 2):
+            count_transitions_packed(data, window_size, packed, start=5)
+        self.assertEqual(dict(packed.sorted_items()), {window: dict(value) for window, value in expected.items()})
+        self.assertEqual(unpack_window(pack_window((0, 7, 2 ** 32 - 1))), (0, 7, 2 ** 32 - 1))
+
+    def test_large_counts(self):
+        # Частоты сверх 32 бит переводят распределение в словарь, в том числе при добавлении слова
+        packed = PackedModel()
+        for window, successors in (((0,), [(5, 2 ** 33), (6, 2 ** 32)]), ((1,), [(5, 1), (6, 2 ** 40)]),
+                                   ((2,), [(5, 1), (6, 1), (7, 2 ** 32), (6, 1)])):
+            for successor, count in successors:
+                packed.add(pack_window(window), successor, count)
+        self.assertEqual(dict(packed.sorted_items()), {(0,): {5: 2 ** 33, 6: 2 ** 32}, (1,): {5: 1, 6: 2 ** 40},
+                                                       (2,): {5: 1, 6: 2, 7: 2 ** 32}})
+
+    def test_train(self):
+        storage, packed_storage = SQLiteStorage(':memory:'), SQLiteStorage(':memory:')
+        MarkovGenerator(MarkovGenerator.TrainStrategy(database=storage, text_path='test_texts/test.txt', window_size=2))
+        MarkovGenerator(MarkovGenerator.TrainStrategy(database=packed_storage, text_path='test_texts/test.txt',
+                                                      window_size=2, engine='packed', chunk_size=3))
+        self.assertEqual(sorted(packed_storage.iter_states()), sorted(storage.iter_states()))
+        self.assertEqual(sorted(packed_storage.iter_starts()), sorted(storage.iter_starts()))
+
+
+class MultipleFilesTests(unittest.TestCase):
+    def test_directory(self):
+        texts = [read_files('test_texts/test.txt'), read_files('test_texts/retrain_test')]
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, 'a.txt'), 'w', encoding='utf-8') as file:
+                file.write(texts[0])
+            with gzip.open(os.path.join(directory, 'b.txt.gz'), 'wt', encoding='utf-8') as file:
+                file.write(texts[1])
+            self.assertEqual(len(expand_paths(os.path.join(directory, '*.txt*'))), 2)
+
+            # Файлы в пуле процессов, по очереди порциями и порциями с бюджетом памяти в упакованную модель
+            options = [{'workers': 2}, {'chunk_size': 3}, {'chunk_size': 3, 'memory_budget': 1, 'engine': 'packed'}]
+            storages = [SQLiteStorage(':memory:') for _ in options]
+            for storage, kwargs in zip(storages, options):
+                MarkovGenerator(MarkovGenerator.TrainStrategy(database=storage, text_path=directory, window_size=2,
+                                                              **kwargs))
+        # Окна на границе файлов не учитываются
+        expected = count_transitions(texts[0].lower().split(), 2)
+        merge_models(expected, count_transitions(texts[1].lower().split(), 2))
+        for storage in storages:
+            words = dict(storage.iter_tokens())
+            model = {tuple(words[idx] for idx in window): {words[idx]: count for idx, count in value.items()}
+                     for window, value in storage.iter_states()}
+            self.assertEqual(model, {window: dict(value) for window, value in expected.items()})
+
+
+class FrozenModelTests(unittest.TestCase):
+    def test_from_model(self):
+        data = [0, 1, 2, 1, 2, 3, 0, 1, 2, 0, 1, 3, 3, 3, 0, 2, 1]
+        model = count_transitions(data, 2)
+        frozen = FrozenModel.from_model(model, 2, end_symbol=0, vocabulary=['end', 'a', 'b', 'c'])
+
+        self.assertEqual(len(frozen), len(model))
+        for window, dictogram in model.items():
+            state = frozen.find(window)
+            start, end = frozen.offsets[state], frozen.offsets[state + 1]
+            self.assertEqual(frozen.cum_counts[end - 1], dictogram.tokens)
+            self.assertEqual(set(frozen.successors[start:end]), set(dictogram))
+            self.assertIn(frozen.sample(window), dictogram)
+        self.assertEqual(frozen.find((3, 2)), -1)
+        self.assertEqual({frozen.keys[state] // frozen.base for state in frozen.starts}, {0})
+
+        sentence = frozen.generate_random_sentence(5, frozen.generate_random_start_sequence())
+        self.assertEqual(len(sentence), 7)
+
+    def test_dead_end(self):
+        # У окна (1, 3) в конце данных нет продолжений
+        data = [0, 1, 2, 3, 0, 1, 2, 1, 3]
+        frozen = FrozenModel.from_model(count_transitions(data, 2), 2, end_symbol=0)
+        self.assertEqual(frozen.find((1, 3)), -1)
+        with self.assertRaises(KeyError):
+            frozen.sample((1, 3))
+        # Предложения длиннее данных продолжаются с нового начала после тупика
+        for _ in range(10):
+            sentence = frozen.generate_random_sentence(len(data) * 3, frozen.generate_random_start_sequence())
+            self.assertGreaterEqual(len(sentence), len(data) * 3 + 2)
+            self.assertLessEqual(set(sentence), set(data))
+
+    def test_no_starts(self):
+        frozen = FrozenModel.from_items([((1, 2), {3: 1}), ((2, 3), {1: 1})], 2, end_symbol=0)
+        with self.assertRaisesRegex(ValueError, 'no sentence starts'):
+            frozen.generate_random_start_sequence()
+
+    def test_from_storage_multi_order(self):
+        storage = SQLiteStorage(':memory:')
+        MarkovGenerator(MarkovGenerator.TrainStrategy(database=storage, text_path='test_texts/test.txt', window_size=3,
+                                                      min_window_size=1))
+        frozen = FrozenModel.from_storage(storage, 3)
+        # Окна размеров 1 и 2 не загружаются
+        self.assertEqual(len(frozen), sum(len(window) == 3 for window, _ in storage.iter_states()))
+        self.assertLess(len(frozen), storage.count_states())
+        words = read_files('test_texts/test.txt').lower().split()
+        self.assertLessEqual(set(frozen.generate(len(words) * 3).split()), set(words))
+
+
+class CorpusTests(unittest.TestCase):
+    def test_prepare(self):
+        tokenizer = Tokenizer(Tokenizer.GenerateNewStrategy('test_texts/test.txt'))
+        with tempfile.TemporaryDirectory() as directory:
+            corpus = prepare_corpus('test_texts/test.txt', directory)
+            self.assertEqual(corpus.words, tokenizer.strategy.idx2word)
+            self.assertEqual(list(corpus.tokens), tokenizer.text_to_int(read_files('test_texts/test.txt')))
+
+            cached = prepare_corpus('test_texts/test.txt', directory)
+            self.assertEqual(cached.words, corpus.words)
+            self.assertEqual(cached.tokens, corpus.tokens)
+            self.assertEqual(cached.digest, corpus.digest)
+
+    def test_train_from_corpus(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for window_size in (2, 3):
+                storage, cached_storage = SQLiteStorage(':memory:'), SQLiteStorage(':memory:')
+                MarkovGenerator(MarkovGenerator.TrainStrategy(database=storage, text_path='test_texts/test.txt',
+                                                              window_size=window_size))
+                MarkovGenerator(MarkovGenerator.TrainStrategy(database=cached_storage,
+                                                              text_path='test_texts/test.txt',
+                                                              window_size=window_size, corpus_cache=directory))
+                self.assertEqual(sorted(cached_storage.iter_states()), sorted(storage.iter_states()))
+            self.assertEqual(len(os.listdir(directory)), 2)
+
+
+class SnapshotTests(unittest.TestCase):
+    def test_round_trip(self):
+        data = [0, 1, 2, 1, 2, 3, 0, 1, 2, 0, 1, 3, 3, 3, 0, 2, 1]
+        frozen = FrozenModel.from_model(count_transitions(data, 2), 2, end_symbol=0,
+                                        vocabulary=['end', 'a', 'b', 'в'])
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'model.snap')
+            write_snapshot(path, frozen)
+            loaded = load_snapshot(path)
+
+            self.assertEqual(list(loaded.keys), list(frozen.keys))
+            self.assertEqual(list(loaded.offsets), list(frozen.offsets))
+            self.assertEqual(list(loaded.successors), list(frozen.successors))
+            self.assertEqual(list(loaded.cum_counts), list(frozen.cum_counts))
+            self.assertEqual([loaded.vocabulary[idx] for idx in range(4)], ['end', 'a', 'b', 'в'])
+            self.assertEqual(loaded.find((1, 2)), frozen.find((1, 2)))
+            self.assertEqual(loaded.find((3, 2)), -1)
+            self.assertEqual({loaded.keys[state] // loaded.base for state in loaded.start_states}, {0})
+            self.assertLessEqual(set(loaded.generate(5).split()), {'a', 'b', 'в'})
+
+    def test_dead_end(self):
+        storage = SQLiteStorage(':memory:')
+        MarkovGenerator(MarkovGenerator.TrainStrategy(database=storage, text_path='test_texts/test.txt', window_size=2))
+        words = read_files('test_texts/test.txt').lower().split()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'model.snap')
+            write_snapshot(path, MarkovGenerator(MarkovGenerator.GenerateStrategy(storage, 2)).strategy.model.freeze())
+            loaded = load_snapshot(path)
+            # Генерация длиннее текста проходит через тупик в конце текста
+            for sentence in loaded.generate_batch(10, len(words) * 3):
+                self.assertLessEqual(set(sentence.split()), set(words))
+
+    def test_loader_without_pymongo(self):
+        code = 'import sys, snapshot; sys.exit("pymongo" in sys.modules)'
+        self.assertEqual(subprocess.run([sys.executable, '-c', code]).returncode, 0)
 
 
 unittest.main()
@@ -1,5 +1,6 @@
-from read_files import read_files
-import pymongo
+from multiprocessing import Pool
+from read_files import read_files, read_token_chunks, read_word_set, expand_paths
+from cache import LRUCache
 
 
 class Tokenizer:
@@ -36,6 +37,28 @@ class Tokenizer:
             """
             return self.word2idx[word]
 
+        def words_to_idx(self, words):
+            """
+            Получение индексов для списка слов
+
+            :param words: слова
+            :type words: list
+            :return: индексы
+            :rtype: list
+            """
+            return [self.word2idx[word] for word in words]
+
+        def idxs_to_words(self, idxs):
+            """
+            Получение слов для списка индексов
+
+            :param idxs: индексы
+            :type idxs: list
+            :return: слова
+            :rtype: list
+            """
+            return [self.idx2word[idx] for idx in idxs]
+
         def update(self, word):
             """
             Добавление слова в токенизатор
@@ -51,16 +74,31 @@ class Tokenizer:
         """
         Стратегия, предназначенная для первичного запуска токенизатора
         """
-        def __init__(self, text_path):
+        def __init__(self, text_path, chunk_size=None, workers=1):
             """
             Инициализация 'word2idx' и 'idx2word' по заданному датасету
 
-            :param text_path: путь к датасету
-            :type text_path: str
+            :param text_path: путь к датасету, каталог, шаблон glob или список файлов
+            :type text_path: str, list
+            :param chunk_size: количество слов в порции при потоковом чтении, None - чтение целиком
+            :type chunk_size: int
+            :param workers: количество процессов чтения, если файлов несколько
+            :type workers: int
             """
             super().__init__()
-            text = read_files(text_path)
-            text = (text.lower()).split()
+            paths = expand_paths(text_path)
+            if len(paths) > 1:
+                text = set()
+                with Pool(workers) as pool:
+                    for words in pool.imap_unordered(read_word_set, paths):
+                        text.update(words)
+            elif chunk_size:
+                text = set()
+                for chunk in read_token_chunks(paths[0], chunk_size):
+                    text.update(word.lower() for word in chunk)
+            else:
+                text = read_files(paths[0])
+                text = (text.lower()).split()
             data = sorted(set(text))
             self.word2idx = {item: idx for idx, item in enumerate(data)}
             self.idx2word = [item for item in data]
@@ -68,33 +106,49 @@ class Tokenizer:
             del data
             del text
 
+    class CorpusStrategy(Strategy):
+        """
+        Стратегия первичного запуска по словарю подготовленного корпуса, без чтения текста
+        """
+        def __init__(self, words):
+            """
+
+            :param words: отсортированный словарь 'idx -> word'
+            :type words: list
+            """
+            super().__init__()
+            self.idx2word = list(words)
+            self.word2idx = {word: idx for idx, word in enumerate(self.idx2word)}
+
     class FullLoadStrategy(Strategy):
         """
         Стратегия, полностью загружающая токенизатор из базы данных
         """
-        def __init__(self, collection):
+        def __init__(self, storage):
             """
             Загрузка 'word2idx' и 'idx2word' из базы данных
 
-            :param collection: коллекция токенизатора
+            :param storage: хранилище токенизатора
+            :type storage: class storage.Storage
             """
             super().__init__()
-            self.idx2word = list()
-            self.word2idx = dict()
-            for pair in collection.find():
-                self.idx2word.append(pair['word'])
-                self.word2idx[pair['word']] = pair['idx']
+            self.word2idx = {word: idx for idx, word in storage.iter_tokens()}
+            # Индексы могут идти с пропусками: неиспользованные остатки аренды, удаленные слова
+            self.idx2word = [None] * (max(self.word2idx.values(), default=-1) + 1)
+            for word, idx in self.word2idx.items():
+                self.idx2word[idx] = word
 
     class LoadStrategy:
         """
         Стратегия для работы с токенизатором из базы данных
         """
-        def __init__(self, collection):
+        def __init__(self, storage):
             """
 
-            :param collection: коллекция токенизатора
+            :param storage: хранилище токенизатора
+            :type storage: class storage.Storage
             """
-            self.collection = collection
+            self.storage = storage
 
         def idx_to_word(self, idx):
             """
@@ -109,7 +163,7 @@ class Tokenizer:
             if type(idx) == str:
                 idx = int(idx)
 
-            return self.collection.find_one({'idx': idx})['word']
+            return self.storage.find_words([idx])[idx]
 
         def word_to_idx(self, word):
             """
@@ -120,7 +174,32 @@ class Tokenizer:
             :return: индекс по заданному слову
             :rtype: int
             """
-            return self.collection.find_one({'word': word})['idx']
+            return self.storage.find_idxs([word])[word]
+
+        def words_to_idx(self, words):
+            """
+            Получение индексов для списка слов одним запросом на порцию уникальных слов
+
+            :param words: слова
+            :type words: list
+            :return: индексы
+            :rtype: list
+            """
+            found = self.storage.find_idxs(list(set(words)))
+            return [found[word] for word in words]
+
+        def idxs_to_words(self, idxs):
+            """
+            Получение слов для списка индексов одним запросом на порцию уникальных индексов
+
+            :param idxs: индексы
+            :type idxs: list
+            :return: слова
+            :rtype: list
+            """
+            idxs = [int(idx) for idx in idxs]
+            found = self.storage.find_words(list(set(idxs)))
+            return [found[idx] for idx in idxs]
 
         def update(self, word, counter):
             """
@@ -131,25 +210,41 @@ class Tokenizer:
             :param counter: счетчик
             :type counter: class counter.Counter
             """
-            found = self.collection.update_one({'word': word.lower()}, {'$setOnInsert': {'idx': counter.get('tokens') + 1}}, upsert=True).upserted_id
-            if found is not None:
-                counter.increment('tokens', 1)
+            self.update_many([word], counter)
 
-        def update_many(self, words, counter):
+        def update_many(self, words, counter, batch_size=50000):
             """
-            Множественный вызов def update(word, counter)
+            Добавление нескольких слов в токенизатор: повторы убираются локально,
+            существующие слова ищутся одним запросом на порцию, для новых слов
+            резервируется непрерывный диапазон индексов одним увеличением счетчика
+            или из арендованного блока ('class counter.IdLease')
 
             :param words: список слов
             :type words: list
             :param counter: счетчик
             :type counter: class counter.Counter
+            :param batch_size: количество слов в одном запросе
+            :type batch_size: int
+            :return: индексы всех переданных слов
+            :rtype: dict
             """
-            mx = len(words)
-            for i, word in enumerate(words):
-                print("updating tokenizer: {}/{}".format(i, mx))
-                self.update(word, counter)
-
-        def update_from_text(self, text_path, counter):
+            words = list(dict.fromkeys(word.lower() for word in words))
+            res = dict()
+            for i in range(0, len(words), batch_size):
+                batch = words[i: i + batch_size]
+                found = self.storage.find_idxs(batch)
+                res.update(found)
+                new_words = [word for word in batch if word not in found]
+                if not new_words:
+                    continue
+                first_id = counter.reserve('tokens', len(new_words))
+                pairs = [(first_id + j, word) for j, word in enumerate(new_words)]
+                self.storage.add_tokens(pairs)
+                # Другой процесс мог добавить то же слово раньше - действует записанный индекс
+                res.update(self.storage.find_idxs(new_words))
+            return res
+
+        def update_from_text(self, text_path, counter, chunk_size=None):
             """
             Обновление токенизатора по тексту
 
@@ -157,9 +252,133 @@ class Tokenizer:
             :type text_path: str
             :param counter: счетчик
             :type counter: class counter.Counter
+            :param chunk_size: количество слов в порции при потоковом чтении, None - чтение целиком
+            :type chunk_size: int
+            """
+            if chunk_size:
+                for chunk in read_token_chunks(text_path, chunk_size):
+                    self.update_many(chunk, counter)
+            else:
+                text = read_files(text_path)
+                self.update_many(text.split(), counter)
+
+    class CachingLoadStrategy(LoadStrategy):
+        """
+        Стратегия для работы с токенизатором из базы данных с ограниченным
+        двусторонним кэшем, промахи кэша загружаются одним запросом '$in'
+        """
+        def __init__(self, storage, cache_size=1000000):
+            """
+
+            :param storage: хранилище токенизатора
+            :type storage: class storage.Storage
+            :param cache_size: максимальное количество слов в каждом направлении кэша
+            :type cache_size: int
+            """
+            super().__init__(storage)
+            self.word2idx = LRUCache(cache_size)
+            self.idx2word = LRUCache(cache_size)
+
+        def remember(self, word, idx):
+            """
+            Добавление пары в оба направления кэша
+
+            :param word: слово
+            :type word: str
+            :param idx: индекс
+            :type idx: int
+            """
+            self.word2idx.put(word, idx)
+            self.idx2word.put(idx, word)
+
+        def update_many(self, words, counter, batch_size=50000):
+            """
+            Добавление нескольких слов в токенизатор, слова из кэша не запрашиваются,
+            индексы остальных слов запоминаются в кэше
+
+            :param words: список слов
+            :type words: list
+            :param counter: счетчик
+            :type counter: class counter.Counter
+            :param batch_size: количество слов в одном запросе
+            :type batch_size: int
+            :return: индексы слов, отсутствовавших в кэше
+            :rtype: dict
+            """
+            missing = [word for word in dict.fromkeys(word.lower() for word in words) if word not in self.word2idx]
+            res = super().update_many(missing, counter, batch_size)
+            for word, idx in res.items():
+                self.remember(word, idx)
+            return res
+
+        def idx_to_word(self, idx):
+            """
+            Получение слова для заданного индекса
+
+            :param idx: индекс
+            :type idx: int
+            :return: слово по заданному индексу
+            :rtype: str
+            """
+            return self.idxs_to_words([idx])[0]
+
+        def word_to_idx(self, word):
+            """
+            Получение индекса по заданному слову
+
+            :param word: слово
+            :type word: str
+            :return: индекс по заданному слову
+            :rtype: int
+            """
+            return self.words_to_idx([word])[0]
+
+        def words_to_idx(self, words):
+            """
+            Получение индексов для списка слов, промахи кэша загружаются одним запросом
+
+            :param words: слова
+            :type words: list
+            :return: индексы
+            :rtype: list
+            """
+            res = dict()
+            missing = list()
+            for word in set(words):
+                idx = self.word2idx.get(word)
+                if idx is None:
+                    missing.append(word)
+                else:
+                    res[word] = idx
+            if missing:
+                for word, idx in self.storage.find_idxs(missing).items():
+                    self.remember(word, idx)
+                    res[word] = idx
+            return [res[word] for word in words]
+
+        def idxs_to_words(self, idxs):
+            """
+            Получение слов для списка индексов, промахи кэша загружаются одним запросом
+
+            :param idxs: индексы
+            :type idxs: list
+            :return: слова
+            :rtype: list
             """
-            text = read_files(text_path)
-            self.update_many(text.split(), counter)
+            idxs = [int(idx) for idx in idxs]
+            res = dict()
+            missing = list()
+            for idx in set(idxs):
+                word = self.idx2word.get(idx)
+                if word is None:
+                    missing.append(idx)
+                else:
+                    res[idx] = word
+            if missing:
+                for idx, word in self.storage.find_words(missing).items():
+                    self.remember(word, idx)
+                    res[idx] = word
+            return [res[idx] for idx in idxs]
 
     def __init__(self, strategy):
         """
@@ -192,24 +411,23 @@ class Tokenizer:
         """
         return self.strategy.idx_to_word(idx)
 
-    def text_to_int(self, text):
+    def text_to_int(self, text, counter=None):
         """
         Конвертация текста в цифры
 
         :param text: текст
         :type text: str, optional
+        :param counter: счетчик; если задан, новые слова добавляются в токенизатор в том же проходе
+        :type counter: class counter.Counter, optional
         :return: токенизированный текст
         :rtype: list
         """
         if type(text) == list:
             text = ' '.join(text)
-        res = list()
-        inp = text.split()
-        ln = len(inp)
-        for i, word in enumerate(inp):
-            res.append(self.word2idx(word.lower()))
-            print('converting text to int: {}/{}'.format(i + 1, ln))
-        return res  # [self.word2idx(i.lower()) for i in text.split()]
+        words = [word.lower() for word in text.split()]
+        if counter is not None:
+            self.strategy.update_many(words, counter)
+        return self.strategy.words_to_idx(words)
 
     def int_to_text(self, text_as_int):
         """
@@ -222,18 +440,18 @@ class Tokenizer:
         """
         if type(text_as_int) == str:
             text_as_int = list(map(int, text_as_int.split()))
-        text = ' '.join([self.strategy.idx_to_word(id) for id in text_as_int])
+        text = ' '.join(self.strategy.idxs_to_words(text_as_int))
         return text
 
-    def save(self, collection):
+    def save(self, storage):
         """
         Сохранение токенизатора в базу данных
 
-        :param collection: имя коллекции
+        :param storage: хранилище токенизатора
+        :type storage: class storage.Storage
         """
-        collection.create_index([('idx', pymongo.ASCENDING)], name='idx2word', unique=True)
-        collection.create_index([('word', pymongo.ASCENDING)], name='word2idx', unique=True)
-        collection.insert_many([{'idx': idx, 'word': word} for idx, word in enumerate(self.strategy.idx2word)])
+        storage.create_token_indexes()
+        storage.insert_tokens(list(enumerate(self.strategy.idx2word)))
 
     def change_strategy(self, strategy):
         """
@@ -0,0 +1,261 @@
+import gc
+from multiprocessing import Pool
+from dictogram import Dictogram
+from read_files import read_token_chunks
+from packed_model import PackedModel, count_transitions_packed
+from spill import SpillingModel
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def count_transitions(data, window_size, markov_model=None):
+    """
+    Подсчет переходов цепи Маркова по токенизированному тексту
+
+    :param data: токенизированный текст
+    :type data: list
+    :param window_size: размер окна
+    :type window_size: int
+    :param markov_model: модель, в которую добавляются переходы
+    :type markov_model: dict, optional
+    :return: модель цепи Маркова
+    :rtype: dict
+    """
+    if markov_model is None:
+        markov_model = dict()
+    for current_word in range(0, len(data) - window_size):
+        # Создаем окно
+        window = tuple(data[current_word: current_word + window_size])
+        # Добавляем в словарь
+        if window in markov_model:
+            # Присоединяем к уже существующему распределению
+            markov_model[window].update([data[current_word + window_size]])
+        else:
+            markov_model[window] = Dictogram([data[current_word + window_size]])
+    return markov_model
+
+
+def count_transitions_multi(data, orders, markov_model=None, start=0):
+    """
+    Подсчет переходов для нескольких размеров окна за один проход:
+    для каждого следующего слова учитываются окна всех размеров, заканчивающиеся перед ним
+
+    :param data: токенизированный текст
+    :type data: list
+    :param orders: размеры окна
+    :type orders: iterable
+    :param markov_model: модель, в которую добавляются переходы
+    :type markov_model: dict, optional
+    :param start: позиция первого учитываемого следующего слова, слова до нее - только контекст
+    :type start: int
+    :return: модель цепи Маркова с окнами разной длины
+    :rtype: dict
+    """
+    if markov_model is None:
+        markov_model = dict()
+    orders = sorted(orders)
+    for target in range(max(start, orders[0]), len(data)):
+        word = data[target]
+        for window_size in orders:
+            if window_size > target:
+                break
+            window = tuple(data[target - window_size: target])
+            if window in markov_model:
+                markov_model[window].update([word])
+            else:
+                markov_model[window] = Dictogram([word])
+    return markov_model
+
+
+def merge_models(markov_model, partial_model):
+    """
+    Добавление частичной модели к модели
+
+    :param markov_model: модель, в которую добавляются переходы
+    :type markov_model: dict, class packed_model.PackedModel, class spill.SpillingModel
+    :param partial_model: частичная модель
+    :type partial_model: dict, class packed_model.PackedModel
+    :return: объединенная модель
+    :rtype: dict
+    """
+    if isinstance(markov_model, PackedModel):
+        return markov_model.merge(partial_model)
+    if isinstance(markov_model, SpillingModel):
+        return markov_model.merge(partial_model.sorted_items() if isinstance(partial_model, PackedModel)
+                                  else partial_model.items())
+    if isinstance(partial_model, PackedModel):
+        for window, value in partial_model.sorted_items():
+            if window in markov_model:
+                markov_model[window].add_counts(value)
+            else:
+                markov_model[window] = Dictogram.from_counts(list(value), list(value.values()))
+        return markov_model
+    for window, dictogram in partial_model.items():
+        if window in markov_model:
+            markov_model[window].add_counts(dictogram)
+        else:
+            markov_model[window] = dictogram
+    return markov_model
+
+
+def count_transitions_numpy(data, window_size):
+    """
+    Векторизованный подсчет переходов: строки (окно, следующее слово) строятся
+    скользящим представлением массива и агрегируются сортировкой
+
+    :param data: токенизированный текст
+    :type data: list, numpy.ndarray
+    :param window_size: размер окна
+    :type window_size: int
+    :return: модель цепи Маркова
+    :rtype: dict
+    """
+    if np is None:
+        raise ImportError("engine 'numpy' requires numpy")
+    data = np.asarray(data, dtype=np.int64)
+    markov_model = dict()
+    if len(data) <= window_size:
+        return markov_model
+    rows = np.lib.stride_tricks.sliding_window_view(data, window_size + 1)
+    base = int(data.max()) + 1
+    if base ** (window_size + 1) < 2 ** 63:
+        # Строка упаковывается в одно число, порядок упакованных чисел лексикографический
+        packed = np.zeros(len(rows), dtype=np.int64)
+        for column in range(window_size + 1):
+            packed = packed * base + rows[:, column]
+        packed, counts = np.unique(packed, return_counts=True)
+        rows = np.empty((len(packed), window_size + 1), dtype=np.int64)
+        for column in range(window_size, -1, -1):
+            packed, rows[:, column] = np.divmod(packed, base)
+    else:
+        rows, counts = np.unique(rows, axis=0, return_counts=True)
+
+    windows, successors = rows[:, :-1], rows[:, -1]
+    # Начала групп строк с одинаковым окном
+    starts = np.flatnonzero(np.concatenate(([True], np.any(windows[1:] != windows[:-1], axis=1))))
+    ends = np.append(starts[1:], len(rows)).tolist()
+    successors, counts = successors.tolist(), counts.tolist()
+    # Сборщик мусора отключается на время создания миллионов распределений:
+    # циклических ссылок здесь нет, а его проходы занимают большую часть времени
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for window, start, end in zip(map(tuple, windows[starts].tolist()), starts.tolist(), ends):
+            markov_model[window] = Dictogram.from_counts(successors[start:end], counts[start:end])
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return markov_model
+
+
+def count_shard(shard, window_size, engine):
+    """
+    Подсчет переходов в части текста, выполняется в процессе-обработчике
+
+    :param shard: часть токенизированного текста
+    :type shard: list
+    :param window_size: размер окна
+    :type window_size: int
+    :param engine: способ подсчета переходов: 'python', 'numpy' или 'packed'
+    :type engine: str
+    :return: частичная модель
+    :rtype: dict
+    """
+    if engine == 'numpy':
+        return count_transitions_numpy(shard, window_size)
+    if engine == 'packed':
+        return count_transitions_packed(shard, window_size)
+    return count_transitions(shard, window_size)
+
+
+def split_shards(data, window_size, shards):
+    """
+    Разбиение текста на части, соседние части перекрываются на 'window_size' слов,
+    поэтому каждый переход попадает ровно в одну часть
+
+    :param data: токенизированный текст
+    :type data: list
+    :param window_size: размер окна
+    :type window_size: int
+    :param shards: количество частей
+    :type shards: int
+    :return: части текста
+    :rtype: list
+    """
+    transitions = len(data) - window_size
+    if transitions <= 0:
+        return list()
+    shard_size = -(-transitions // shards)
+    return [data[start: start + shard_size + window_size] for start in range(0, transitions, shard_size)]
+
+
+def count_transitions_parallel(data, window_size, workers, engine='python'):
+    """
+    Параллельный подсчет переходов в пуле процессов с объединением частичных моделей.
+    Результат совпадает с 'count_transitions'
+
+    :param data: токенизированный текст
+    :type data: list
+    :param window_size: размер окна
+    :type window_size: int
+    :param workers: количество процессов
+    :type workers: int
+    :param engine: способ подсчета переходов в процессах: 'python', 'numpy' или 'packed'
+    :type engine: str
+    :return: модель цепи Маркова
+    :rtype: dict, class packed_model.PackedModel
+    """
+    shards = split_shards(data, window_size, workers)
+    with Pool(workers) as pool:
+        partial_models = pool.starmap(count_shard, [(shard, window_size, engine) for shard in shards])
+    markov_model = PackedModel() if engine == 'packed' else dict()
+    for partial_model in partial_models:
+        merge_models(markov_model, partial_model)
+    return markov_model
+
+
+def count_file(filename, orders, chunk_size=1 << 20):
+    """
+    Чтение файла порциями и подсчет переходов по словам, выполняется в процессе-обработчике.
+    Окна не выходят за границы файла, текст файла целиком в памяти не собирается
+
+    :param filename: путь к файлу
+    :type filename: str
+    :param orders: размеры окна
+    :type orders: range
+    :param chunk_size: количество слов в порции
+    :type chunk_size: int
+    :return: частичная модель с окнами из слов
+    :rtype: dict
+    """
+    markov_model = dict()
+    # Первые слова каждой порции, кроме первой, уже учтены в предыдущей
+    start = 0
+    for chunk in read_token_chunks(filename, chunk_size, overlap=orders[-1]):
+        words = [word.lower() for word in chunk]
+        if len(orders) == 1:
+            count_transitions(words, orders[0], markov_model)
+        else:
+            count_transitions_multi(words, orders, markov_model, start)
+        # Порция короче окна переносится целиком
+        start = min(orders[-1], len(chunk))
+    return markov_model
+
+
+def translate_model(markov_model, word2idx):
+    """
+    Перевод модели с окнами из слов в индексы токенизатора
+
+    :param markov_model: модель с окнами из слов
+    :type markov_model: dict
+    :param word2idx: индексы слов
+    :type word2idx: dict
+    :return: модель с окнами из индексов
+    :rtype: dict
+    """
+    return {tuple(word2idx[word] for word in window):
+            Dictogram.from_counts([word2idx[word] for word in dictogram], list(dictogram.values()))
+            for window, dictogram in markov_model.items()}